@@ -12,4 +12,5 @@ from . import moftest
 
 from . import stamps
 from . import fofs
+from . import run
 from . import tests
@@ -0,0 +1,97 @@
+"""
+FFT size planning for the galsim fitters
+
+Each stamp is assigned an FFT size from a small fixed set, so stamps of
+different sizes share the same FFT dimensions, k space grids and draw
+buffers, and sizes are never chosen during the fit
+"""
+from __future__ import print_function
+import numpy as np
+
+# allowed FFT sizes
+FFT_SIZES = [32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+
+class FFTPlanner(object):
+    """
+    assign FFT sizes from a fixed set, and cache the k space grid and
+    draw buffer for each size
+
+    parameters
+    ----------
+    sizes: sequence, optional
+        The allowed sizes, default FFT_SIZES
+    """
+    def __init__(self, sizes=None):
+        if sizes is None:
+            sizes = FFT_SIZES
+
+        self.sizes = np.array(sorted(sizes), dtype='i8')
+        self._counts = {}
+        self._kgrids = {}
+        self._kimages = {}
+
+    def get_size(self, min_size):
+        """
+        get the smallest allowed size at least as big as min_size,
+        and record it
+
+        parameters
+        ----------
+        min_size: int
+            The minimum size
+
+        returns
+        -------
+        size: int
+        """
+        w, = np.where(self.sizes >= min_size)
+        if w.size == 0:
+            raise ValueError(
+                'FFT size %d larger than '
+                'the maximum %d' % (min_size, self.sizes[-1])
+            )
+
+        size = int(self.sizes[w[0]])
+        self._counts[size] = self._counts.get(size, 0) + 1
+        return size
+
+    def get_size_counts(self):
+        """
+        get a dict with the number of times each size was assigned
+        """
+        return dict(self._counts)
+
+    def get_kgrid(self, size):
+        """
+        get the kx and ky values for the half plane used by the real FFT,
+        with shapes (size//2+1, ) and (size, ) in standard FFT order, for
+        unit pixel scale
+        """
+        kgrid = self._kgrids.get(size)
+        if kgrid is None:
+            kx = np.fft.rfftfreq(size)*2.0*np.pi
+            ky = np.fft.fftfreq(size)*2.0*np.pi
+            kgrid = (kx, ky)
+            self._kgrids[size] = kgrid
+
+        return kgrid
+
+    def get_kimage(self, size):
+        """
+        get a galsim k space image covering the half plane used by the
+        real FFT, with ky from -size/2 to size/2-1.  The same image is
+        returned for each call with this size, so it should only be
+        used as a buffer
+        """
+        kimage = self._kimages.get(size)
+        if kimage is None:
+            import galsim
+
+            kimage = galsim.ImageCD(
+                galsim.BoundsI(0, size//2, -size//2, size//2-1),
+                scale=2.0*np.pi/size,
+            )
+            self._kimages[size] = kimage
+
+        return kimage
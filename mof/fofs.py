@@ -1,7 +1,7 @@
 from __future__ import print_function, division
 import os
-import copy
 import numpy as np
+from numba import njit
 import meds
 
 
@@ -39,9 +39,77 @@ class MEDSNbrs(object):
 
     def _init_bounds(self):
         if self.conf['method'] == 'radius':
-            return self._init_bounds_by_radius()
+            self._init_bounds_by_radius()
         else:
-            return self._init_bounds_by_stamps()
+            self._init_bounds_by_stamps()
+
+        self._init_trees()
+
+    def _init_trees(self):
+        """
+        build a kd-tree on the box centers for each band, used to find
+        the candidate overlapping boxes
+
+        Two boxes can only overlap if the distance between the centers,
+        in the max norm, is less than the sum of the half widths
+        """
+        from scipy.spatial import cKDTree
+
+        self.trees = {}
+        self.half_width = {}
+        self.max_half_width = {}
+
+        for band in self.left:
+            rowcen = 0.5*(self.left[band] + self.right[band])
+            colcen = 0.5*(self.bot[band] + self.top[band])
+
+            half_width = 0.5*np.maximum(
+                self.right[band] - self.left[band],
+                self.top[band] - self.bot[band],
+            )
+
+            self.trees[band] = cKDTree(np.column_stack((rowcen, colcen)))
+            self.half_width[band] = half_width
+            self.max_half_width[band] = half_width.max()
+
+    def _get_candidates(self, mindices, band):
+        """
+        get the indices of boxes that could overlap the boxes of the
+        input objects, a list of arrays
+        """
+        tree = self.trees[band]
+        half_width = self.half_width[band]
+
+        # extra for negative buffers, and one pixel for round off; the
+        # exact test is done in check_mindex
+        pad = self._get_max_negative_buff(band) + 1.0
+        radius = half_width[mindices] + self.max_half_width[band] + pad
+
+        candidates = tree.query_ball_point(
+            tree.data[mindices],
+            r=radius,
+            p=np.inf,
+        )
+
+        return [np.array(c, dtype='i8') for c in candidates]
+
+    def _get_max_negative_buff(self, band):
+        """
+        the buffer can only make boxes larger when buff_frac
+        is negative
+        """
+        if self.conf['method'] == 'radius':
+            return 0.0
+
+        buff_frac = self.conf['buff_frac']
+        if buff_frac >= 0:
+            return 0.0
+
+        max_buff = self.sze[band].max()
+        if self.conf['buff_type'] == 'tot':
+            max_buff *= 2
+
+        return -buff_frac*max_buff
 
     def _init_bounds_by_radius(self):
 
@@ -113,14 +181,24 @@ class MEDSNbrs(object):
         nbrs_data = []
         dtype = [('number', 'i8'), ('nbr_number', 'i8')]
 
-        for mindex in range(self.meds_list[0].size):
+        # query the trees for all objects at once
+        mindices = np.arange(self.meds_list[0].size)
+        candidates = {}
+        for band in range(len(self.meds_list)):
+            candidates[band] = self._get_candidates(mindices, band)
+
+        for mindex in mindices:
             nbrs = []
             for band, m in enumerate(self.meds_list):
                 # make sure MEDS lists have the same objects!
                 self._check_ids(m, mindex)
 
                 # add on the nbrs
-                nbrs.extend(list(self.check_mindex(mindex, band)))
+                nbrs.extend(list(self.check_mindex(
+                    mindex,
+                    band,
+                    candidates=candidates[band][mindex],
+                )))
 
             # only keep unique nbrs
             nbrs = np.unique(np.array(nbrs))
@@ -141,7 +219,20 @@ class MEDSNbrs(object):
         assert m['id'][mindex] == self.meds_list[0]['id'][mindex]
         assert m['number'][mindex] == mindex+1
 
-    def check_mindex(self, mindex, band):
+    def check_mindex(self, mindex, band, candidates=None):
+        """
+        get the neighbor numbers for the object in the given band
+
+        parameters
+        ----------
+        mindex: int
+            Index of the object
+        band: int
+            The band to check
+        candidates: array, optional
+            Indices of objects whose boxes might overlap; if not sent
+            the kd-tree for the band is queried
+        """
         m = self.meds_list[band]
 
         # check that current gal has OK stamp, or return bad crap
@@ -159,41 +250,45 @@ class MEDSNbrs(object):
         # use buffer of 1/4 of smaller of pair
         # sze is a diameter
 
+        if candidates is None:
+            candidates = self._get_candidates([mindex], band)[0]
+
+        sze = self.sze[band]
         if self.conf['method'] == 'radius':
             # we don't add any additional buffering when calculating
             # overlap by radius
-            buff = self.sze[band]*0
+            buff = sze[candidates]*0
         else:
-            buff = self.sze[band].copy()
             if self.conf['buff_type'] == 'min':
-                q, = np.where(buff[mindex] < buff)
-                if len(q) > 0:
-                    buff[q[:]] = buff[mindex]
+                buff = np.minimum(sze[candidates], sze[mindex])
             elif self.conf['buff_type'] == 'max':
-                q, = np.where(buff[mindex] > buff)
-                if len(q) > 0:
-                    buff[q[:]] = buff[mindex]
+                buff = np.maximum(sze[candidates], sze[mindex])
             elif self.conf['buff_type'] == 'tot':
-                buff = buff[mindex] + buff
+                buff = sze[mindex] + sze[candidates]
             else:
                 assert False, \
                     "buff_type '%s' not supported!" % self.conf['buff_type']
 
             buff = buff*self.conf['buff_frac']
 
+        left = self.left[band]
+        right = self.right[band]
+        top = self.top[band]
+        bot = self.bot[band]
+
         q, = np.where(
-            (~((self.left[band][mindex] > self.right[band]-buff)
-               | (self.right[band][mindex] < self.left[band]+buff)
-               | (self.top[band][mindex] < self.bot[band]+buff)
-               | (self.bot[band][mindex] > self.top[band]-buff)))
+            (~((left[mindex] > right[candidates]-buff)
+               | (right[mindex] < left[candidates]+buff)
+               | (top[mindex] < bot[candidates]+buff)
+               | (bot[mindex] > top[candidates]-buff)))
             &
-            (m['number'][mindex] != m['number'])
-            & (m['orig_start_row'][:, 0] != -9999)
-            & (m['orig_start_col'][:, 0] != -9999)
+            (m['number'][mindex] != m['number'][candidates])
+            & (m['orig_start_row'][candidates, 0] != -9999)
+            & (m['orig_start_col'][candidates, 0] != -9999)
         )
 
         if len(q) > 0:
-            nbr_numbers.extend(list(m['number'][q]))
+            nbr_numbers.extend(list(m['number'][candidates[q]]))
 
         # check coadd seg maps
         if self.conf['check_seg']:
@@ -231,13 +326,20 @@ class MEDSNbrs(object):
 
 
 class NbrsFoF(object):
+    """
+    Get friends-of-friends groups from the neighbor data
+
+    The groups are found with a union-find over the neighbor edges.
+    The fofid numbering matches that of the original linking code,
+    where a group keeps the id of the first member processed, and the
+    ids are numbered in that order
+    """
     def __init__(self, nbrs_data):
         self.nbrs_data = nbrs_data
         self.Nobj = len(np.unique(nbrs_data['number']))
 
         # records fofid of entry
         self.linked = np.zeros(self.Nobj, dtype='i8')
-        self.fofs = {}
 
         self._fof_data = None
 
@@ -246,44 +348,55 @@ class NbrsFoF(object):
         return self._fof_data
 
     def _make_fofs(self, verbose=True):
-        # init
-        self._init_fofs()
+        indptr, nbr_inds = self._get_nbrs_csr()
 
-        for i in range(self.Nobj):
-            self._link_fof(i)
+        parent = np.zeros(self.Nobj, dtype='i8') - 1
+        rank = np.zeros(self.Nobj, dtype='i8')
+        label = np.zeros(self.Nobj, dtype='i8') - 1
 
-        for fofid, k in enumerate(self.fofs):
-            inds = np.array(list(self.fofs[k]), dtype=int)
-            self.linked[inds[:]] = fofid
-        self.fofs = {}
+        _link_fofs(indptr, nbr_inds, parent, rank, label)
 
-        self._make_fof_data()
+        labels = _get_labels(parent, label)
 
-    def _link_fof(self, mind):
-        # get nbrs for this object
-        nbrs = set(self._get_nbrs_index(mind))
+        # the ids are numbered in order of the surviving labels
+        _, self.linked[:] = np.unique(labels, return_inverse=True)
 
-        # always make a base fof
-        if self.linked[mind] == -1:
-            fofid = copy.copy(mind)
-            self.fofs[fofid] = set([mind])
-            self.linked[mind] = fofid
-        else:
-            fofid = copy.copy(self.linked[mind])
+        self._make_fof_data()
 
-        # loop through nbrs
-        for nbr in nbrs:
-            if self.linked[nbr] == -1 or self.linked[nbr] == fofid:
-                # not linked so add to current
-                self.fofs[fofid].add(nbr)
-                self.linked[nbr] = fofid
-            else:
-                # join!
-                self.fofs[self.linked[nbr]] |= self.fofs[fofid]
-                del self.fofs[fofid]
-                fofid = copy.copy(self.linked[nbr])
-                inds = np.array(list(self.fofs[fofid]), dtype=int)
-                self.linked[inds[:]] = fofid
+    def _get_nbrs_csr(self):
+        """
+        get the neighbor indices for each object in compressed sparse row
+        form, for object i the neighbors are
+        nbr_inds[indptr[i]:indptr[i+1]]
+
+        The neighbors are in the iteration order of a python set built
+        from the list of neighbors, which determines the id of merged
+        groups in the original linking code
+        """
+        nbrs_data = self.nbrs_data
+
+        w, = np.where(nbrs_data['nbr_number'] > 0)
+        inds = nbrs_data['number'][w] - 1
+        nbr_inds = nbrs_data['nbr_number'][w] - 1
+
+        # stable to keep the original order of the neighbors
+        s = inds.argsort(kind='mergesort')
+        inds = inds[s]
+        nbr_inds = nbr_inds[s]
+
+        counts = np.bincount(inds, minlength=self.Nobj)
+        indptr = np.zeros(self.Nobj+1, dtype='i8')
+        indptr[1:] = counts.cumsum()
+
+        # only matters when there are multiple neighbors; duplicates
+        # are left at the end, they are already linked when reached
+        multi, = np.where(counts > 1)
+        for i in multi:
+            beg, end = indptr[i], indptr[i+1]
+            nbrs = list(set(nbr_inds[beg:end].tolist()))
+            nbr_inds[beg:beg+len(nbrs)] = nbrs
+
+        return indptr, nbr_inds
 
     def _make_fof_data(self):
         self._fof_data = []
@@ -297,20 +410,82 @@ class NbrsFoF(object):
         self._fof_data = self._fof_data[i]
         assert np.all(self._fof_data['fofid'] >= 0)
 
-    def _init_fofs(self):
-        self.linked[:] = -1
-        self.fofs = {}
 
-    def _get_nbrs_index(self, mind):
-        q, = np.where(
-            (self.nbrs_data['number'] == mind+1)
-            &
-            (self.nbrs_data['nbr_number'] > 0)
-        )
-        if len(q) > 0:
-            return list(self.nbrs_data['nbr_number'][q]-1)
-        else:
-            return []
+@njit
+def _find_root(parent, i):
+    """
+    find the root of the tree containing i, with path compression
+    """
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+
+    while parent[i] != root:
+        next_i = parent[i]
+        parent[i] = root
+        i = next_i
+
+    return root
+
+
+@njit
+def _link_fofs(indptr, nbr_inds, parent, rank, label):
+    """
+    link the objects into groups, with union by rank
+
+    parent is -1 for objects not yet in a group.  The label for each
+    root is the id of the group.  When an object is linked to a
+    neighbor in another group, the merged group takes the label of
+    the neighbor's group, as in the original linking code
+    """
+    nobj = indptr.size-1
+
+    for i in range(nobj):
+        if parent[i] == -1:
+            # new group
+            parent[i] = i
+            rank[i] = 0
+            label[i] = i
+
+        root = _find_root(parent, i)
+
+        for k in range(indptr[i], indptr[i+1]):
+            nbr = nbr_inds[k]
+
+            if parent[nbr] == -1:
+                # not linked so add to current
+                parent[nbr] = root
+                if rank[root] == 0:
+                    rank[root] = 1
+            else:
+                nbr_root = _find_root(parent, nbr)
+                if nbr_root == root:
+                    continue
+
+                # join!
+                new_label = label[nbr_root]
+                if rank[root] < rank[nbr_root]:
+                    parent[root] = nbr_root
+                    root = nbr_root
+                elif rank[root] > rank[nbr_root]:
+                    parent[nbr_root] = root
+                else:
+                    parent[nbr_root] = root
+                    rank[root] += 1
+
+                label[root] = new_label
+
+
+@njit
+def _get_labels(parent, label):
+    """
+    get the group label for each object
+    """
+    nobj = parent.size
+    labels = np.zeros(nobj, dtype=np.int64)
+    for i in range(nobj):
+        labels[i] = label[_find_root(parent, i)]
+    return labels
 
 
 def plot_fofs(m,
@@ -15,7 +15,13 @@ from ngmix.gexceptions import GMixRangeError
 from ngmix.fitting import run_leastsq
 from ngmix.priors import LOWVAL
 
-from .moflib import MOFStamps, DEFAULT_LM_PARS
+from .moflib import MOFStamps, DEFAULT_LM_PARS, get_lin_fluxes
+from . import procflags
+from . import kspace
+from . import fftplan
+import logging
+
+logger = logging.getLogger(__name__)
 
 FOLDING_THRESHOLD = 0.05
 
@@ -29,6 +35,14 @@ class KGSMOF(MOFStamps):
         """
         list_of_obs is not an ObsList, it is a python list of
         Observation/ObsList/MultiBandObsList
+
+        Send analytic_kspace=True to evaluate the fourier transforms of
+        the models directly on the k space grid of each stamp, rather
+        than drawing galsim objects, see mof.kspace
+
+        For GSMOF, send fft_draw=True to convolve with a cached k space
+        image of the psf, see GSMOF._draw_fft.  The FFT sizes are taken
+        from the fixed set fft_sizes, default mof.fftplan.FFT_SIZES
         """
         # import galsim
         # self._gsp = galsim.GSParams(folding_threshold=FOLDING_THRESHOLD)
@@ -36,6 +50,9 @@ class KGSMOF(MOFStamps):
         self._gsp = None
 
         self.use_logpars = keys.get('use_logpars', False)
+        self.analytic_kspace = keys.get('analytic_kspace', False)
+        self.fft_draw = keys.get('fft_draw', False)
+        self._fft_sizes = keys.get('fft_sizes', None)
 
         self._set_all_obs(list_of_obs)
         self._setup_nbrs()
@@ -123,23 +140,26 @@ class KGSMOF(MOFStamps):
         """
         import galsim
 
-        # we cannot keep sending existing array into leastsq, don't know why
-        fdiff = np.zeros(self.fdiff_size)
+        if self.analytic_kspace:
+            return self._calc_fdiff_kspace(pars)
+
+        # the same array is filled for each call; leastsq copies it
+        fdiff = self._get_workspace()['fdiff']
+        fdiff[:] = 0.0
         start = 0
 
+        allpars = pars.reshape(self.nobj, self.npars_per)
+
         try:
 
+            band_pars_table = self._get_band_pars_table(pars)
+
             for iobj, mbo in enumerate(self.list_of_obs):
                 # fill priors and get new start
-                objpars = self.get_object_pars(pars, iobj)
-                start = self._fill_priors(objpars, fdiff, start)
+                start = self._fill_priors(allpars[iobj], fdiff, start)
 
                 for band, obslist in enumerate(mbo):
-                    band_pars = self.get_object_band_pars(
-                        pars,
-                        iobj,
-                        band,
-                    )
+                    band_pars = band_pars_table[iobj, band]
 
                     for obs in obslist:
 
@@ -162,6 +182,7 @@ class KGSMOF(MOFStamps):
                             band,
                             maxrad,
                             obs,
+                            band_pars_table=band_pars_table,
                         )
 
                         if len(nbr_models) > 0:
@@ -203,6 +224,43 @@ class KGSMOF(MOFStamps):
 
         return fdiff
 
+    def _calc_fdiff_kspace(self, pars):
+        """
+        vector with (model-data)/error, with the models evaluated
+        analytically in k space
+        """
+
+        # the same array is filled for each call; leastsq copies it
+        fdiff = self._get_workspace()['fdiff']
+        start = 0
+
+        allpars = pars.reshape(self.nobj, self.npars_per)
+        kmodel = self._kspace_model
+
+        try:
+
+            band_pars_table = self._get_band_pars_table(pars)
+
+            for iobj, mbo in enumerate(self.list_of_obs):
+                # fill priors and get new start
+                start = self._fill_priors(allpars[iobj], fdiff, start)
+
+                for band, obslist in enumerate(mbo):
+                    band_pars = band_pars_table[:, band]
+
+                    for obs in obslist:
+                        start = kmodel.fill_fdiff(
+                            band_pars,
+                            obs.meta['kspace'],
+                            fdiff,
+                            start,
+                        )
+
+        except GMixRangeError:
+            fdiff[:] = LOWVAL
+
+        return fdiff
+
     def _make_fully_shifted_model(self, band_pars, obs):
         """
         get the model with the relative shift, but also the shift
@@ -224,15 +282,25 @@ class KGSMOF(MOFStamps):
         scale = obs.meta['scale']
         return obs.image.shape[0]*scale*0.5
 
-    def _get_nbr_models(self, iobj, pars, meta, band, maxrad, obs):
+    def _get_nbr_models(self, iobj, pars, meta, band, maxrad, obs,
+                        band_pars_table=None):
+        """
+        get the models for the neighbors within maxrad.  If the
+        band_pars_table is sent, the pars are taken from there rather
+        than from get_object_band_pars, see _get_band_pars_table
+        """
         models = []
         for nbr in meta['nbr_data']:
             # assert nbr['index'] != iobj
-            nbr_pars = self.get_object_band_pars(
-                pars,
-                nbr['index'],
-                band,
-            )
+            if band_pars_table is None:
+                nbr_pars = self.get_object_band_pars(
+                    pars,
+                    nbr['index'],
+                    band,
+                )
+            else:
+                nbr_pars = self._get_workspace()['tpars']
+                nbr_pars[:] = band_pars_table[nbr['index'], band]
 
             # the current pars [v,u,..] are relative to
             # fiducial position.  we need to add these to
@@ -423,6 +491,50 @@ class KGSMOF(MOFStamps):
         self.max_dim_arcsec = max_dim
         self.totpix = totpix
 
+        if self.analytic_kspace:
+            self._init_kspace()
+
+    def _init_kspace(self):
+        """
+        set the data for rendering each stamp in k space.  The psf is
+        drawn in k space once, and the neighbors to render are those
+        within maxrad, see _get_nbr_models
+        """
+        self._kspace_model = kspace.KSpaceModel(
+            self.model,
+            use_logpars=self.use_logpars,
+        )
+
+        for iobj, mbobs in enumerate(self.list_of_obs):
+            for obslist in mbobs:
+                for obs in obslist:
+                    meta = obs.meta
+
+                    dv, du = self._get_jcen_shift(obs)
+                    maxrad = self._get_maxrad(obs)
+
+                    index = [iobj]
+                    offsets = [(dv, du)]
+                    for nbr in meta['nbr_data']:
+                        rad_offset = np.sqrt(
+                            nbr['v0']**2 + nbr['u0']**2
+                        )
+                        if rad_offset < maxrad:
+                            index.append(nbr['index'])
+                            offsets.append((nbr['v0'] + dv, nbr['u0'] + du))
+
+                    psf_kimage = meta['psf_ii'].drawKImage(
+                        image=meta['kimage'].copy(),
+                    )
+
+                    meta['kspace'] = kspace.make_kspace_stamp(
+                        meta['kimage'],
+                        psf_kimage,
+                        meta['ierr'],
+                        index,
+                        offsets,
+                    )
+
     def _set_fdiff_size(self):
         """
         we have 2*totpix, since we use both real and imaginary
@@ -651,23 +763,23 @@ class GSMOF(KGSMOF):
         import galsim
         from galsim import GalSimFFTSizeError
 
-        # we cannot keep sending existing array into leastsq, don't know why
-        fdiff = np.zeros(self.fdiff_size)
+        # the same array is filled for each call; leastsq copies it
+        fdiff = self._get_workspace()['fdiff']
+        fdiff[:] = 0.0
         start = 0
 
+        allpars = pars.reshape(self.nobj, self.npars_per)
+
         try:
 
+            band_pars_table = self._get_band_pars_table(pars)
+
             for iobj, mbo in enumerate(self.list_of_obs):
                 # fill priors and get new start
-                objpars = self.get_object_pars(pars, iobj)
-                start = self._fill_priors(objpars, fdiff, start)
+                start = self._fill_priors(allpars[iobj], fdiff, start)
 
                 for band, obslist in enumerate(mbo):
-                    band_pars = self.get_object_band_pars(
-                        pars,
-                        iobj,
-                        band,
-                    )
+                    band_pars = band_pars_table[iobj, band]
 
                     for obs in obslist:
 
@@ -686,6 +798,7 @@ class GSMOF(KGSMOF):
                             band,
                             maxrad,
                             obs,
+                            band_pars_table=band_pars_table,
                         )
 
                         if len(nbr_models) > 0:
@@ -698,16 +811,19 @@ class GSMOF(KGSMOF):
                         else:
                             total_model = central_model
 
-                        total_model = galsim.Convolve(
-                            total_model,
-                            obs.psf.meta['ii'],
-                            gsparams=self._gsp,
-                        )
+                        if self.fft_draw:
+                            tfdiff = self._draw_fft(obs, total_model)
+                        else:
+                            total_model = galsim.Convolve(
+                                total_model,
+                                obs.psf.meta['ii'],
+                                gsparams=self._gsp,
+                            )
 
-                        self._do_draw(obs, total_model, model)
+                            self._do_draw(obs, total_model, model)
+                            tfdiff = model.array
 
                         # (model-data)/err
-                        tfdiff = model.array
                         tfdiff -= obs.image
                         tfdiff *= ierr
 
@@ -742,6 +858,38 @@ class GSMOF(KGSMOF):
             offset=offset,
         )
 
+    def _draw_fft(self, obs, obj):
+        """
+        draw the object convolved with the psf, using the k space image
+        of the psf cached by _init_fft_draw
+
+        The unconvolved object is drawn in k space on the half plane
+        needed for the real FFT, multiplied by the psf, which includes
+        the phase to put the object at the jacobian center, and
+        transformed back.  Unlike drawImage, k values beyond the Nyquist
+        frequency of the stamp are not folded back in
+
+        returns
+        -------
+        image: array
+            The model image, with the same shape as the observation
+        """
+        fdata = obs.meta['fft_draw']
+        kimage = fdata['kimage']
+        dim = fdata['dim']
+
+        image_obj = fdata['wcs'].profileToImage(obj)
+        image_obj.drawKImage(image=kimage, recenter=False)
+
+        # ky runs from -dim/2 to dim/2-1, need standard FFT order
+        kmodel = np.fft.ifftshift(kimage.array, axes=0)
+        kmodel *= fdata['psf_kimage']
+
+        image = np.fft.irfft2(kmodel, s=(dim, dim))
+
+        nrow, ncol = obs.image.shape
+        return image[:nrow, :ncol]
+
     '''
     def get_object_s2n(self, i):
         """
@@ -773,9 +921,14 @@ class GSMOF(KGSMOF):
 
     def _get_maxrad(self, obs):
         """
-        no problem with off-stamp neighbors for real space fitting
+        no problem with off-stamp neighbors for real space fitting,
+        except when drawing with a fixed FFT size, where neighbors
+        far from the stamp would wrap around
         """
-        return 1.e9
+        if self.fft_draw:
+            return obs.meta['fft_draw']['maxrad']
+        else:
+            return 1.e9
 
     def _set_all_obs(self, list_of_obs):
         self.list_of_obs = list_of_obs
@@ -794,6 +947,11 @@ class GSMOF(KGSMOF):
         model images for each observation will be added to meta
         """
 
+        if self.fft_draw:
+            self.fft_planner = fftplan.FFTPlanner(
+                sizes=self._fft_sizes,
+            )
+
         totpix = 0
         max_dim = 0
         for mbobs in self.list_of_obs:
@@ -815,6 +973,9 @@ class GSMOF(KGSMOF):
                     meta['wpositive'] = w
                     self._create_models_in_obs(obs)
 
+                    if self.fft_draw:
+                        self._init_fft_draw(obs)
+
                     dim = max(obs.image.shape)*jac.scale
                     max_dim = max(max_dim, dim)
 
@@ -824,6 +985,11 @@ class GSMOF(KGSMOF):
         self.max_dim_arcsec = max_dim
         self.totpix = totpix
 
+        if self.fft_draw:
+            logger.debug(
+                'FFT sizes: %s' % self.fft_planner.get_size_counts()
+            )
+
     def _create_models_in_obs(self, obs):
         import galsim
 
@@ -844,6 +1010,53 @@ class GSMOF(KGSMOF):
         meta['model'] = gsimage
         obs.psf.meta['ii'] = psf_ii
 
+    def _init_fft_draw(self, obs):
+        """
+        set the FFT size for the stamp, the k space buffer for drawing
+        the model, and the k space image of the psf in image coordinates
+
+        The FFT is at least twice the size of the stamp, so neighbors
+        within a stamp width of the center are drawn without wrapping
+        around; the size is taken from the fixed set of the fft_planner,
+        and stamps with the same size share the k space buffer.  The phase
+        to put the model center at the position given by
+        _get_fft_draw_cen is included in the psf image
+        """
+        planner = self.fft_planner
+
+        jac = obs.jacobian
+        wcs = jac.get_galsim_wcs()
+
+        size = max(max(obs.image.shape), max(obs.psf.image.shape))
+        dim = planner.get_size(2*size)
+        kimage = planner.get_kimage(dim)
+
+        psf_obj = wcs.profileToImage(obs.psf.meta['ii'])
+        psf_obj.drawKImage(image=kimage, recenter=False)
+        psf_kimage = np.fft.ifftshift(kimage.array, axes=0)
+
+        kx, ky = planner.get_kgrid(dim)
+
+        row, col = self._get_fft_draw_cen(obs)
+        psf_kimage *= np.exp(
+            -1j*(kx[np.newaxis, :]*col + ky[:, np.newaxis]*row)
+        )
+
+        obs.meta['fft_draw'] = {
+            'dim': dim,
+            'wcs': wcs,
+            'kimage': kimage,
+            'psf_kimage': psf_kimage,
+            'maxrad': max(obs.image.shape)*jac.scale,
+        }
+
+    def _get_fft_draw_cen(self, obs):
+        """
+        the models are drawn centered on the jacobian center,
+        as for _do_draw
+        """
+        return obs.jacobian.get_cen()
+
     def make_image(self, iobj, band=0, obsnum=0, include_nbrs=False):
         """
         make an image for the given band and observation number
@@ -906,11 +1119,26 @@ class GSMOF(KGSMOF):
 class GSMOFFlux(GSMOF):
     """
     flux only fitter
+
+    Send linear_solve=True to solve for the fluxes directly with linear
+    least squares, rather than running leastsq.  The templates are drawn
+    with unit flux, so the fluxes are totals rather than sums over the
+    stamps
+
+    Send parent_templates=True to draw each neighbor once for each image,
+    in the frame of the parent image, and slice out its contribution to
+    each stamp, see _get_parent_template
     """
     def __init__(self, list_of_obs, model, **keys):
         import galsim
 
         self._gsp = galsim.GSParams(folding_threshold=FOLDING_THRESHOLD)
+        self.fft_draw = keys.get('fft_draw', False)
+        self._fft_sizes = keys.get('fft_sizes', None)
+        self.linear_solve = keys.get('linear_solve', False)
+        self.parent_templates = keys.get('parent_templates', False)
+        self._parent_templates = {}
+        self._parent_bounds = {}
 
         self._set_all_obs(list_of_obs)
         self._setup_nbrs()
@@ -918,6 +1146,9 @@ class GSMOFFlux(GSMOF):
 
         self._set_model_maker()
 
+        # the input model pars and the fluxes are linear
+        self.use_logpars = False
+
         self.nobj = len(self.list_of_obs)
 
         self.npars_per = self.nband
@@ -953,19 +1184,20 @@ class GSMOFFlux(GSMOF):
 
         The npars elements contain -ln(prior)
         """
-        import galsim
         from galsim import GalSimFFTSizeError
 
-        # we cannot keep sending existing array into leastsq, don't know why
-        fdiff = np.zeros(self.fdiff_size)
+        # the same array is filled for each call; leastsq copies it
+        fdiff = self._get_workspace()['fdiff']
+        fdiff[:] = 0.0
         start = 0
 
+        allpars = pars.reshape(self.nobj, self.npars_per)
+
         try:
 
             for iobj, mbo in enumerate(self.list_of_obs):
                 # fill priors and get new start
-                objpars = self.get_object_pars(pars, iobj)
-                start = self._fill_priors(objpars, fdiff, start)
+                start = self._fill_priors(allpars[iobj], fdiff, start)
 
                 for band, obslist in enumerate(mbo):
                     if 'summed_image' not in obslist[0].meta:
@@ -986,7 +1218,6 @@ class GSMOFFlux(GSMOF):
                     for obs in obslist:
 
                         meta = obs.meta
-                        model = meta['model']
                         ierr = meta['ierr']
 
                         if 'summed_image' not in meta:
@@ -996,51 +1227,29 @@ class GSMOFFlux(GSMOF):
                                 obs,
                             )
 
-                            central_image = model.copy()
-                            convolved_model = galsim.Convolve(
+                            central_image = self._draw_template(
+                                obs,
                                 central_model,
-                                obs.psf.meta['ii'],
-                                gsparams=self._gsp,
-                            )
-                            convolved_model.drawImage(
-                                image=central_image,
-                                method='no_pixel',
                             )
 
                             maxrad = self._get_maxrad(obs)
-                            nbr_models = self._get_nbr_models(
+                            nbr_images = self._draw_nbr_templates(
                                 iobj,
-                                pars,
-                                meta,
                                 band,
-                                maxrad,
                                 obs,
+                                pars,
                             )
 
-                            central_image = central_image.array
                             summed_image = central_image.copy()
-
-                            nbr_images = []
-                            for nbr_model in nbr_models:
-                                nbr_image = model.copy()
-
-                                convolved_model = galsim.Convolve(
-                                    nbr_model,
-                                    obs.psf.meta['ii'],
-                                    gsparams=self._gsp,
-                                )
-                                convolved_model.drawImage(
-                                    image=nbr_image,
-                                    method='no_pixel',
-                                )
-
-                                nbr_image = nbr_image.array
-                                nbr_images.append(nbr_image)
-
+                            for nbr_image in nbr_images:
                                 summed_image += nbr_image
 
                             meta['central_image'] = central_image
                             meta['nbr_images'] = nbr_images
+                            meta['nbr_indices'] = self._get_nbr_indices(
+                                meta,
+                                maxrad,
+                            )
                             meta['summed_image'] = summed_image
                         else:
 
@@ -1085,16 +1294,316 @@ class GSMOFFlux(GSMOF):
 
         return fdiff
 
+    def go(self, guess=None):
+        """
+        Run leastsq and set the result.  If linear_solve was set, the
+        fluxes are found directly and the guess is not needed
+        """
+        if self.linear_solve:
+            self._go_linear()
+        else:
+            super(GSMOFFlux, self).go(guess)
+
+    def _go_linear(self):
+        """
+        solve for the fluxes in each band with linear least squares and
+        set the result, with the same pars layout as for leastsq
+
+        Objects that could not be solved for in a band are flagged in
+        flux_flags, which also has the pars layout
+        """
+        from galsim import GalSimFFTSizeError
+
+        pars = np.zeros(self.npars)
+        pars_cov = np.zeros((self.npars, self.npars))
+        pars_err = np.zeros(self.npars)
+        flux_flags = np.zeros(self.npars, dtype='i4')
+
+        result = {
+            'model': self.model,
+            'flags': 0,
+            'nfev': 0,
+            'pars': pars,
+            'flux_flags': flux_flags,
+        }
+
+        chi2 = 0.0
+        try:
+            for band in range(self.nband):
+                band_res = self._get_lin_flux_band(band)
+
+                ind = np.arange(self.nobj)*self.npars_per + band
+                pars[ind] = band_res['flux']
+                pars_cov[np.ix_(ind, ind)] = band_res['flux_cov']
+                pars_err[ind] = band_res['flux_err']
+                flux_flags[ind] = band_res['flags']
+                chi2 += band_res['chi2']
+
+        except (GMixRangeError, GalSimFFTSizeError) as err:
+            logger.info(str(err))
+            result['flags'] = procflags.GMIX_RANGE_ERROR
+        except np.linalg.LinAlgError as err:
+            logger.info(str(err))
+            result['flags'] = procflags.LIN_ALG_ERROR
+
+        if result['flags'] == 0:
+            result['pars_cov'] = pars_cov
+            result['pars_err'] = pars_err
+
+            dof = self.totpix - self.npars
+            if dof > 0:
+                result['chi2per'] = chi2/dof
+
+        self._result = result
+
+    def _get_lin_flux_band(self, band):
+        """
+        get the fluxes for all objects in the band using linear least
+        squares, see moflib.get_lin_fluxes
+        """
+        return get_lin_fluxes(self._get_band_stamp_data(band), self.nobj)
+
+    def _get_band_stamp_data(self, band):
+        """
+        yield the object indices, weighted templates and weighted image
+        for each stamp in the band, as needed by moflib.get_lin_fluxes
+        """
+
+        # the templates are drawn with unit flux
+        flux_pars = np.ones(self.npars)
+
+        for iobj, mbo in enumerate(self.list_of_obs):
+            for obs in mbo[band]:
+                indices, templates = self._get_stamp_templates(
+                    iobj, band, obs, flux_pars,
+                )
+                rim = (obs.image*obs.meta['ierr']).ravel()
+                yield indices, templates, rim
+
+    def _get_stamp_templates(self, iobj, band, obs, pars):
+        """
+        get the weighted templates for the central object and the
+        neighbors drawn into the stamp, for the fluxes in pars
+
+        returns
+        -------
+        indices, templates
+            The object indices and the templates, shape
+            (len(indices), npix)
+        """
+        meta = obs.meta
+
+        band_pars = self.get_object_band_pars(pars, iobj, band)
+        central_model = self._make_fully_shifted_model(band_pars, obs)
+
+        images = [self._draw_template(obs, central_model)]
+        images += self._draw_nbr_templates(iobj, band, obs, pars)
+
+        maxrad = self._get_maxrad(obs)
+        indices = np.array(
+            [iobj] + self._get_nbr_indices(meta, maxrad),
+            dtype='i8',
+        )
+
+        templates = np.zeros((indices.size, obs.image.size))
+        for i, image in enumerate(images):
+            templates[i] = (image*meta['ierr']).ravel()
+
+        return indices, templates
+
+    def _draw_nbr_templates(self, iobj, band, obs, pars):
+        """
+        get images of the neighbors within maxrad in the stamp, in the
+        order given by _get_nbr_indices
+        """
+        meta = obs.meta
+        maxrad = self._get_maxrad(obs)
+
+        if self.parent_templates:
+            return [
+                self._get_parent_template_slice(index, band, obs, pars)
+                for index in self._get_nbr_indices(meta, maxrad)
+            ]
+
+        nbr_models = self._get_nbr_models(
+            iobj,
+            pars,
+            meta,
+            band,
+            maxrad,
+            obs,
+        )
+
+        return [
+            self._draw_template(obs, nbr_model)
+            for nbr_model in nbr_models
+        ]
+
+    def _get_parent_template_slice(self, index, band, obs, pars):
+        """
+        get a copy of the part of the parent frame template for the
+        object that overlaps the stamp
+        """
+        meta = obs.meta
+
+        template, start_row, start_col = self._get_parent_template(
+            index, band, meta['file_id'], pars,
+        )
+
+        nrow, ncol = obs.image.shape
+        row = meta['orig_start_row'] - start_row
+        col = meta['orig_start_col'] - start_col
+
+        return template[row:row+nrow, col:col+ncol].copy()
+
+    def _get_parent_template(self, index, band, file_id, pars):
+        """
+        get the image of the object convolved with its psf in the frame
+        of the parent image, covering its own stamp and the stamps it is
+        drawn into as a neighbor, see _get_parent_bounds.  The template
+        is drawn once for each object, band and image
+
+        The object is drawn using the psf and jacobian of its own stamp,
+        rather than those of the stamp it is a neighbor in
+
+        returns
+        -------
+        template, start_row, start_col
+            The image and the location of its first pixel in the
+            parent image
+        """
+        import galsim
+
+        key = (index, band, file_id)
+        if key in self._parent_templates:
+            return self._parent_templates[key]
+
+        start_row, start_col, nrow, ncol = self._get_parent_bounds(
+            index, band, file_id,
+        )
+
+        for obs in self.list_of_obs[index][band]:
+            if obs.meta['file_id'] == file_id:
+                break
+        else:
+            raise ValueError('object %d has no stamp in '
+                             'file %d' % (index, file_id))
+
+        meta = obs.meta
+        jac = obs.jacobian
+
+        band_pars = self.get_object_band_pars(pars, index, band)
+        model = galsim.Convolve(
+            self.make_model(band_pars),
+            obs.psf.meta['ii'],
+            gsparams=self._gsp,
+        )
+
+        # put the model center at the jacobian center of the object's
+        # stamp, as for _do_draw
+        jrow, jcol = jac.get_cen()
+        jrow += meta['orig_start_row'] - start_row
+        jcol += meta['orig_start_col'] - start_col
+        offset = (jcol - (ncol - 1.0)/2.0, jrow - (nrow - 1.0)/2.0)
+
+        image = galsim.Image(
+            ncol, nrow,
+            dtype=np.float64,
+            wcs=jac.get_galsim_wcs(),
+        )
+        model.drawImage(
+            image=image,
+            method='no_pixel',
+            offset=offset,
+        )
+
+        res = (image.array, start_row, start_col)
+        self._parent_templates[key] = res
+        return res
+
+    def _get_parent_bounds(self, index, band, file_id):
+        """
+        get the start row, start col and size of the region of the
+        parent image covered by the stamp of the object and the stamps
+        from that image it is drawn into as a neighbor, see
+        _get_nbr_indices
+        """
+        key = (index, band, file_id)
+        if key not in self._parent_bounds:
+            row_min, col_min = np.inf, np.inf
+            row_max, col_max = -np.inf, -np.inf
+
+            for iobj, mbo in enumerate(self.list_of_obs):
+                for obs in mbo[band]:
+                    meta = obs.meta
+                    if meta['file_id'] != file_id:
+                        continue
+
+                    if iobj != index:
+                        maxrad = self._get_maxrad(obs)
+                        nbr_indices = self._get_nbr_indices(meta, maxrad)
+                        if index not in nbr_indices:
+                            continue
+
+                    nrow, ncol = obs.image.shape
+                    row_min = min(row_min, meta['orig_start_row'])
+                    col_min = min(col_min, meta['orig_start_col'])
+                    row_max = max(row_max, meta['orig_start_row'] + nrow)
+                    col_max = max(col_max, meta['orig_start_col'] + ncol)
+
+            self._parent_bounds[key] = (
+                int(row_min),
+                int(col_min),
+                int(row_max - row_min),
+                int(col_max - col_min),
+            )
+
+        return self._parent_bounds[key]
+
+    def _draw_template(self, obs, obj):
+        """
+        draw the object convolved with the psf into a new array with
+        the shape of the observation
+        """
+        import galsim
+
+        if self.fft_draw:
+            return self._draw_fft(obs, obj).copy()
+
+        image = obs.meta['model'].copy()
+
+        convolved_model = galsim.Convolve(
+            obj,
+            obs.psf.meta['ii'],
+            gsparams=self._gsp,
+        )
+        convolved_model.drawImage(
+            image=image,
+            method='no_pixel',
+        )
+
+        return image.array
+
+    def _get_fft_draw_cen(self, obs):
+        """
+        the models include the shift to the jacobian center, so are
+        drawn centered on the stamp, as for drawImage
+        """
+        return (np.array(obs.image.shape) - 1.0)/2.0
+
     def get_object_band_flux(self, flux_pars, iobj, band):
         """
-        get the input pars plus the flux
+        get the flux for the object in the band
+
+        The linear solve can give negative fluxes for faint objects, so
+        they are only rejected when running leastsq
         """
 
         ind = iobj*self.npars_per + band
 
         flux = flux_pars[ind]
 
-        if flux < 0.0:
+        if flux < 0.0 and not self.linear_solve:
             raise GMixRangeError('flux less than zero')
 
         return flux
@@ -1120,17 +1629,34 @@ class GSMOFFlux(GSMOF):
         return pars
 
     def _get_nbr_fluxes(self, iobj, pars, meta, band, maxrad):
+        """
+        get the fluxes for the neighbors that were drawn into
+        nbr_images
+        """
         fluxes = []
-        for nbr in meta['nbr_data']:
+        for index in meta['nbr_indices']:
             flux = self.get_object_band_flux(
                 pars,
-                nbr['index'],
+                index,
                 band,
             )
             fluxes.append(flux)
 
         return fluxes
 
+    def _get_nbr_indices(self, meta, maxrad):
+        """
+        get the indices of the neighbors within maxrad, in the order
+        of the models returned by _get_nbr_models
+        """
+        indices = []
+        for nbr in meta['nbr_data']:
+            rad_offset = np.sqrt(nbr['v0']**2 + nbr['u0']**2)
+            if rad_offset < maxrad:
+                indices.append(nbr['index'])
+
+        return indices
+
     def _fill_priors(self, pars, fdiff, start):
         """
         no priors for this fitter
@@ -1161,6 +1687,11 @@ class GSMOFFlux(GSMOF):
         res['flux_cov'] = res['pars_cov'].copy()
         res['flux_err'] = np.sqrt(np.diag(res['flux_cov']))
 
+        if 'flux_flags' in self._result:
+            res['flux_flags'] = self.get_object_pars(
+                self._result['flux_flags'], i,
+            )
+
         return res
 
 
@@ -1173,6 +1704,8 @@ class GSMOFFluxReRender(GSMOF):
         # self._gsp = galsim.GSParams(folding_threshold=FOLDING_THRESHOLD)
 
         self._gsp = None
+        self.fft_draw = keys.get('fft_draw', False)
+        self._fft_sizes = keys.get('fft_sizes', None)
 
         self._set_all_obs(list_of_obs)
         self._setup_nbrs()
@@ -1234,6 +1767,22 @@ class GSMOFFluxReRender(GSMOF):
         pars[-1] = flux
         return pars
 
+    def _make_band_pars_table(self):
+        """
+        array to hold the band pars for all objects and bands
+        """
+        return np.zeros((self.nobj, self.nband, self.nband_pars_per_full))
+
+    def _fill_band_pars_table(self, pars, table):
+        """
+        the fixed pars come from the input, so fill object by object
+        """
+        for iobj in range(self.nobj):
+            for band in range(self.nband):
+                table[iobj, band] = self.get_object_band_pars(
+                    pars, iobj, band,
+                )
+
     def _fill_priors(self, pars, fdiff, start):
         """
         no priors for this fitter
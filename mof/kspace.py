@@ -0,0 +1,349 @@
+"""
+analytic k space models for the KGSMOF fitter
+
+The fourier transforms of the galsim models are evaluated directly on the
+k space grid of each stamp, rather than building galsim objects and calling
+drawKImage for every evaluation.  The gaussian and exponential profiles have
+closed forms; the sersic profiles are interpolated from a table of the round,
+unit half light radius profile, drawn once using galsim.  The shear and shift
+are applied to the k grid, and the result is multiplied by the k space image
+of the psf, which is also drawn once for each stamp.
+"""
+from __future__ import print_function
+import numpy as np
+from numba import njit
+from ngmix.gexceptions import GMixRangeError
+
+# half light radius of a gaussian in units of sigma, sqrt(2 ln 2)
+GAUSS_HLR_PER_SIGMA = 1.1774100225154747
+
+# half light radius of an exponential in units of the scale radius
+EXP_HLR_PER_R0 = 1.6783469900166605
+
+KMODEL_GAUSS = 0
+KMODEL_EXP = 1
+KMODEL_DEV = 2
+KMODEL_BDF = 3
+
+KMODEL_CODES = {
+    'gauss': KMODEL_GAUSS,
+    'exp': KMODEL_EXP,
+    'dev': KMODEL_DEV,
+    'bdf': KMODEL_BDF,
+}
+
+# sersic index for the dev model and the bulge of the bdf model,
+# see galsimfit.make_bdf
+DEV_SERSIC_N = 4
+BDF_BULGE_SERSIC_N = 2
+
+# the sersic tables are evaluated at q = k*hlr, evenly spaced in ln(q)
+SERSIC_TABLE_QMIN = 1.0e-3
+SERSIC_TABLE_QMAX = 1.0e4
+SERSIC_TABLE_SIZE = 8000
+
+SERSIC_TABLE_LNQMIN = np.log(SERSIC_TABLE_QMIN)
+SERSIC_TABLE_DLNQ = (
+    (np.log(SERSIC_TABLE_QMAX) - SERSIC_TABLE_LNQMIN)/(SERSIC_TABLE_SIZE-1)
+)
+
+# tables for each sersic index, see get_sersic_ktable
+_SERSIC_TABLES = {}
+
+# status returned by the fill kernel
+KSPACE_BAD_SHEAR = 2**0
+KSPACE_BAD_HLR = 2**1
+
+MAX_G = 0.99
+
+
+class KSpaceModel(object):
+    """
+    render models in k space and fill the fdiff array
+
+    parameters
+    ----------
+    model: string
+        The model, one of gauss, exp, dev or bdf
+    use_logpars: bool, optional
+        If True, the half light radius and flux are log10 values
+    """
+    def __init__(self, model, use_logpars=False):
+        if model not in KMODEL_CODES:
+            raise NotImplementedError("can't fit '%s' in k space" % model)
+
+        self.model = model
+        self.code = KMODEL_CODES[model]
+        self.use_logpars = use_logpars
+
+        if model == 'dev':
+            self.table = get_sersic_ktable(DEV_SERSIC_N)
+        elif model == 'bdf':
+            self.table = get_sersic_ktable(BDF_BULGE_SERSIC_N)
+        else:
+            # not used
+            self.table = np.zeros(2)
+
+    def fill_fdiff(self, band_pars, stamp, fdiff, start):
+        """
+        fill the real and then imaginary parts of (model-data)/err for
+        the stamp into fdiff
+
+        parameters
+        ----------
+        band_pars: array
+            Parameters for all objects in this band, shape
+            (nobj, nband_pars_per)
+        stamp: dict
+            Data for the stamp, as returned by make_kspace_stamp
+        fdiff: array
+            The array to fill
+        start: int
+            Where to start filling
+
+        returns
+        -------
+        The new start
+        """
+        status = _fill_kspace_fdiff(
+            self.code,
+            self.use_logpars,
+            self.table,
+            band_pars,
+            stamp['index'],
+            stamp['offsets'],
+            stamp['kx'],
+            stamp['ky'],
+            stamp['psf_kimage'],
+            stamp['kimage'],
+            stamp['ierr'],
+            fdiff,
+            start,
+        )
+
+        if status & KSPACE_BAD_SHEAR:
+            raise GMixRangeError('g too big')
+        if status & KSPACE_BAD_HLR:
+            raise GMixRangeError('hlr must be positive')
+
+        return start + 2*stamp['kimage'].size
+
+
+def make_kspace_stamp(kimage, psf_kimage, ierr, index, offsets):
+    """
+    get the data needed to render a stamp in k space
+
+    parameters
+    ----------
+    kimage: galsim Image
+        The k space image of the data, as returned by drawKImage
+    psf_kimage: galsim Image
+        The k space image of the psf, drawn on the same grid as kimage
+    ierr: array
+        1/err for each k space pixel
+    index: sequence
+        Index of each object to render into the stamp, starting with the
+        central
+    offsets: sequence
+        The (v, u) offset to add to the center of each object
+
+    returns
+    -------
+    stamp: dict
+    """
+    kx, ky = get_kgrid(kimage)
+
+    return {
+        'kx': kx,
+        'ky': ky,
+        'kimage': kimage.array,
+        'psf_kimage': psf_kimage.array,
+        'ierr': ierr,
+        'index': np.array(index, dtype='i8'),
+        'offsets': np.array(offsets, dtype='f8').reshape(-1, 2),
+    }
+
+
+def get_kgrid(kimage):
+    """
+    get the kx and ky values for the columns and rows of a k space image
+    """
+    bounds = kimage.bounds
+    dk = kimage.scale
+
+    kx = np.arange(bounds.xmin, bounds.xmax+1)*dk
+    ky = np.arange(bounds.ymin, bounds.ymax+1)*dk
+    return kx, ky
+
+
+def get_sersic_ktable(n):
+    """
+    get a table of the fourier transform of a round sersic profile with
+    unit half light radius and flux, evaluated at the q values given by
+    SERSIC_TABLE_LNQMIN and SERSIC_TABLE_DLNQ.  The tables are cached
+    for each n
+    """
+    table = _SERSIC_TABLES.get(n)
+
+    if table is None:
+        import galsim
+
+        prof = galsim.Sersic(n=n, half_light_radius=1.0)
+
+        lnq = SERSIC_TABLE_LNQMIN + SERSIC_TABLE_DLNQ*np.arange(
+            SERSIC_TABLE_SIZE,
+        )
+        table = np.array([
+            prof.kValue(q, 0.0).real for q in np.exp(lnq)
+        ])
+        table.flags.writeable = False
+
+        _SERSIC_TABLES[n] = table
+
+    return table
+
+
+@njit
+def _fill_kspace_fdiff(code,
+                       use_logpars,
+                       table,
+                       band_pars,
+                       index,
+                       offsets,
+                       kx,
+                       ky,
+                       psf_kimage,
+                       kimage,
+                       ierr,
+                       fdiff,
+                       start):
+    """
+    sum the models for the objects, multiply by the psf and fill
+    (model-data)/err, real parts first and then imaginary
+    """
+    nobj = index.size
+    nky, nkx = kimage.shape
+    npix = nkx*nky
+
+    # shear matrix, size and flux for each object
+    shear = np.zeros((nobj, 3))
+    hlrs = np.zeros(nobj)
+    fracdevs = np.zeros(nobj)
+    fluxes = np.zeros(nobj)
+
+    # the shift is separable, exp(-i kx x0) exp(-i ky y0)
+    xphase = np.zeros((nobj, nkx), dtype=np.complex128)
+    yphase = np.zeros((nobj, nky), dtype=np.complex128)
+
+    for j in range(nobj):
+        pars = band_pars[index[j]]
+
+        y0 = pars[0] + offsets[j, 0]
+        x0 = pars[1] + offsets[j, 1]
+        g1 = pars[2]
+        g2 = pars[3]
+        hlr = pars[4]
+
+        if code == KMODEL_BDF:
+            fracdevs[j] = pars[5]
+            flux = pars[6]
+        else:
+            flux = pars[5]
+
+        if use_logpars:
+            hlr = 10.0**hlr
+            flux = 10.0**flux
+
+        gsq = g1**2 + g2**2
+        if gsq > MAX_G**2:
+            return KSPACE_BAD_SHEAR
+        if hlr <= 0.0:
+            return KSPACE_BAD_HLR
+
+        # the sheared profile is I(S^-1 x), with transform F(S k)
+        norm = 1.0/np.sqrt(1.0 - gsq)
+        shear[j, 0] = (1.0 + g1)*norm
+        shear[j, 1] = g2*norm
+        shear[j, 2] = (1.0 - g1)*norm
+
+        hlrs[j] = hlr
+        fluxes[j] = flux
+
+        for ix in range(nkx):
+            xphase[j, ix] = np.exp(-1j*kx[ix]*x0)
+        for iy in range(nky):
+            yphase[j, iy] = np.exp(-1j*ky[iy]*y0)
+
+    for iy in range(nky):
+        tky = ky[iy]
+        for ix in range(nkx):
+            tkx = kx[ix]
+
+            val = 0.0 + 0.0j
+            for j in range(nobj):
+                skx = shear[j, 0]*tkx + shear[j, 1]*tky
+                sky = shear[j, 1]*tkx + shear[j, 2]*tky
+                ksq = skx**2 + sky**2
+
+                kval = _get_round_kvalue(
+                    code, ksq, hlrs[j], fracdevs[j], table,
+                )
+                val += fluxes[j]*kval*xphase[j, ix]*yphase[j, iy]
+
+            val = val*psf_kimage[iy, ix] - kimage[iy, ix]
+
+            ipix = iy*nkx + ix
+            fdiff[start + ipix] = val.real*ierr[iy, ix]
+            fdiff[start + npix + ipix] = val.imag*ierr[iy, ix]
+
+    return 0
+
+
+@njit
+def _get_round_kvalue(code, ksq, hlr, fracdev, table):
+    """
+    fourier transform of the round, unit flux profile at k**2
+    """
+    if code == KMODEL_GAUSS:
+        sigma = hlr/GAUSS_HLR_PER_SIGMA
+        return np.exp(-0.5*ksq*sigma**2)
+
+    elif code == KMODEL_EXP:
+        r0 = hlr/EXP_HLR_PER_R0
+        return _get_exp_kvalue(ksq*r0**2)
+
+    elif code == KMODEL_DEV:
+        return _interp_sersic_ktable(np.sqrt(ksq)*hlr, table)
+
+    else:
+        r0 = hlr/EXP_HLR_PER_R0
+        bulge = _interp_sersic_ktable(np.sqrt(ksq)*hlr, table)
+        disk = _get_exp_kvalue(ksq*r0**2)
+        return fracdev*bulge + (1.0 - fracdev)*disk
+
+
+@njit
+def _get_exp_kvalue(ksq_r0sq):
+    """
+    fourier transform of a unit flux exponential
+    """
+    tmp = 1.0 + ksq_r0sq
+    return 1.0/(tmp*np.sqrt(tmp))
+
+
+@njit
+def _interp_sersic_ktable(q, table):
+    """
+    interpolate the sersic table linearly in ln(q); the transform is
+    taken to be zero beyond the end of the table
+    """
+    if q <= SERSIC_TABLE_QMIN:
+        return table[0]
+
+    x = (np.log(q) - SERSIC_TABLE_LNQMIN)/SERSIC_TABLE_DLNQ
+    i = int(x)
+    if i >= table.size-1:
+        return 0.0
+
+    frac = x - i
+    return table[i]*(1.0 - frac) + table[i+1]*frac
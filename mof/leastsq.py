@@ -0,0 +1,178 @@
+"""
+least squares fitting with a jacobian supplied by the caller
+
+The result dict has the same main entries as ngmix.fitting.run_leastsq
+so the fitters can use either one
+"""
+from __future__ import print_function
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# flags set in the result
+LM_MAXFEV = 2**0
+LM_SINGULAR_MATRIX = 2**4
+LM_NEG_COV_EIG = 2**5
+LM_NEG_COV_DIAG = 2**6
+LM_FUNC_NOTFINITE = 2**8
+
+
+def run_leastsq_jac(func, jac, guess, n_prior_pars, bounds=None, **keys):
+    """
+    run scipy.optimize.least_squares using the input jacobian function
+
+    parameters
+    ----------
+    func: callable
+        The function to minimize, returning the fdiff array
+    jac: callable
+        Function returning the jacobian d(fdiff)/d(pars), shape
+        (fdiff_size, npars)
+    guess: array
+        Initial guess for the parameters
+    n_prior_pars: int
+        Number of elements in fdiff coming from priors; these are
+        not counted when calculating the chi squared per dof
+    bounds: sequence, optional
+        Bounds for each parameter as (low, high), where either can
+        be None
+    **keys:
+        Extra keywords for the solver.  The leastsq keyword maxfev
+        is translated to max_nfev
+
+    returns
+    -------
+    result: dict
+        With entries flags, nfev, pars, pars_err, pars_cov etc.
+    """
+    from scipy.optimize import least_squares
+
+    guess = np.array(guess, dtype='f8', copy=True)
+    npars = guess.size
+
+    lower, upper = get_bounds_arrays(bounds, npars)
+    guess.clip(min=lower, max=upper, out=guess)
+
+    lskeys = _get_least_squares_keys(keys)
+
+    result = {
+        'flags': 0,
+        'nfev': 0,
+        'pars': guess,
+    }
+
+    try:
+        res = least_squares(
+            func,
+            guess,
+            jac=jac,
+            bounds=(lower, upper),
+            method='trf',
+            **lskeys
+        )
+    except ValueError as err:
+        # this happens for non-finite fdiff
+        logger.info(str(err))
+        result['flags'] = LM_FUNC_NOTFINITE
+        result['errmsg'] = str(err)
+        return result
+
+    result['nfev'] = res.nfev
+    result['ier'] = res.status
+    result['errmsg'] = res.message
+    result['pars'] = res.x
+
+    if res.status <= 0:
+        result['flags'] |= LM_MAXFEV
+        return result
+
+    fdiff = res.fun
+    dof = fdiff.size - n_prior_pars - npars
+    if dof > 0:
+        result['chi2per'] = (fdiff[n_prior_pars:]**2).sum()/dof
+
+    flags, pars_cov = get_pars_cov(res.jac)
+    result['flags'] |= flags
+    if flags == 0:
+        result['pars_cov'] = pars_cov
+        result['pars_err'] = np.sqrt(np.diag(pars_cov))
+
+    return result
+
+
+def get_pars_cov(jac):
+    """
+    get the parameter covariance matrix as the inverse
+    of J^T J
+
+    parameters
+    ----------
+    jac: array or sparse matrix
+        The jacobian at the best fit
+
+    returns
+    -------
+    flags, pars_cov
+    """
+
+    jtj = jac.T.dot(jac)
+    if hasattr(jtj, 'toarray'):
+        jtj = jtj.toarray()
+
+    try:
+        pars_cov = np.linalg.inv(jtj)
+    except np.linalg.LinAlgError as err:
+        logger.info(str(err))
+        return LM_SINGULAR_MATRIX, None
+
+    if np.any(np.diag(pars_cov) <= 0.0):
+        return LM_NEG_COV_DIAG, None
+
+    eigs = np.linalg.eigvalsh(0.5*(pars_cov + pars_cov.T))
+    if np.any(eigs <= 0.0):
+        return LM_NEG_COV_EIG, None
+
+    return 0, pars_cov
+
+
+def get_bounds_arrays(bounds, npars):
+    """
+    convert bounds in the form [(low, high), ...] to lower
+    and upper arrays, with None converted to -inf or inf
+    """
+    lower = np.zeros(npars) - np.inf
+    upper = np.zeros(npars) + np.inf
+
+    if bounds is not None:
+        if len(bounds) != npars:
+            raise ValueError('got %d bounds for '
+                             '%d parameters' % (len(bounds), npars))
+
+        for i, (low, high) in enumerate(bounds):
+            if low is not None:
+                lower[i] = low
+            if high is not None:
+                upper[i] = high
+
+    return lower, upper
+
+
+def _get_least_squares_keys(keys):
+    """
+    translate leastsq style keywords
+    """
+    lskeys = {}
+    for key in ['ftol', 'xtol', 'gtol', 'x_scale', 'tr_solver']:
+        if key in keys:
+            lskeys[key] = keys[key]
+
+    if 'maxfev' in keys:
+        lskeys['max_nfev'] = keys['maxfev']
+    elif 'max_nfev' in keys:
+        lskeys['max_nfev'] = keys['max_nfev']
+
+    if 'x_scale' not in lskeys:
+        lskeys['x_scale'] = 'jac'
+
+    return lskeys
@@ -9,7 +9,7 @@ todo:
 from __future__ import print_function
 import numpy as np
 from numpy import dot
-from numba import njit
+from numba import njit, prange
 import ngmix
 from ngmix.gmix import GMix, GMixModel, GMixBDF
 from ngmix.fitting import LMSimple
@@ -31,6 +31,7 @@ from . import (
     priors,
     procflags,
 )
+from .leastsq import run_leastsq_jac, get_bounds_arrays
 import logging
 
 logger = logging.getLogger(__name__)
@@ -41,6 +42,44 @@ DEFAULT_LM_PARS = {
     'xtol': 1.0e-5,
 }
 
+# gaussians are not evaluated beyond this chi squared when
+# calculating the jacobian
+JAC_MAX_CHI2 = 25.0
+
+# relative step for finite difference derivatives
+FDIFF_STEP = 1.0e-7
+
+# in the linear flux solve, objects whose templates have a sum of squares
+# below this fraction of the largest are flagged and left out, and the
+# normal matrix is solved with a pseudo-inverse if its condition number,
+# after scaling to unit diagonal, is above LIN_FLUX_MAX_COND
+LIN_FLUX_MIN_DIAG = 1.0e-12
+LIN_FLUX_MAX_COND = 1.0e12
+
+# gaussians are evaluated within this many sigma when rendering in tiles.
+# The box contains the region where the chi squared of the gaussian is
+# less than JAC_MAX_CHI2, the same cut used by gmix_eval_pixel_fast
+TILE_NSIGMA = 5.0
+
+# tables for the packed representation of the stamps, see
+# MOFStamps._setup_packed_data
+PACKED_STAMP_DTYPE = [
+    ('index', 'i8'),
+    ('band', 'i8'),
+    ('fdiff_start', 'i8'),
+    ('pix_start', 'i8'),
+    ('pix_end', 'i8'),
+    ('psf_start', 'i8'),
+    ('psf_end', 'i8'),
+    ('nbr_start', 'i8'),
+    ('nbr_end', 'i8'),
+]
+PACKED_NBR_DTYPE = [
+    ('index', 'i8'),
+    ('v0', 'f8'),
+    ('u0', 'f8'),
+]
+
 
 class MOF(LMSimple):
     """
@@ -49,6 +88,12 @@ class MOF(LMSimple):
     def __init__(self, obs, model, nobj, **keys):
         """
         currently model is same for all objects
+
+        Send tile_size to split the images into square tiles of that many
+        pixels, and only evaluate each gaussian in the tiles overlapped
+        by a box of trunc_nsigma around its center, default TILE_NSIGMA.
+        Send parallel=True to render the tiles in parallel using the
+        numba threads
         """
         super(LMSimple, self).__init__(obs, model, **keys)
 
@@ -93,6 +138,10 @@ class MOF(LMSimple):
             # default in leastsq is 100*(self.npars+1)
             self.lm_pars['maxfev'] = 300*(self.npars+1)
 
+        self.tile_size = keys.get('tile_size', None)
+        self.trunc_nsigma = keys.get('trunc_nsigma', None)
+        self.parallel = keys.get('parallel', False)
+
     def go(self, guess):
         """
         Run leastsq and set the result
@@ -127,6 +176,117 @@ class MOF(LMSimple):
 
         self._result = result
 
+    def _calc_fdiff(self, pars):
+        """
+        vector with (model-data)/error.
+
+        The npars elements contain -ln(prior)
+
+        If tile_size was sent, the images are rendered in tiles,
+        see _get_tile_index
+        """
+        if self.tile_size is None:
+            return super(MOF, self)._calc_fdiff(pars)
+
+        if self.parallel:
+            fill_func = fill_fdiff_tiled_parallel
+        else:
+            fill_func = fill_fdiff_tiled
+
+        nsigma = self.trunc_nsigma
+        if nsigma is None:
+            nsigma = TILE_NSIGMA
+
+        fdiff = np.zeros(self.fdiff_size)
+
+        try:
+            # all norms are set after fill
+            self._fill_gmix_all(pars)
+            start = self._fill_priors(pars, fdiff)
+
+            for band in range(self.nband):
+                obs_list = self.obs[band]
+                gmix_list = self._gmix_all[band]
+
+                for obs, gm in zip(obs_list, gmix_list):
+                    tile_index = self._get_tile_index(obs)
+                    fill_func(
+                        gm._data,
+                        obs._pixels,
+                        fdiff,
+                        start,
+                        tile_index['jinv'],
+                        tile_index['dims'],
+                        self.tile_size,
+                        tile_index['tile_ptr'],
+                        tile_index['order'],
+                        nsigma,
+                    )
+                    start += obs.pixels.size
+
+        except GMixRangeError:
+            fdiff[:] = LOWVAL
+
+        return fdiff
+
+    def _get_tile_index(self, obs):
+        """
+        get an index of the pixels in each tile of the image; cached in
+        the meta data
+
+        returns
+        -------
+        index: dict
+            jinv: see _get_jinv
+            dims: the dimensions of the image
+            tile_ptr: the pixels in tile i are
+                order[tile_ptr[i]:tile_ptr[i+1]], with the tiles
+                numbered in row major order
+            order: index into the pixel array of the pixels sorted by tile
+        """
+        meta = obs.meta
+        if 'tile_index' in meta:
+            return meta['tile_index']
+
+        jacobian = obs.jacobian
+        pixels = obs.pixels
+        tile_size = self.tile_size
+
+        dims = np.array(obs.image.shape, dtype='i8')
+        ntile_col = (dims[1] + tile_size - 1)//tile_size
+        ntile = ntile_col*((dims[0] + tile_size - 1)//tile_size)
+
+        rows, cols = jacobian.get_rowcol(pixels['v'], pixels['u'])
+        rows = np.rint(rows).astype('i8').clip(min=0, max=dims[0]-1)
+        cols = np.rint(cols).astype('i8').clip(min=0, max=dims[1]-1)
+
+        tiles = (rows//tile_size)*ntile_col + cols//tile_size
+        order = tiles.argsort(kind='mergesort')
+        tile_ptr = np.searchsorted(tiles[order], np.arange(ntile+1))
+
+        tile_index = {
+            'jinv': self._get_jinv(jacobian),
+            'dims': dims,
+            'tile_ptr': tile_ptr,
+            'order': order,
+        }
+        meta['tile_index'] = tile_index
+        return tile_index
+
+    def _get_jinv(self, jacobian):
+        """
+        get the row, col of v, u = 0 followed by the derivatives
+        drow/dv, drow/du, dcol/dv, dcol/du
+        """
+        row0, col0 = jacobian.get_rowcol(0.0, 0.0)
+        rowv, colv = jacobian.get_rowcol(1.0, 0.0)
+        rowu, colu = jacobian.get_rowcol(0.0, 1.0)
+        return np.array([
+            row0, col0,
+            rowv - row0, rowu - row0,
+            colv - col0, colu - col0,
+        ])
+
     def _get_bounds(self, nobj):
         """
         get bounds on parameters
@@ -528,6 +688,26 @@ class MOFStamps(MOF):
         """
         list_of_obs is not an ObsList, it is a python list of
         Observation/ObsList/MultiBandObsList
+
+        Send analytic_jacobian=True to use analytic derivatives of the
+        models rather than finite differences; supported for the simple
+        models and bdf
+
+        Send sparse_jacobian=True to represent the jacobian as a sparse
+        matrix built from the neighbor lists.  Only the stamps touched by
+        an object are re-rendered when taking finite differences
+
+        Send packed=True to copy all pixels, psfs and neighbor lists
+        into flat arrays, and calculate the fdiff array with a single
+        numba call.  Supported for the simple models and bdf
+
+        Send nbr_cull_thresh to only render neighbors into a stamp if
+        their peak contribution, evaluated at the start of each call to
+        go, is larger than this value times the noise
+
+        Send trunc_nsigma to only evaluate each gaussian at pixels
+        within a box of that many sigma around its center.  Not used
+        with packed=True
         """
 
         self._set_all_obs(list_of_obs)
@@ -580,6 +760,22 @@ class MOFStamps(MOF):
             # default in leastsq is 100*(self.npars+1)
             self.lm_pars['maxfev'] = 300*(self.npars+1)
 
+        self.analytic_jacobian = keys.get('analytic_jacobian', False)
+        self.sparse_jacobian = keys.get('sparse_jacobian', False)
+        if self.analytic_jacobian and self.model_name == 'bd':
+            raise NotImplementedError(
+                'analytic jacobian not implemented for bd'
+            )
+
+        self.packed = keys.get('packed', False)
+        if self.packed and self.model_name == 'bd':
+            raise NotImplementedError(
+                'packed fdiff not implemented for bd'
+            )
+
+        self.nbr_cull_thresh = keys.get('nbr_cull_thresh', None)
+        self.trunc_nsigma = keys.get('trunc_nsigma', None)
+
     def go(self, guess):
         """
         Run leastsq and set the result
@@ -594,16 +790,34 @@ class MOFStamps(MOF):
             raise ValueError("bad guess size: %d" % guess.size)
 
         self._setup_data(guess)
+        if self.nbr_cull_thresh is not None:
+            self._cull_nbrs(guess)
+        if self.packed:
+            self._setup_packed_data()
 
         bounds = self._get_bounds(nobj)
 
-        result = run_leastsq(
-            self._calc_fdiff,
-            guess,
-            self.n_prior_pars,
-            bounds=bounds,
-            **self.lm_pars
-        )
+        if self.analytic_jacobian or self.sparse_jacobian:
+            _, self._upper_bounds = get_bounds_arrays(bounds, self.npars)
+            if self.sparse_jacobian:
+                self._setup_jacobian_blocks()
+
+            result = run_leastsq_jac(
+                self._calc_fdiff_copy,
+                self._calc_jacobian,
+                guess,
+                self.n_prior_pars,
+                bounds=bounds,
+                **self.lm_pars
+            )
+        else:
+            result = run_leastsq(
+                self._calc_fdiff,
+                guess,
+                self.n_prior_pars,
+                bounds=bounds,
+                **self.lm_pars
+            )
 
         result['model'] = self.model_name
         if result['flags'] == 0:
@@ -870,69 +1084,188 @@ class MOFStamps(MOF):
         The npars elements contain -ln(prior)
         """
 
-        # we cannot keep sending existing array into leastsq, don't know why
-        fdiff = np.zeros(self.fdiff_size)
+        if self.packed:
+            return self._calc_fdiff_packed(pars)
+
+        # the same array is filled for each call, see _calc_fdiff_copy
+        fdiff = self._get_workspace()['fdiff']
+        fdiff[:] = 0.0
         start = 0
 
+        # convolved mixtures for each object, band and psf, which are
+        # shifted when rendering into the stamps
+        gmix_cache = self._get_gmix_cache(pars)
+        allpars = pars.reshape(self.nobj, self.npars_per)
+
         try:
 
             for iobj, mbo in enumerate(self.list_of_obs):
                 # fill priors and get new start
-                objpars = self.get_object_pars(pars, iobj)
-                start = self._fill_priors(objpars, fdiff, start)
+                start = self._fill_priors(allpars[iobj], fdiff, start)
 
                 for band, obslist in enumerate(mbo):
                     for obs in obslist:
+                        self._fill_stamp_fdiff(
+                            pars, iobj, band, obs, fdiff, start,
+                            gmix_cache=gmix_cache,
+                        )
+                        start += obs.pixels.size
+
+        except GMixRangeError:
+            fdiff[:] = LOWVAL
 
-                        meta = obs.meta
-                        pixels = obs.pixels
+        return fdiff
 
-                        gm0 = meta['gmix0']
-                        gm = meta['gmix']
-                        psf_gmix = obs.psf.gmix
+    def _calc_fdiff_copy(self, pars):
+        """
+        get a new copy of the fdiff array
 
-                        tpars = self.get_object_band_pars(
-                            pars,
-                            iobj,
-                            band,
-                        )
+        _calc_fdiff fills the same array for every call.  That is fine
+        for leastsq, which copies the result into its own work array,
+        but least_squares keeps the arrays for the current and trial
+        steps, so they must not be overwritten
+        """
+        return self._calc_fdiff(pars).copy()
 
-                        self._update_model(tpars,
-                                           gm0, gm, psf_gmix,
-                                           pixels, fdiff, start)
-
-                        # now also do same for neighbors. We can re-use
-                        # the gmixes
-                        for nbr in meta['nbr_data']:
-                            tnbr_pars = self.get_object_band_pars(
-                                pars,
-                                nbr['index'],
-                                band,
-                            )
-                            # the current pars [v,u,..] are relative to
-                            # fiducial position.  we need to add these to
-                            # the fiducial for the rendering within
-                            # the stamp of the central
-                            tnbr_pars[0] += nbr['v0']
-                            tnbr_pars[1] += nbr['u0']
-                            self._update_model(tnbr_pars,
-                                               gm0, gm, psf_gmix,
-                                               pixels, fdiff, start)
-
-                        # convert model values to fdiff
-                        ngmix.fitting_nb.finish_fdiff(
-                            obs._pixels,
-                            fdiff,
-                            start,
-                        )
+    def _calc_fdiff_packed(self, pars):
+        """
+        vector with (model-data)/error, using the packed representation
+        of the data.  The priors are filled first, then all the stamps
+        in a single call
+        """
+
+        fdiff = self._get_workspace()['fdiff']
+        fdiff[:] = 0.0
+        packed = self._packed
+        allpars = pars.reshape(self.nobj, self.npars_per)
 
-                        start += pixels.size
+        try:
+            for iobj, start in enumerate(packed['prior_starts']):
+                self._fill_priors(allpars[iobj], fdiff, start)
+
+            if self.model_name == 'bdf':
+                fill_fdiff_packed_bdf(
+                    packed['fill_func'],
+                    packed['TdByTe'],
+                    pars,
+                    self.npars_per,
+                    packed['band_pars'],
+                    packed['gmix0'],
+                    packed['gmix'],
+                    packed['stamps'],
+                    packed['pixels'],
+                    packed['psfs'],
+                    packed['nbrs'],
+                    fdiff,
+                )
+            else:
+                fill_fdiff_packed(
+                    packed['fill_func'],
+                    pars,
+                    self.npars_per,
+                    packed['band_pars'],
+                    packed['gmix0'],
+                    packed['gmix'],
+                    packed['stamps'],
+                    packed['pixels'],
+                    packed['psfs'],
+                    packed['nbrs'],
+                    fdiff,
+                )
 
         except GMixRangeError:
             fdiff[:] = LOWVAL
 
         return fdiff
 
+    def _setup_packed_data(self):
+        """
+        copy the pixels, psf mixtures and neighbor lists for all stamps
+        into flat arrays, with a table of offsets for each stamp.  The
+        stamps are listed in the same order as in the fdiff array
+
+        The model mixtures filled during the fit are scratch space, so
+        the mixtures in the meta data of the observations are not
+        updated when using the packed data
+        """
+
+        nprior_per = self.n_prior_pars//self.nobj
+
+        nstamp = 0
+        nbr_size = 0
+        for mbo in self.list_of_obs:
+            for obslist in mbo:
+                for obs in obslist:
+                    nstamp += 1
+                    nbr_size += len(obs.meta['nbr_data'])
+
+        stamps = np.zeros(nstamp, dtype=PACKED_STAMP_DTYPE)
+        nbrs = np.zeros(nbr_size, dtype=PACKED_NBR_DTYPE)
+        prior_starts = np.zeros(self.nobj, dtype='i8')
+
+        pixels_list = []
+        psf_list = []
+
+        istamp = 0
+        fdiff_start = 0
+        pix_start = 0
+        psf_start = 0
+        nbr_start = 0
+        for iobj, mbo in enumerate(self.list_of_obs):
+            prior_starts[iobj] = fdiff_start
+            fdiff_start += nprior_per
+
+            for band, obslist in enumerate(mbo):
+                for obs in obslist:
+                    pixels = obs.pixels
+                    psf_data = obs.psf.gmix.get_data()
+                    nbr_data = obs.meta['nbr_data']
+
+                    stamp = stamps[istamp]
+                    stamp['index'] = iobj
+                    stamp['band'] = band
+                    stamp['fdiff_start'] = fdiff_start
+                    stamp['pix_start'] = pix_start
+                    stamp['pix_end'] = pix_start + pixels.size
+                    stamp['psf_start'] = psf_start
+                    stamp['psf_end'] = psf_start + psf_data.size
+                    stamp['nbr_start'] = nbr_start
+                    stamp['nbr_end'] = nbr_start + len(nbr_data)
+
+                    for nbr in nbr_data:
+                        nbrs['index'][nbr_start] = nbr['index']
+                        nbrs['v0'][nbr_start] = nbr['v0']
+                        nbrs['u0'][nbr_start] = nbr['u0']
+                        nbr_start += 1
+
+                    pixels_list.append(pixels)
+                    psf_list.append(psf_data)
+
+                    istamp += 1
+                    fdiff_start += pixels.size
+                    pix_start += pixels.size
+                    psf_start += psf_data.size
+
+        psfs = np.concatenate(psf_list)
+        max_npsf = max([p.size for p in psf_list])
+
+        gm0 = self.list_of_obs[0][0][0].meta['gmix0']
+        gmix0 = gm0.get_data().copy()
+        gmix = np.zeros(gmix0.size*max_npsf, dtype=gmix0.dtype)
+
+        self._packed = {
+            'stamps': stamps,
+            'nbrs': nbrs,
+            'prior_starts': prior_starts,
+            'pixels': np.concatenate(pixels_list),
+            'psfs': psfs,
+            'gmix0': gmix0,
+            'gmix': gmix,
+            'band_pars': np.zeros(self.nband_pars_per),
+            'fill_func': gm0._fill_func,
+            'TdByTe': getattr(gm0, '_TdByTe', 1.0),
+        }
+
     def _fill_priors(self, pars, fdiff, start):
         """
         same prior for every object
@@ -942,180 +1275,871 @@ class MOFStamps(MOF):
 
         return start+nprior
 
-    def _update_model(self, pars, gm0, gm, psf_gmix,
-                      pixels, model_array, start):
-        gm0._fill(pars)
-        ngmix.gmix_nb.gmix_convolve_fill(
-            gm._data,
-            gm0._data,
-            psf_gmix._data,
-        )
+    def _get_workspace(self):
+        """
+        get the arrays that are filled for each evaluation of the fdiff
+        array, made on the first call and kept for the life of the fitter
+        """
+        workspace = getattr(self, '_workspace', None)
+        if workspace is None:
+            band_pars = self._make_band_pars_table()
+            workspace = {
+                'fdiff': np.zeros(self.fdiff_size),
+                'band_pars': band_pars,
+                'tpars': np.zeros(band_pars.shape[2]),
+                'gmix_cache': {
+                    'band_pars': band_pars,
+                    'data': {},
+                    'filled': set(),
+                },
+            }
+            self._workspace = workspace
 
-        ngmix.fitting_nb.update_model_array(
-            gm._data,
-            pixels,
-            model_array,
-            start,
-        )
+        return workspace
 
-    def make_image(self, index, band=0, obsnum=0, include_nbrs=False):
+    def _make_band_pars_table(self):
         """
-        make an image for the given band and observation number
+        array to hold the band pars for all objects and bands
         """
-        gm = self.get_convolved_gmix(index, band=band, obsnum=obsnum)
-        obs = self.list_of_obs[index][band][obsnum]
-        im = gm.make_image(obs.image.shape, jacobian=obs.jacobian)
+        return np.zeros((self.nobj, self.nband, self.nband_pars_per))
 
-        if include_nbrs:
-            pars = self.get_result()['pars']
-            for nbr in obs.meta['nbr_data']:
-                nbr_pars = self.get_object_band_pars(
-                    pars,
-                    nbr['index'],
-                    band,
-                )
-                # the current pars [v,u,..] are relative to
-                # fiducial position.  we need to add these to
-                # the fiducial for the rendering within
-                # the stamp of the central
-                nbr_pars[0] += nbr['v0']
-                nbr_pars[1] += nbr['u0']
-                ngm0 = self._make_model(nbr_pars)
-                ngm = ngm0.convolve(obs.psf.gmix)
-                nim = ngm.make_image(obs.image.shape, jacobian=obs.jacobian)
-                im += nim
+    def _get_band_pars_table(self, pars):
+        """
+        fill the band pars for all objects and bands in the workspace
+        and return the table, indexed by [object, band]
 
-        return im
+        The table is overwritten by the next call
+        """
+        table = self._get_workspace()['band_pars']
+        self._fill_band_pars_table(pars, table)
+        return table
 
-    def get_convolved_gmix(self, index, band=0, obsnum=0, pars=None):
+    def _fill_band_pars_table(self, pars, table):
         """
-        get the psf-convolved gmix for the specified object, band, obsnum
+        the same as calling get_object_band_pars for each object and band
         """
+        nbper = self.nband_pars_per
+        allpars = pars.reshape(self.nobj, self.npars_per)
 
-        gm0 = self.get_gmix(index, band=band, pars=pars)
+        table[:, :, :nbper-1] = allpars[:, np.newaxis, :nbper-1]
+        table[:, :, nbper-1] = allpars[:, nbper-1:]
 
-        obs = self.list_of_obs[index][band][obsnum]
-        psf_gmix = obs.psf.gmix
-        return gm0.convolve(psf_gmix)
+    def _get_gmix_cache(self, pars):
+        """
+        get the cache of psf convolved mixtures for the input parameters,
+        see _get_cached_gmix
 
-    def get_gmix(self, index, band=0, pars=None):
+        The arrays are kept between calls, but each mixture is remade
+        the first time it is used for a new set of parameters
         """
-        get the pre-psf gmix for the specified object, band, obsnum
+        gmix_cache = self._get_workspace()['gmix_cache']
+        self._get_band_pars_table(pars)
+        gmix_cache['filled'].clear()
+        return gmix_cache
+
+    def _fill_stamp_fdiff(self, pars, iobj, band, obs, fdiff, start,
+                          gmix_cache=None):
         """
-        if pars is None:
-            res = self.get_result()
-            pars = res['pars']
+        fill (model-data)/error for the pixels of a stamp, including
+        the light from neighbors
 
-        tpars = self.get_object_band_pars(
-            pars,
-            index,
-            band,
-        )
+        If gmix_cache is sent, the psf convolved mixtures are only made
+        once for each object, band and psf, see _get_cached_gmix.  The
+        cache is only valid for the parameters sent to _get_gmix_cache
+        """
 
-        gm0 = self._make_model(tpars)
-        return gm0
+        meta = obs.meta
 
-    def _init_gmix_all(self, pars):
-        """
-        input pars are in linear space
+        pixel_index = None
+        if self.trunc_nsigma is not None:
+            pixel_index = self._get_pixel_index(obs)
 
-        initialize the list of lists of gaussian mixtures
-        """
+        self._add_object_model(
+            pars, iobj, band, obs, 0.0, 0.0, fdiff, start,
+            pixel_index=pixel_index,
+            gmix_cache=gmix_cache,
+        )
 
-        for iobj, mbobs in enumerate(self.list_of_obs):
-            for band, obs_list in enumerate(mbobs):
-                band_pars = self.get_object_band_pars(pars, iobj, band)
-                for obs in obs_list:
-                    assert obs.has_psf_gmix(), "psfs must be set"
+        # now also do same for neighbors. We can re-use
+        # the gmixes
+        for nbr in meta['nbr_data']:
+            self._add_object_model(
+                pars, nbr['index'], band, obs, nbr['v0'], nbr['u0'],
+                fdiff, start,
+                pixel_index=pixel_index,
+                gmix_cache=gmix_cache,
+            )
 
-                    # make this make a single model not huge model
-                    gm0 = self._make_model(band_pars)
-                    psf_gmix = obs.psf.gmix
-                    gm = gm0.convolve(psf_gmix)
+        # convert model values to fdiff
+        ngmix.fitting_nb.finish_fdiff(
+            obs._pixels,
+            fdiff,
+            start,
+        )
 
-                    obs.meta['gmix0'] = gm0
-                    obs.meta['gmix'] = gm
+    def _add_object_model(self, pars, index, band, obs, v0, u0,
+                          model_array, start,
+                          pixel_index=None, gmix_cache=None):
+        """
+        add the model for an object to the array for the stamp, with the
+        center offset by v0, u0
+        """
+        meta = obs.meta
+        gm = meta['gmix']
 
-    def _init_gmix_all_old(self, pars):
+        if gmix_cache is None:
+            tpars = self.get_object_band_pars(
+                pars,
+                index,
+                band,
+            )
+            # the current pars [v,u,..] are relative to
+            # fiducial position.  we need to add these to
+            # the fiducial for the rendering within
+            # the stamp of the central object
+            tpars[0] += v0
+            tpars[1] += u0
+            self._update_model(tpars,
+                               meta['gmix0'], gm, obs.psf.gmix,
+                               obs.pixels, model_array, start,
+                               pixel_index=pixel_index)
+        else:
+            gdata = gm._data
+            gdata[:] = self._get_cached_gmix(
+                index, band, obs, gmix_cache,
+            )
+            # the norms do not depend on the center
+            gdata['row'] += v0
+            gdata['col'] += u0
+            self._add_gmix_model(gdata, obs.pixels, model_array, start,
+                                 pixel_index=pixel_index)
+
+    def _get_cached_gmix(self, index, band, obs, gmix_cache):
         """
-        input pars are in linear space
+        get the psf convolved mixture data for the object, at its
+        fiducial position, with norms set
 
-        initialize the list of lists of gaussian mixtures
+        The cache is keyed by the object, band and psf observation.  The
+        psf observation is held by the stamp for the life of the fitter,
+        so its id is unique; the gmix property returns a new copy for
+        each call, so its id can be reused
         """
+        psf_gmix = obs.psf.gmix
 
-        gmix0_lol = []
-        gmix_lol = []
-        for iobj, mbobs in enumerate(self.list_of_obs):
+        key = (index, band, id(obs.psf))
+        data = gmix_cache['data'].get(key)
 
-            gmix_all0 = MultiBandGMixList()
-            gmix_all = MultiBandGMixList()
+        if key not in gmix_cache['filled']:
+            gm0 = obs.meta['gmix0']
+            gm0._fill(gmix_cache['band_pars'][index, band])
 
-            for band, obs_list in enumerate(mbobs):
-                gmix_list0 = GMixList()
-                gmix_list = GMixList()
+            size = gm0._data.size*psf_gmix._data.size
+            if data is None or data.size != size:
+                data = np.zeros(size, dtype=gm0._data.dtype)
+                gmix_cache['data'][key] = data
 
-                band_pars = self.get_object_band_pars(pars, iobj, band)
+            ngmix.gmix_nb.gmix_convolve_fill(
+                data,
+                gm0._data,
+                psf_gmix._data,
+            )
+            ngmix.gmix_nb.gmix_set_norms(data)
 
-                for obs in obs_list:
-                    assert obs.has_psf_gmix(), "psfs must be set"
+            gmix_cache['filled'].add(key)
 
-                    # make this make a single model not huge model
-                    gm0 = self._make_model(band_pars)
-                    psf_gmix = obs.psf.gmix
-                    gm = gm0.convolve(psf_gmix)
+        return data
 
-                    gmix_list0.append(gm0)
-                    gmix_list.append(gm)
+    def _update_model(self, pars, gm0, gm, psf_gmix,
+                      pixels, model_array, start,
+                      pixel_index=None):
+        """
+        add the model to the array.  If pixel_index is sent, each
+        gaussian is only evaluated within trunc_nsigma of its center,
+        see _get_pixel_index
+        """
+        gm0._fill(pars)
+        ngmix.gmix_nb.gmix_convolve_fill(
+            gm._data,
+            gm0._data,
+            psf_gmix._data,
+        )
 
-                gmix_all0.append(gmix_list0)
-                gmix_all.append(gmix_list)
+        self._add_gmix_model(gm._data, pixels, model_array, start,
+                             pixel_index=pixel_index)
+
+    def _add_gmix_model(self, gdata, pixels, model_array, start,
+                        pixel_index=None):
+        """
+        add the model for the mixture data to the array
+        """
+        if pixel_index is not None:
+            update_model_array_trunc(
+                gdata,
+                pixels,
+                model_array,
+                start,
+                pixel_index['jinv'],
+                pixel_index['row_ptr'],
+                pixel_index['cols'],
+                pixel_index['order'],
+                self.trunc_nsigma,
+                False,
+            )
+        else:
+            ngmix.fitting_nb.update_model_array(
+                gdata,
+                pixels,
+                model_array,
+                start,
+            )
 
-            gmix0_lol.append(gmix_all0)
-            gmix_lol.append(gmix_all)
+    def _get_pixel_index(self, obs):
+        """
+        get an index of the pixels by image row and column, used to
+        find the pixels in a box; cached in the meta data
 
-        self.gmix0_lol = gmix0_lol
-        self.gmix_lol = gmix_lol
+        The index holds the pixels sorted by row then column, with the
+        position of each in the original pixel array, so the model
+        array keeps the pixel ordering
 
-    def _make_model(self, band_pars):
-        """
-        generate a gaussian mixture
+        returns
+        -------
+        index: dict
+            jinv: see _get_jinv
+            row_ptr: the sorted pixels in image row i are
+                row_ptr[i]:row_ptr[i+1]
+            cols: column of each sorted pixel
+            order: index into the pixel array of each sorted pixel
         """
+        meta = obs.meta
+        if 'pixel_index' in meta:
+            return meta['pixel_index']
 
-        if self.model_name == 'bdf':
-            return GMixBDF(pars=band_pars)
-        else:
-            return GMixModel(band_pars, self.model)
+        jacobian = obs.jacobian
+        pixels = obs.pixels
 
-    def _set_all_obs(self, list_of_obs):
+        jinv = self._get_jinv(jacobian)
 
-        lobs = []
-        for i, o in enumerate(list_of_obs):
-            mbo = get_mb_obs(o)
-            if i == 0:
-                self.nband = len(mbo)
-            else:
-                assert len(mbo) == self.nband,\
-                    "all obs must have same number of bands"
-            lobs.append(mbo)
+        rows, cols = jacobian.get_rowcol(pixels['v'], pixels['u'])
+        rows = np.rint(rows).astype('i8')
+        cols = np.rint(cols).astype('i8')
 
-        self.list_of_obs = lobs
+        order = np.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
 
-    def _setup_nbrs(self):
+        nrows = obs.image.shape[0]
+        row_ptr = np.searchsorted(rows, np.arange(nrows+1))
+
+        pixel_index = {
+            'jinv': jinv,
+            'row_ptr': row_ptr,
+            'cols': cols,
+            'order': order,
+        }
+        meta['pixel_index'] = pixel_index
+        return pixel_index
+
+    def _calc_jacobian(self, pars):
         """
-        determine which neighboring objects should be
-        rendered into each stamp
+        jacobian d(fdiff)/d(pars), with the same layout as the fdiff
+        array
+
+        The model derivatives are analytic. The prior derivatives are
+        calculated with finite differences, which is cheap because no
+        rendering is involved
+
+        If sparse_jacobian was set, a scipy sparse matrix is returned
+        """
+
+        if self.sparse_jacobian:
+            return self._calc_sparse_jacobian(pars)
+
+        jac = np.zeros((self.fdiff_size, self.npars))
+        start = 0
+
+        try:
+            for iobj, mbo in enumerate(self.list_of_obs):
+                pjac = self._get_prior_jacobian(pars, iobj)
+                if pjac is not None:
+                    beg = iobj*self.npars_per
+                    end = start + pjac.shape[0]
+                    jac[start:end, beg:beg+self.npars_per] = pjac
+                    start = end
+
+                for band, obslist in enumerate(mbo):
+                    for obs in obslist:
+                        self._fill_stamp_jacobian(
+                            pars, iobj, band, obs, jac, start,
+                        )
+                        start += obs.pixels.size
+
+        except GMixRangeError as err:
+            logger.info(str(err))
+            jac[:, :] = 0.0
+
+        return jac
+
+    def _calc_sparse_jacobian(self, pars):
+        """
+        jacobian as a sparse matrix
+
+        The pixels of a stamp only depend on the central object and
+        its neighbors, so the jacobian is assembled from dense blocks,
+        one for each stamp, holding only those columns.  When the
+        derivatives are not analytic, the finite differences only
+        re-render the stamp for each of its columns
+        """
+        from scipy.sparse import csr_matrix
+
+        rows = []
+        cols = []
+        vals = []
+
+        try:
+            for block in self._jac_blocks:
+                if block['obs'] is None:
+                    bjac = self._get_prior_jacobian(pars, block['iobj'])
+                elif self.analytic_jacobian:
+                    bjac = self._get_stamp_jacobian(pars, block)
+                else:
+                    bjac = self._get_stamp_jacobian_fdiff(pars, block)
+
+                w = np.where(bjac != 0.0)
+                rows.append(block['start'] + w[0])
+                cols.append(block['cols'][w[1]])
+                vals.append(bjac[w])
+
+        except GMixRangeError as err:
+            logger.info(str(err))
+            return csr_matrix((self.fdiff_size, self.npars))
+
+        return csr_matrix(
+            (
+                np.concatenate(vals),
+                (np.concatenate(rows), np.concatenate(cols)),
+            ),
+            shape=(self.fdiff_size, self.npars),
+        )
+
+    def _setup_jacobian_blocks(self):
+        """
+        record the rows and columns of the non-zero blocks of
+        the jacobian, based on the neighbor lists
+        """
+        nprior_per = self.n_prior_pars//self.nobj
+
+        blocks = []
+        start = 0
+        for iobj, mbo in enumerate(self.list_of_obs):
+            if nprior_per > 0:
+                beg = iobj*self.npars_per
+                blocks.append({
+                    'iobj': iobj,
+                    'band': None,
+                    'obs': None,
+                    'start': start,
+                    'cols': np.arange(beg, beg+self.npars_per),
+                })
+                start += nprior_per
+
+            for band, obslist in enumerate(mbo):
+                for obs in obslist:
+                    cols = [self._get_jacobian_cols(iobj, band)]
+                    for nbr in obs.meta['nbr_data']:
+                        cols.append(
+                            self._get_jacobian_cols(nbr['index'], band)
+                        )
+
+                    blocks.append({
+                        'iobj': iobj,
+                        'band': band,
+                        'obs': obs,
+                        'start': start,
+                        'cols': np.unique(np.concatenate(cols)),
+                    })
+                    start += obs.pixels.size
+
+        self._jac_blocks = blocks
+
+    def _get_prior_jacobian(self, pars, iobj):
+        """
+        get the block of the jacobian for the priors of the specified
+        object, using finite differences
+
+        returns None if there are no priors
+        """
+        nprior_per = self.n_prior_pars//self.nobj
+        if nprior_per == 0:
+            return None
+
+        objpars = self.get_object_pars(pars, iobj)
+
+        fdiff0 = np.zeros(nprior_per)
+        fdiff1 = np.zeros(nprior_per)
+        self._fill_priors(objpars, fdiff0, 0)
+
+        beg = iobj*self.npars_per
+
+        pjac = np.zeros((nprior_per, self.npars_per))
+        for ipar in range(self.npars_per):
+            tpars = objpars.copy()
+
+            step = self._get_fdiff_step(pars, beg+ipar)
+            tpars[ipar] += step
+
+            self._fill_priors(tpars, fdiff1, 0)
+            pjac[:, ipar] = (fdiff1 - fdiff0)/step
+
+        return pjac
+
+    def _get_stamp_jacobian(self, pars, block):
+        """
+        get the analytic jacobian block for a stamp
+        """
+        obs = block['obs']
+        bjac = np.zeros((obs.pixels.size, block['cols'].size))
+        self._fill_stamp_jacobian(
+            pars, block['iobj'], block['band'], obs, bjac, 0,
+            block_cols=block['cols'],
+        )
+        return bjac
+
+    def _get_stamp_jacobian_fdiff(self, pars, block):
+        """
+        get the jacobian block for a stamp using finite differences,
+        rendering only this stamp
+        """
+        iobj = block['iobj']
+        band = block['band']
+        obs = block['obs']
+        cols = block['cols']
+
+        npix = obs.pixels.size
+        bjac = np.zeros((npix, cols.size))
+
+        fdiff0 = np.zeros(npix)
+        fdiff1 = np.zeros(npix)
+        self._fill_stamp_fdiff(pars, iobj, band, obs, fdiff0, 0)
+
+        tpars = pars.copy()
+        for i, col in enumerate(cols):
+            step = self._get_fdiff_step(pars, col)
+            tpars[col] = pars[col] + step
+
+            fdiff1[:] = 0.0
+            self._fill_stamp_fdiff(tpars, iobj, band, obs, fdiff1, 0)
+            bjac[:, i] = (fdiff1 - fdiff0)/step
+
+            tpars[col] = pars[col]
+
+        return bjac
+
+    def _get_fdiff_step(self, pars, ipar):
+        """
+        step for finite differences, taken backwards
+        if the forward step would cross the upper bound
+        """
+        step = FDIFF_STEP*max(abs(pars[ipar]), 1.0)
+        if pars[ipar] + step > self._upper_bounds[ipar]:
+            step = -step
+        return step
+
+    def _fill_stamp_jacobian(self, pars, iobj, band, obs, jac, start,
+                             block_cols=None):
+        """
+        fill the jacobian for the pixels of a stamp, including the
+        derivatives with respect to the parameters of the neighbors
+
+        If block_cols is sent, jac is a block holding only those columns
+        """
+
+        tpars = self.get_object_band_pars(pars, iobj, band)
+        self._fill_model_jacobian(
+            tpars, iobj, band, obs, jac, start, block_cols=block_cols,
+        )
+
+        for nbr in obs.meta['nbr_data']:
+            tnbr_pars = self.get_object_band_pars(
+                pars,
+                nbr['index'],
+                band,
+            )
+            # see _fill_stamp_fdiff
+            tnbr_pars[0] += nbr['v0']
+            tnbr_pars[1] += nbr['u0']
+            self._fill_model_jacobian(
+                tnbr_pars, nbr['index'], band, obs, jac, start,
+                block_cols=block_cols,
+            )
+
+    def _fill_model_jacobian(self, band_pars, iobj, band, obs, jac, start,
+                             block_cols=None):
+        """
+        add the derivatives of a single model rendered in the stamp
+        """
+        meta = obs.meta
+        gm0 = meta['gmix0']
+        gm = meta['gmix']
+        psf_gmix = obs.psf.gmix
+
+        derivs = self._get_gmix_derivs(band_pars, gm0, gm, psf_gmix)
+        if 'pixel_norm' not in meta:
+            meta['pixel_norm'] = self._get_pixel_norm(obs)
+
+        cols = self._get_jacobian_cols(iobj, band)
+        if block_cols is not None:
+            cols = np.searchsorted(block_cols, cols)
+
+        fill_model_jacobian(
+            gm._data,
+            derivs,
+            meta['pixel_norm'],
+            obs.pixels,
+            jac,
+            start,
+            cols,
+        )
+
+    def _get_gmix_derivs(self, band_pars, gm0, gm, psf_gmix):
+        """
+        get derivatives of the psf convolved gaussians with respect to the
+        band parameters [v, u, g1, g2, T, (fracdev), flux]
+
+        The derivatives are stored in an array of shape
+        (nband_pars_per, ngauss, 6), the last axis holding the
+        derivatives of [p, row, col, irr, irc, icc]
+
+        The dependence of the mixture on flux, T and fracdev is linear, so
+        we get those from mixtures filled at reference values of those
+        parameters, which avoids any assumption about the internals of the
+        mixture. On exit gm holds the mixture at the input parameters
+        """
+
+        tpars = band_pars.copy()
+        tpars[-1] = 1.0
+
+        tpars[4] = 1.0
+        data1 = self._get_convolved_data(tpars, gm0, gm, psf_gmix)
+        tpars[4] = 2.0
+        data2 = self._get_convolved_data(tpars, gm0, gm, psf_gmix)
+
+        nbper = self.nband_pars_per
+        derivs = np.zeros((nbper, data1.size, 6))
+
+        # centers
+        derivs[0, :, 1] = 1.0
+        derivs[1, :, 2] = 1.0
+
+        # the moments are linear in T
+        dirr_dT = data2['irr'] - data1['irr']
+        dirc_dT = data2['irc'] - data1['irc']
+        dicc_dT = data2['icc'] - data1['icc']
+        derivs[4, :, 3] = dirr_dT
+        derivs[4, :, 4] = dirc_dT
+        derivs[4, :, 5] = dicc_dT
+
+        # irr = T_i/2 (1-e1), irc = T_i/2 e2, icc = T_i/2 (1+e1)
+        # with e = 2 g/(1+g^2)
+        T = band_pars[4]
+        g1, g2 = band_pars[2], band_pars[3]
+        fac = 1.0/(1.0 + g1**2 + g2**2)
+        de1_dg = [
+            2*fac - 4*g1*g1*fac**2,
+            -4*g1*g2*fac**2,
+        ]
+        de2_dg = [
+            -4*g1*g2*fac**2,
+            2*fac - 4*g2*g2*fac**2,
+        ]
+
+        Thalf = 0.5*T*(dirr_dT + dicc_dT)
+        for i in range(2):
+            derivs[2+i, :, 3] = -Thalf*de1_dg[i]
+            derivs[2+i, :, 4] = Thalf*de2_dg[i]
+            derivs[2+i, :, 5] = Thalf*de1_dg[i]
+
+        flux = band_pars[-1]
+        if self.model_name == 'bdf':
+            tpars[4] = band_pars[4]
+            tpars[5] = 0.0
+            data_exp = self._get_convolved_data(tpars, gm0, gm, psf_gmix)
+            tpars[5] = 1.0
+            data_dev = self._get_convolved_data(tpars, gm0, gm, psf_gmix)
+            derivs[5, :, 0] = flux*(data_dev['p'] - data_exp['p'])
+
+        # the flux
+        derivs[-1, :, 0] = data1['p']
+
+        # leave the mixture at the requested parameters
+        self._get_convolved_data(band_pars, gm0, gm, psf_gmix)
+
+        return derivs
+
+    def _get_convolved_data(self, pars, gm0, gm, psf_gmix):
+        """
+        fill the mixtures and get a copy of the convolved
+        gaussian data
+        """
+        gm0._fill(pars)
+        ngmix.gmix_nb.gmix_convolve_fill(
+            gm._data,
+            gm0._data,
+            psf_gmix._data,
+        )
+        return gm._data.copy()
+
+    def _get_jacobian_cols(self, iobj, band):
+        """
+        get the columns in the jacobian corresponding to
+        the band parameters of the object
+        """
+        nbper = self.nband_pars_per
+        beg = iobj*self.npars_per
+
+        cols = np.arange(beg, beg+nbper)
+        cols[-1] += band
+        return cols
+
+    def _get_pixel_norm(self, obs):
+        """
+        get the ratio of the model value ngmix assigns to a pixel at the
+        center of a gaussian to the peak p/(2 pi sqrt(det)), which
+        accounts for any factors such as pixel area applied when rendering
+        """
+        pixels = obs.pixels[0:1]
+
+        gdata = obs.meta['gmix']._data[0:1].copy()
+        gdata['p'] = 1.0
+        gdata['row'] = pixels['v'][0]
+        gdata['col'] = pixels['u'][0]
+        gdata['norm_set'] = 0
+        ngmix.gmix_nb.gmix_set_norms(gdata)
+
+        det = gdata['irr'][0]*gdata['icc'][0] - gdata['irc'][0]**2
+        peak = 1.0/(2.0*np.pi*np.sqrt(det))
+
+        val = np.zeros(1)
+        ngmix.fitting_nb.update_model_array(gdata, pixels, val, 0)
+
+        return val[0]/peak
+
+    def make_image(self, index, band=0, obsnum=0, include_nbrs=False):
+        """
+        make an image for the given band and observation number
+        """
+        gm = self.get_convolved_gmix(index, band=band, obsnum=obsnum)
+        obs = self.list_of_obs[index][band][obsnum]
+        im = gm.make_image(obs.image.shape, jacobian=obs.jacobian)
+
+        if include_nbrs:
+            pars = self.get_result()['pars']
+            for nbr in obs.meta['nbr_data']:
+                nbr_pars = self.get_object_band_pars(
+                    pars,
+                    nbr['index'],
+                    band,
+                )
+                # the current pars [v,u,..] are relative to
+                # fiducial position.  we need to add these to
+                # the fiducial for the rendering within
+                # the stamp of the central
+                nbr_pars[0] += nbr['v0']
+                nbr_pars[1] += nbr['u0']
+                ngm0 = self._make_model(nbr_pars)
+                ngm = ngm0.convolve(obs.psf.gmix)
+                nim = ngm.make_image(obs.image.shape, jacobian=obs.jacobian)
+                im += nim
+
+        return im
+
+    def get_convolved_gmix(self, index, band=0, obsnum=0, pars=None):
+        """
+        get the psf-convolved gmix for the specified object, band, obsnum
+        """
+
+        gm0 = self.get_gmix(index, band=band, pars=pars)
+
+        obs = self.list_of_obs[index][band][obsnum]
+        psf_gmix = obs.psf.gmix
+        return gm0.convolve(psf_gmix)
+
+    def get_gmix(self, index, band=0, pars=None):
+        """
+        get the pre-psf gmix for the specified object, band, obsnum
+        """
+        if pars is None:
+            res = self.get_result()
+            pars = res['pars']
+
+        tpars = self.get_object_band_pars(
+            pars,
+            index,
+            band,
+        )
+
+        gm0 = self._make_model(tpars)
+        return gm0
+
+    def _init_gmix_all(self, pars):
+        """
+        input pars are in linear space
+
+        initialize the list of lists of gaussian mixtures
+        """
+
+        for iobj, mbobs in enumerate(self.list_of_obs):
+            for band, obs_list in enumerate(mbobs):
+                band_pars = self.get_object_band_pars(pars, iobj, band)
+                for obs in obs_list:
+                    assert obs.has_psf_gmix(), "psfs must be set"
+
+                    # make this make a single model not huge model
+                    gm0 = self._make_model(band_pars)
+                    psf_gmix = obs.psf.gmix
+                    gm = gm0.convolve(psf_gmix)
+
+                    obs.meta['gmix0'] = gm0
+                    obs.meta['gmix'] = gm
+
+    def _init_gmix_all_old(self, pars):
+        """
+        input pars are in linear space
+
+        initialize the list of lists of gaussian mixtures
+        """
+
+        gmix0_lol = []
+        gmix_lol = []
+        for iobj, mbobs in enumerate(self.list_of_obs):
+
+            gmix_all0 = MultiBandGMixList()
+            gmix_all = MultiBandGMixList()
+
+            for band, obs_list in enumerate(mbobs):
+                gmix_list0 = GMixList()
+                gmix_list = GMixList()
+
+                band_pars = self.get_object_band_pars(pars, iobj, band)
+
+                for obs in obs_list:
+                    assert obs.has_psf_gmix(), "psfs must be set"
+
+                    # make this make a single model not huge model
+                    gm0 = self._make_model(band_pars)
+                    psf_gmix = obs.psf.gmix
+                    gm = gm0.convolve(psf_gmix)
+
+                    gmix_list0.append(gm0)
+                    gmix_list.append(gm)
+
+                gmix_all0.append(gmix_list0)
+                gmix_all.append(gmix_list)
+
+            gmix0_lol.append(gmix_all0)
+            gmix_lol.append(gmix_all)
+
+        self.gmix0_lol = gmix0_lol
+        self.gmix_lol = gmix_lol
+
+    def _make_model(self, band_pars):
+        """
+        generate a gaussian mixture
+        """
+
+        if self.model_name == 'bdf':
+            return GMixBDF(pars=band_pars)
+        else:
+            return GMixModel(band_pars, self.model)
+
+    def _set_all_obs(self, list_of_obs):
+
+        lobs = []
+        for i, o in enumerate(list_of_obs):
+            mbo = get_mb_obs(o)
+            if i == 0:
+                self.nband = len(mbo)
+            else:
+                assert len(mbo) == self.nband,\
+                    "all obs must have same number of bands"
+            lobs.append(mbo)
+
+        self.list_of_obs = lobs
+
+    def _setup_nbrs(self):
+        """
+        determine which neighboring objects should be
+        rendered into each stamp
         """
         for iobj, mbo in enumerate(self.list_of_obs):
             for band in range(self.nband):
                 band_obslist = mbo[band]
 
-                for icut, obs in enumerate(band_obslist):
-                    nbr_data = self._get_nbr_data(obs, iobj, band)
-                    obs.meta['nbr_data'] = nbr_data
+                for icut, obs in enumerate(band_obslist):
+                    nbr_data = self._get_nbr_data(obs, iobj, band)
+                    obs.meta['all_nbr_data'] = nbr_data
+                    obs.meta['nbr_data'] = nbr_data
+
+    def _cull_nbrs(self, pars):
+        """
+        keep only the neighbors for which the peak contribution to
+        the stamp is above nbr_cull_thresh times the noise
+        """
+        ntot = 0
+        nkeep = 0
+        for iobj, mbo in enumerate(self.list_of_obs):
+            for band, obslist in enumerate(mbo):
+                for obs in obslist:
+                    all_nbr_data = obs.meta['all_nbr_data']
+
+                    nbr_data = []
+                    for nbr in all_nbr_data:
+                        s2n = self._get_nbr_peak_s2n(pars, nbr, band, obs)
+                        if s2n > self.nbr_cull_thresh:
+                            nbr_data.append(nbr)
+
+                    obs.meta['nbr_data'] = nbr_data
+
+                    ntot += len(all_nbr_data)
+                    nkeep += len(nbr_data)
+
+        logger.debug('kept %d/%d neighbors' % (nkeep, ntot))
+
+    def _get_nbr_peak_s2n(self, pars, nbr, band, obs):
+        """
+        estimate the peak contribution of the neighbor to the stamp in
+        units of the noise, using the pixel nearest the center of the
+        neighbor and the lowest noise in the stamp
+        """
+        meta = obs.meta
+        pixels = obs.pixels
+
+        tpars = self.get_object_band_pars(pars, nbr['index'], band)
+        tpars[0] += nbr['v0']
+        tpars[1] += nbr['u0']
+
+        dist2 = (pixels['v'] - tpars[0])**2 + (pixels['u'] - tpars[1])**2
+        imin = dist2.argmin()
+
+        pixel = pixels[imin:imin+1].copy()
+        pixel['ierr'] = pixels['ierr'].max()
+
+        val = np.zeros(1)
+        try:
+            self._update_model(tpars,
+                               meta['gmix0'], meta['gmix'], obs.psf.gmix,
+                               pixel, val, 0)
+        except GMixRangeError as err:
+            # can't tell, so keep it
+            logger.debug(str(err))
+            return np.inf
+
+        return abs(val[0])*pixel['ierr'][0]
 
     def _get_nbr_data(self, obs, iobj, band):
         """
-        TODO trim list to those that we expect to contribute flux
+        get all neighbors from the same image.  The list may be culled
+        later to those expected to contribute flux, see _cull_nbrs
         """
 
         jacobian = obs.jacobian
@@ -1132,8 +2156,6 @@ class MOFStamps(MOF):
             nbr_band_obslist = nbr_mbo[band]
             for nbr_obs in nbr_band_obslist:
                 # only keep the ones in the same image
-                # will want to trim later to ones expected to contribute
-                # flux
                 nbr_meta = nbr_obs.meta
                 if nbr_meta['file_id'] == file_id:
                     # row,col within the postage stamp of the central object
@@ -1153,7 +2175,12 @@ class MOFStamps(MOF):
 
 
 class MOFFlux(MOFStamps):
-    def __init__(self, list_of_obs, model, pars, flags=None):
+    def __init__(self, list_of_obs, model, pars, flags=None,
+                 trunc_nsigma=None):
+        """
+        Send trunc_nsigma to only evaluate each gaussian at pixels
+        within a box of that many sigma around its center
+        """
         self._set_all_obs(list_of_obs)
         self._setup_nbrs()
         self.model = model
@@ -1181,6 +2208,8 @@ class MOFFlux(MOFStamps):
 
         self.npars = self.nobj*self.npars_per
 
+        self.trunc_nsigma = trunc_nsigma
+
         self._set_input_pars(pars, flags)
 
     def get_gmix(self, index, band=0, pars=None):
@@ -1256,8 +2285,10 @@ class MOFFlux(MOFStamps):
             try:
                 band_res = self._get_lin_flux_band(band)
 
-                flux[:, band] = band_res['flux']
-                flux_err[:, band] = band_res['flux_err']
+                w, = np.where(band_res['flags'] == 0)
+                flux[w, band] = band_res['flux'][w]
+                flux_err[w, band] = band_res['flux_err'][w]
+                flags[:, band] = band_res['flags']
 
             except GMixRangeError as err:
                 logger.info(str(err))
@@ -1274,116 +2305,99 @@ class MOFFlux(MOFStamps):
         }
 
     def _get_lin_flux_band(self, band):
+        """
+        get the fluxes for all objects in the band using linear least
+        squares, see get_lin_fluxes
+        """
+        return get_lin_fluxes(self._get_band_stamp_data(band), self.nobj)
 
-        rim = np.zeros(self.totpix[band])
-
-        flux = np.zeros(self.nobj)
-        flux_err = np.zeros(self.nobj)
-
-        for ipass in range(2):
-            start = 0
-            starts = np.zeros(self.nobj, dtype='i4')
-            model_data = np.zeros((self.totpix[band], self.nobj))
-
-            for iobj, mbo in enumerate(self.list_of_obs):
-
-                obslist = mbo[band]
-                for obs in obslist:
-
-                    meta = obs.meta
-                    pixels = obs.pixels
-
-                    rim[start:start+pixels.size] = pixels['val']*pixels['ierr']
-                    start += pixels.size
-
-                    gm0 = meta['gmix0']
-                    gm = meta['gmix']
-                    psf_gmix = obs.psf.gmix
-
-                    tpars = self.get_object_band_pars(
-                        self._input_pars,
-                        iobj,
-                        band,
-                    )
-
-                    # templates always have flux 1
-                    if ipass == 0:
-                        tpars[-1] = 1.0
-                    else:
-                        tpars[-1] = flux[iobj]
+    def _get_band_stamp_data(self, band):
+        """
+        yield the object indices, weighted templates and weighted image
+        for each stamp in the band, as needed by get_lin_fluxes
+        """
+        for iobj, mbo in enumerate(self.list_of_obs):
+            for obs in mbo[band]:
+                pixels = obs.pixels
+                indices, templates = self._get_stamp_templates(
+                    iobj, band, obs,
+                )
+                yield indices, templates, pixels['val']*pixels['ierr']
 
-                    self._set_weighted_model(
-                        tpars,
-                        gm0, gm, psf_gmix,
-                        pixels,
-                        model_data[:, iobj],
-                        starts[iobj],
-                    )
-                    starts[iobj] += pixels.size
-
-                    # now also do same for neighbors. We can re-use
-                    # the gmixes
-                    for nbr in meta['nbr_data']:
-                        tnbr_pars = self.get_object_band_pars(
-                            self._input_pars,
-                            nbr['index'],
-                            band,
-                        )
-                        if ipass == 0:
-                            tnbr_pars[-1] = 1.0
-                        else:
-                            tnbr_pars[-1] = flux[nbr['index']]
-
-                        # the current pars [v,u,..] are relative to
-                        # fiducial position.  we need to add these to
-                        # the fiducial for the rendering within
-                        # the stamp of the central
-                        tnbr_pars[0] += nbr['v0']
-                        tnbr_pars[1] += nbr['u0']
-                        self._set_weighted_model(
-                            tnbr_pars,
-                            gm0, gm, psf_gmix,
-                            pixels,
-                            model_data[:, nbr['index']],
-                            starts[nbr['index']],
-                        )
-                        starts[nbr['index']] += pixels.size
+    def _get_stamp_templates(self, iobj, band, obs):
+        """
+        get the weighted unit flux templates for the central object and
+        its neighbors in the stamp
 
-            if ipass == 0:
-                flux[:], resid, rank, s = np.linalg.lstsq(
-                    model_data,
-                    rim,
-                    rcond=None,
-                )
-                model_data_nonorm = model_data
-            else:
+        returns
+        -------
+        indices, templates
+            The object indices and the templates, shape
+            (len(indices), npix)
+        """
+        meta = obs.meta
+        pixels = obs.pixels
 
-                # this version gives the same error for 1 or N objects,
-                # whereas the true error increases somewhat with N
-                for i in range(self.nobj):
+        gm0 = meta['gmix0']
+        gm = meta['gmix']
+        psf_gmix = obs.psf.gmix
 
-                    imodel = model_data[:, iobj]
-                    imodel_nonorm = model_data_nonorm[:, iobj]
-                    msq_sum = (imodel_nonorm**2).sum()
+        pixel_index = None
+        if self.trunc_nsigma is not None:
+            pixel_index = self._get_pixel_index(obs)
 
-                    subim = rim.copy()
-                    for j in range(self.nobj):
-                        if j != i:
-                            subim -= model_data[:, j]
+        nbr_data = meta['nbr_data']
+        indices = np.zeros(1+len(nbr_data), dtype='i8')
+        templates = np.zeros((indices.size, pixels.size))
 
-                    tchi2 = ((subim-imodel)**2).sum()
+        indices[0] = iobj
+        tpars = self.get_object_band_pars(
+            self._input_pars,
+            iobj,
+            band,
+        )
+        # templates always have flux 1
+        tpars[-1] = 1.0
+        self._set_weighted_model(
+            tpars,
+            gm0, gm, psf_gmix,
+            pixels,
+            templates[0],
+            0,
+            pixel_index=pixel_index,
+        )
 
-                    arg = tchi2/msq_sum/(rim.size-self.nobj)
-                    if arg > 0:
-                        flux_err[i] = np.sqrt(arg)
+        # now also do same for neighbors. We can re-use
+        # the gmixes
+        for inbr, nbr in enumerate(nbr_data):
+            indices[inbr+1] = nbr['index']
+            tnbr_pars = self.get_object_band_pars(
+                self._input_pars,
+                nbr['index'],
+                band,
+            )
+            tnbr_pars[-1] = 1.0
+
+            # the current pars [v,u,..] are relative to
+            # fiducial position.  we need to add these to
+            # the fiducial for the rendering within
+            # the stamp of the central
+            tnbr_pars[0] += nbr['v0']
+            tnbr_pars[1] += nbr['u0']
+            self._set_weighted_model(
+                tnbr_pars,
+                gm0, gm, psf_gmix,
+                pixels,
+                templates[inbr+1],
+                0,
+                pixel_index=pixel_index,
+            )
 
-        return {
-            'flux': flux,
-            'flux_err': flux_err,
-        }
+        return indices, templates
 
     def _set_weighted_model(self, pars, gm0, gm, psf_gmix,
-                            pixels, model_array, start):
+                            pixels, model_array, start,
+                            pixel_index=None):
 
         for i in range(2):
             gm0._fill(pars)
@@ -1394,12 +2408,27 @@ class MOFFlux(MOFStamps):
             )
 
             try:
-                set_weighted_model(
-                    gm._data,
-                    pixels,
-                    model_array,
-                    start,
-                )
+                if pixel_index is not None:
+                    model_array[start:start+pixels.size] = 0.0
+                    update_model_array_trunc(
+                        gm._data,
+                        pixels,
+                        model_array,
+                        start,
+                        pixel_index['jinv'],
+                        pixel_index['row_ptr'],
+                        pixel_index['cols'],
+                        pixel_index['order'],
+                        self.trunc_nsigma,
+                        True,
+                    )
+                else:
+                    set_weighted_model(
+                        gm._data,
+                        pixels,
+                        model_array,
+                        start,
+                    )
                 break
             except GMixRangeError as err:
                 logger.info(str(err))
@@ -1556,6 +2585,14 @@ class MOFFluxOld(MOFStamps):
             # default in leastsq is 100*(self.npars+1)
             self.lm_pars['maxfev'] = 300*(self.npars+1)
 
+        # the jacobian, packed and culling code assume the full set
+        # of parameters
+        self.analytic_jacobian = False
+        self.sparse_jacobian = False
+        self.packed = False
+        self.nbr_cull_thresh = None
+        self.trunc_nsigma = None
+
     def get_object_band_flux(self, flux_pars, iobj, band):
         """
         get the input pars plus the flux
@@ -1585,6 +2622,22 @@ class MOFFluxOld(MOFStamps):
         pars[-1] = flux
         return pars
 
+    def _make_band_pars_table(self):
+        """
+        array to hold the band pars for all objects and bands
+        """
+        return np.zeros((self.nobj, self.nband, self.nband_pars_per_full))
+
+    def _fill_band_pars_table(self, pars, table):
+        """
+        the fixed pars come from the input, so fill object by object
+        """
+        for iobj in range(self.nobj):
+            for band in range(self.nband):
+                table[iobj, band] = self.get_object_band_pars(
+                    pars, iobj, band,
+                )
+
     def _fill_priors(self, pars, fdiff, start):
         """
         no priors for this fitter
@@ -1701,45 +2754,35 @@ class GMixModelMulti(GMix):
         Fill in the gaussian mixture with new parameters, without
         error checking
 
+        The mixtures for all objects are filled in a single numba call
+
         parameters
         ----------
         pars: ndarray or sequence
             The parameters
         """
 
-        if self._model_name == 'bdf':
-            dobdf = True
-        else:
-            dobdf = False
-
         self._pars[:] = pars
 
-        gmall = self.get_data()
-
-        ng = self._ngauss_per
-        np = self._npars_per
-        for i in range(self._nobj):
-            beg = i*ng
-            end = (i+1)*ng
-
-            pbeg = i*np
-            pend = (i+1)*np
-
-            # should be a reference
-            gm = gmall[beg:end]
-            gpars = pars[pbeg:pend]
-
-            if dobdf:
-                self._fill_func(
-                    gm,
-                    gpars,
-                    self._TdByTe,
-                )
-            else:
-                self._fill_func(
-                    gm,
-                    gpars,
-                )
+        if self._model_name == 'bdf':
+            fill_gmix_multi_bdf(
+                self._fill_func,
+                self._TdByTe,
+                self.get_data(),
+                self._pars,
+                self._nobj,
+                self._ngauss_per,
+                self._npars_per,
+            )
+        else:
+            fill_gmix_multi(
+                self._fill_func,
+                self.get_data(),
+                self._pars,
+                self._nobj,
+                self._ngauss_per,
+                self._npars_per,
+            )
 
 
 def get_full_image_guesses(objects,
@@ -2037,6 +3080,113 @@ def get_mof_stamps_prior(list_of_obs, model, rng):
         )
 
 
+def get_lin_fluxes(stamp_data, nobj):
+    """
+    solve for the fluxes of a set of objects with linear least squares
+
+    The normal equations are accumulated from the weighted unit flux
+    templates in each stamp, which only involve the central object and
+    its neighbors.  The flux covariance is the inverse of the normal
+    matrix, scaled by the reduced chi squared of the fit
+
+    Objects with no light in any stamp, for example with fully masked
+    stamps, are flagged with LIN_ALG_ERROR and the system is solved for
+    the rest.  An ill conditioned system is solved with the
+    pseudo-inverse, see LIN_FLUX_MAX_COND
+
+    parameters
+    ----------
+    stamp_data: iterable
+        Yields (indices, templates, rim) for each stamp: the indices of
+        the objects drawn into the stamp, their weighted unit flux
+        templates with shape (len(indices), npix), and the weighted image
+        with shape (npix, )
+    nobj: int
+        The number of objects
+
+    returns
+    -------
+    result: dict
+        With entries flux, flux_cov, flux_err, flags and chi2.  The
+        flux and errors are zero for flagged objects
+    """
+
+    # normal matrix and right hand side, and sum of squares of the
+    # weighted data for the chi squared
+    amat = np.zeros((nobj, nobj))
+    bvec = np.zeros(nobj)
+    rsq = 0.0
+    npix = 0
+
+    for indices, templates, rim in stamp_data:
+        np.add.at(
+            amat,
+            np.ix_(indices, indices),
+            dot(templates, templates.T),
+        )
+        np.add.at(bvec, indices, dot(templates, rim))
+        rsq += dot(rim, rim)
+        npix += rim.size
+
+    flux = np.zeros(nobj)
+    flux_cov = np.zeros((nobj, nobj))
+    flux_err = np.zeros(nobj)
+    flags = np.zeros(nobj, dtype='i4')
+
+    diag = np.diag(amat)
+    good = diag > LIN_FLUX_MIN_DIAG*diag.max()
+    flags[~good] = procflags.LIN_ALG_ERROR
+
+    w, = np.where(good)
+    if w.size == 0:
+        chi2 = rsq
+    else:
+        cov = _get_lin_flux_cov(amat[np.ix_(w, w)])
+        flux[w] = dot(cov, bvec[w])
+
+        chi2 = (
+            rsq - 2*dot(flux[w], bvec[w])
+            + dot(flux[w], dot(amat[np.ix_(w, w)], flux[w]))
+        )
+        dof = npix - w.size
+
+        if dof > 0:
+            flux_cov[np.ix_(w, w)] = cov*chi2/dof
+
+            arg = np.diag(flux_cov)
+            wpos, = np.where(arg > 0)
+            flux_err[wpos] = np.sqrt(arg[wpos])
+
+    return {
+        'flux': flux,
+        'flux_cov': flux_cov,
+        'flux_err': flux_err,
+        'flags': flags,
+        'chi2': chi2,
+    }
+
+
+def _get_lin_flux_cov(amat):
+    """
+    invert the normal matrix for the linear flux solve.  The matrix is
+    scaled to unit diagonal, and the pseudo-inverse is used if it is
+    singular or ill conditioned
+    """
+    norm = 1.0/np.sqrt(np.diag(amat))
+    nmat = amat*np.outer(norm, norm)
+
+    try:
+        if np.linalg.cond(nmat) > LIN_FLUX_MAX_COND:
+            raise np.linalg.LinAlgError('ill conditioned normal matrix')
+
+        ncov = np.linalg.solve(nmat, np.identity(nmat.shape[0]))
+    except np.linalg.LinAlgError as err:
+        logger.debug('using pseudo-inverse: %s' % str(err))
+        ncov = np.linalg.pinv(nmat, rcond=1.0/LIN_FLUX_MAX_COND)
+
+    return ncov*np.outer(norm, norm)
+
+
 @njit
 def set_weighted_model(gmix, pixels, arr, start):
     """
@@ -2061,3 +3211,484 @@ def set_weighted_model(gmix, pixels, arr, start):
 
         model_val = ngmix.gmix_nb.gmix_eval_pixel(gmix, pixel)
         arr[start+ipixel] = model_val*pixel['ierr']
+
+
+@njit
+def update_model_array_trunc(gmix, pixels, arr, start,
+                             jinv, row_ptr, cols, order,
+                             nsigma, weighted):
+    """
+    add the model to the array, evaluating each gaussian only at
+    pixels within a box of nsigma around its center
+
+    parameters
+    ----------
+    gmix: gaussian mixture
+        See gmix.py
+    pixels: array of pixel structs
+        u,v,val,ierr
+    arr: array
+        Array to fill
+    start: int
+        Position in arr of the first pixel
+    jinv, row_ptr, cols, order: arrays
+        Index of the pixels, see MOFStamps._get_pixel_index
+    nsigma: float
+        Size of the box in units of the sigma of each gaussian
+    weighted: bool
+        If True, multiply by the inverse error, using the same evaluation
+        as set_weighted_model.  Otherwise as update_model_array
+    """
+
+    if gmix['norm_set'][0] == 0:
+        ngmix.gmix_nb.gmix_set_norms(gmix)
+
+    nrows = row_ptr.size-1
+
+    for igauss in range(gmix.size):
+        gauss = gmix[igauss:igauss+1]
+
+        v = gauss['row'][0]
+        u = gauss['col'][0]
+        vext = nsigma*np.sqrt(gauss['irr'][0])
+        uext = nsigma*np.sqrt(gauss['icc'][0])
+
+        # box in the image containing the box in v, u
+        rowcen = jinv[0] + jinv[2]*v + jinv[3]*u
+        colcen = jinv[1] + jinv[4]*v + jinv[5]*u
+        rowext = abs(jinv[2])*vext + abs(jinv[3])*uext
+        colext = abs(jinv[4])*vext + abs(jinv[5])*uext
+
+        rowmin = max(int(np.floor(rowcen - rowext)), 0)
+        rowmax = min(int(np.ceil(rowcen + rowext)), nrows-1)
+        colmin = np.floor(colcen - colext)
+        colmax = np.ceil(colcen + colext)
+
+        for row in range(rowmin, rowmax+1):
+            beg = row_ptr[row]
+            end = row_ptr[row+1]
+            if beg == end:
+                continue
+
+            row_cols = cols[beg:end]
+            kbeg = beg + np.searchsorted(row_cols, colmin)
+            kend = beg + np.searchsorted(row_cols, colmax, side='right')
+
+            for k in range(kbeg, kend):
+                ipixel = order[k]
+                pixel = pixels[ipixel]
+
+                if weighted:
+                    model_val = ngmix.gmix_nb.gmix_eval_pixel(gauss, pixel)
+                    arr[start+ipixel] += model_val*pixel['ierr']
+                else:
+                    model_val = ngmix.gmix_nb.gmix_eval_pixel_fast(
+                        gauss,
+                        pixel,
+                    )
+                    arr[start+ipixel] += model_val
+
+
+@njit
+def fill_model_jacobian(gmix, derivs, pixel_norm, pixels, jac, start, cols):
+    """
+    add the derivatives of the model with respect to the parameters
+    into the jacobian, weighted by the inverse error of each pixel
+
+    parameters
+    ----------
+    gmix: gaussian mixture
+        The psf convolved mixture at the current parameters
+    derivs: array
+        Derivatives of the [p, row, col, irr, irc, icc] of each
+        gaussian with respect to the parameters, shape
+        (npars, ngauss, 6)
+    pixel_norm: float
+        Ratio of the rendered value to p/(2 pi sqrt(det)) at the center
+        of a gaussian
+    pixels: array of pixel structs
+        u,v,val,ierr
+    jac: array
+        The jacobian to fill, shape (fdiff_size, total npars)
+    start: int
+        The row in jac corresponding to the first pixel
+    cols: array
+        The columns in jac corresponding to the parameters
+    """
+
+    ngauss = gmix.size
+    npars = derivs.shape[0]
+    twopi = 2.0*np.pi
+
+    n_pixels = pixels.shape[0]
+    for ipixel in range(n_pixels):
+        pixel = pixels[ipixel]
+        ierr = pixel['ierr']
+        if ierr == 0.0:
+            continue
+
+        row = start + ipixel
+
+        for igauss in range(ngauss):
+            gauss = gmix[igauss]
+
+            irr = gauss['irr']
+            irc = gauss['irc']
+            icc = gauss['icc']
+            det = irr*icc - irc*irc
+            if det <= 0.0:
+                continue
+
+            vdiff = pixel['v'] - gauss['row']
+            udiff = pixel['u'] - gauss['col']
+
+            chi2 = (
+                icc*vdiff*vdiff + irr*udiff*udiff - 2.0*irc*vdiff*udiff
+            )/det
+
+            if chi2 > JAC_MAX_CHI2:
+                continue
+
+            # value for unit p, and the actual value
+            unit_val = pixel_norm*np.exp(-0.5*chi2)/(twopi*np.sqrt(det))
+            val = gauss['p']*unit_val
+
+            # derivatives of ln(val) with respect to the gaussian parameters
+            dln_row = (icc*vdiff - irc*udiff)/det
+            dln_col = (irr*udiff - irc*vdiff)/det
+            dln_irr = 0.5*(chi2*icc - icc - udiff*udiff)/det
+            dln_irc = (irc + vdiff*udiff - chi2*irc)/det
+            dln_icc = 0.5*(chi2*irr - irr - vdiff*vdiff)/det
+
+            for ipar in range(npars):
+                dval = (
+                    derivs[ipar, igauss, 0]*unit_val
+                    + val*(
+                        derivs[ipar, igauss, 1]*dln_row
+                        + derivs[ipar, igauss, 2]*dln_col
+                        + derivs[ipar, igauss, 3]*dln_irr
+                        + derivs[ipar, igauss, 4]*dln_irc
+                        + derivs[ipar, igauss, 5]*dln_icc
+                    )
+                )
+                jac[row, cols[ipar]] += dval*ierr
+
+
+@njit
+def fill_fdiff_packed(fill_func, pars, npars_per, band_pars,
+                      gmix0, gmix, stamps, pixels, psfs, nbrs, fdiff):
+    """
+    fill the fdiff array for all stamps, for the simple models
+
+    parameters
+    ----------
+    fill_func: numba function
+        Function to fill the mixture for the model, called as
+        fill_func(gmix0, band_pars)
+    pars: array
+        The full parameter array
+    npars_per: int
+        Number of parameters for each object
+    band_pars: array
+        Scratch space for the parameters in a single band
+    gmix0: gaussian mixture
+        Scratch space for the unconvolved mixture
+    gmix: gaussian mixture
+        Scratch space for the convolved mixture, big enough for the
+        largest psf
+    stamps: array
+        Table of offsets for each stamp, see PACKED_STAMP_DTYPE
+    pixels: array of pixel structs
+        Pixels for all stamps
+    psfs: array
+        The psf mixtures for all stamps
+    nbrs: array
+        Neighbor data for all stamps, see PACKED_NBR_DTYPE
+    fdiff: array
+        The array to fill
+    """
+
+    for istamp in range(stamps.size):
+        stamp = stamps[istamp]
+
+        stamp_pixels = pixels[stamp['pix_start']:stamp['pix_end']]
+        psf = psfs[stamp['psf_start']:stamp['psf_end']]
+        gm = gmix[0:gmix0.size*psf.size]
+        start = stamp['fdiff_start']
+
+        get_band_pars_packed(
+            pars, npars_per, stamp['index'], stamp['band'], band_pars,
+        )
+        fill_func(gmix0, band_pars)
+        add_model_packed(gmix0, gm, psf, stamp_pixels, fdiff, start)
+
+        for inbr in range(stamp['nbr_start'], stamp['nbr_end']):
+            nbr = nbrs[inbr]
+            get_band_pars_packed(
+                pars, npars_per, nbr['index'], stamp['band'], band_pars,
+            )
+            band_pars[0] += nbr['v0']
+            band_pars[1] += nbr['u0']
+
+            fill_func(gmix0, band_pars)
+            add_model_packed(gmix0, gm, psf, stamp_pixels, fdiff, start)
+
+        ngmix.fitting_nb.finish_fdiff(stamp_pixels, fdiff, start)
+
+
+@njit
+def fill_fdiff_packed_bdf(fill_func, TdByTe, pars, npars_per, band_pars,
+                          gmix0, gmix, stamps, pixels, psfs, nbrs, fdiff):
+    """
+    fill the fdiff array for all stamps, for the bdf model
+
+    The parameters are the same as for fill_fdiff_packed, with the
+    addition of TdByTe, the ratio of the sizes of the bulge and disk.
+    The fill function is called as fill_func(gmix0, band_pars, TdByTe)
+    """
+
+    for istamp in range(stamps.size):
+        stamp = stamps[istamp]
+
+        stamp_pixels = pixels[stamp['pix_start']:stamp['pix_end']]
+        psf = psfs[stamp['psf_start']:stamp['psf_end']]
+        gm = gmix[0:gmix0.size*psf.size]
+        start = stamp['fdiff_start']
+
+        get_band_pars_packed(
+            pars, npars_per, stamp['index'], stamp['band'], band_pars,
+        )
+        fill_func(gmix0, band_pars, TdByTe)
+        add_model_packed(gmix0, gm, psf, stamp_pixels, fdiff, start)
+
+        for inbr in range(stamp['nbr_start'], stamp['nbr_end']):
+            nbr = nbrs[inbr]
+            get_band_pars_packed(
+                pars, npars_per, nbr['index'], stamp['band'], band_pars,
+            )
+            band_pars[0] += nbr['v0']
+            band_pars[1] += nbr['u0']
+
+            fill_func(gmix0, band_pars, TdByTe)
+            add_model_packed(gmix0, gm, psf, stamp_pixels, fdiff, start)
+
+        ngmix.fitting_nb.finish_fdiff(stamp_pixels, fdiff, start)
+
+
+@njit
+def get_band_pars_packed(pars, npars_per, iobj, band, band_pars):
+    """
+    copy the parameters for the object and band into band_pars;
+    the same as MOFStamps.get_object_band_pars
+    """
+    nbper = band_pars.size
+    beg = iobj*npars_per
+
+    for i in range(nbper-1):
+        band_pars[i] = pars[beg+i]
+
+    band_pars[nbper-1] = pars[beg+nbper-1+band]
+
+
+@njit
+def add_model_packed(gmix0, gmix, psf, pixels, fdiff, start):
+    """
+    convolve the mixture with the psf and add the model
+    to the fdiff array
+    """
+    ngmix.gmix_nb.gmix_convolve_fill(gmix, gmix0, psf)
+    ngmix.fitting_nb.update_model_array(gmix, pixels, fdiff, start)
+
+
+@njit
+def fill_gmix_multi(fill_func, gmix, pars, nobj, ngauss_per, npars_per):
+    """
+    fill the mixtures for multiple objects, for the simple models
+
+    parameters
+    ----------
+    fill_func: numba function
+        Function to fill the mixture for the model, called as
+        fill_func(gmix, pars) for each object
+    gmix: gaussian mixture
+        The mixture for all objects, with ngauss_per gaussians
+        for each object
+    pars: array
+        The parameters for all objects, with npars_per parameters
+        for each object
+    nobj: int
+        Number of objects
+    ngauss_per: int
+        Number of gaussians for each object
+    npars_per: int
+        Number of parameters for each object
+    """
+    for i in range(nobj):
+        gm = gmix[i*ngauss_per:(i+1)*ngauss_per]
+        gpars = pars[i*npars_per:(i+1)*npars_per]
+        fill_func(gm, gpars)
+
+
+@njit
+def fill_gmix_multi_bdf(fill_func, TdByTe, gmix, pars,
+                        nobj, ngauss_per, npars_per):
+    """
+    fill the mixtures for multiple objects, for the bdf model
+
+    The parameters are the same as for fill_gmix_multi, with the
+    addition of TdByTe, the ratio of the sizes of the bulge and disk.
+    The fill function is called as fill_func(gmix, pars, TdByTe)
+    """
+    for i in range(nobj):
+        gm = gmix[i*ngauss_per:(i+1)*ngauss_per]
+        gpars = pars[i*npars_per:(i+1)*npars_per]
+        fill_func(gm, gpars, TdByTe)
+
+
+def _fill_fdiff_tiled(gmix, pixels, fdiff, start,
+                      jinv, dims, tile_size, tile_ptr, order, nsigma):
+    """
+    fill (model-data)/error for the pixels of an image, rendering the
+    image in tiles and only evaluating the gaussians that overlap each
+    tile
+
+    Compiled as fill_fdiff_tiled and fill_fdiff_tiled_parallel; the
+    latter renders the tiles in parallel
+
+    parameters
+    ----------
+    gmix: gaussian mixture
+        See gmix.py
+    pixels: array of pixel structs
+        u,v,val,ierr
+    fdiff: array
+        Array to fill
+    start: int
+        Position in fdiff of the first pixel
+    jinv: array
+        Inverse of the jacobian, see MOF._get_jinv
+    dims: array
+        Dimensions of the image
+    tile_size: int
+        Size of the tiles in pixels
+    tile_ptr, order: arrays
+        Index of the pixels in each tile, see MOF._get_tile_index
+    nsigma: float
+        Gaussians are evaluated in the tiles overlapping a box of this
+        many sigma around their center
+    """
+
+    if gmix['norm_set'][0] == 0:
+        ngmix.gmix_nb.gmix_set_norms(gmix)
+
+    gauss_ptr, gauss_index = get_tile_gaussians(
+        gmix, jinv, dims, tile_size, nsigma,
+    )
+
+    ntile = tile_ptr.size-1
+    for itile in prange(ntile):
+        fill_fdiff_tile(
+            gmix,
+            pixels,
+            fdiff,
+            start,
+            order[tile_ptr[itile]:tile_ptr[itile+1]],
+            gauss_index[gauss_ptr[itile]:gauss_ptr[itile+1]],
+        )
+
+
+fill_fdiff_tiled = njit(_fill_fdiff_tiled)
+fill_fdiff_tiled_parallel = njit(parallel=True)(_fill_fdiff_tiled)
+
+
+@njit
+def fill_fdiff_tile(gmix, pixels, fdiff, start, pixel_index, gauss_index):
+    """
+    fill (model-data)/error for the pixels of a tile, evaluating only
+    the indicated gaussians
+    """
+    tgmix = np.empty(gauss_index.size, dtype=gmix.dtype)
+    for i in range(gauss_index.size):
+        tgmix[i] = gmix[gauss_index[i]]
+
+    for i in range(pixel_index.size):
+        ipixel = pixel_index[i]
+        pixel = pixels[ipixel]
+
+        model_val = ngmix.gmix_nb.gmix_eval_pixel_fast(tgmix, pixel)
+        fdiff[start+ipixel] = (model_val-pixel['val'])*pixel['ierr']
+
+
+@njit
+def get_tile_gaussians(gmix, jinv, dims, tile_size, nsigma):
+    """
+    get the gaussians that overlap each tile of the image, where a
+    gaussian covers a box of nsigma around its center
+
+    returns
+    -------
+    gauss_ptr, gauss_index: arrays
+        The gaussians for tile i are
+        gauss_index[gauss_ptr[i]:gauss_ptr[i+1]], in increasing order
+    """
+    ntile_row = (dims[0] + tile_size - 1)//tile_size
+    ntile_col = (dims[1] + tile_size - 1)//tile_size
+    ntile = ntile_row*ntile_col
+
+    # range of tiles for each gaussian, empty if off the image
+    tile_ranges = np.zeros((gmix.size, 4), dtype=np.int64)
+    counts = np.zeros(ntile, dtype=np.int64)
+
+    for igauss in range(gmix.size):
+        gauss = gmix[igauss]
+
+        v = gauss['row']
+        u = gauss['col']
+        vext = nsigma*np.sqrt(gauss['irr'])
+        uext = nsigma*np.sqrt(gauss['icc'])
+
+        # box in the image containing the box in v, u
+        rowcen = jinv[0] + jinv[2]*v + jinv[3]*u
+        colcen = jinv[1] + jinv[4]*v + jinv[5]*u
+        rowext = abs(jinv[2])*vext + abs(jinv[3])*uext
+        colext = abs(jinv[4])*vext + abs(jinv[5])*uext
+
+        rowmin = max(np.floor(rowcen - rowext), 0.0)
+        rowmax = min(np.ceil(rowcen + rowext), dims[0]-1.0)
+        colmin = max(np.floor(colcen - colext), 0.0)
+        colmax = min(np.ceil(colcen + colext), dims[1]-1.0)
+
+        if rowmin > rowmax or colmin > colmax:
+            tile_ranges[igauss, 1] = -1
+            continue
+
+        trow_min = int(rowmin)//tile_size
+        trow_max = int(rowmax)//tile_size
+        tcol_min = int(colmin)//tile_size
+        tcol_max = int(colmax)//tile_size
+
+        tile_ranges[igauss, 0] = trow_min
+        tile_ranges[igauss, 1] = trow_max
+        tile_ranges[igauss, 2] = tcol_min
+        tile_ranges[igauss, 3] = tcol_max
+
+        for trow in range(trow_min, trow_max+1):
+            for tcol in range(tcol_min, tcol_max+1):
+                counts[trow*ntile_col + tcol] += 1
+
+    gauss_ptr = np.zeros(ntile+1, dtype=np.int64)
+    for itile in range(ntile):
+        gauss_ptr[itile+1] = gauss_ptr[itile] + counts[itile]
+
+    gauss_index = np.zeros(gauss_ptr[ntile], dtype=np.int64)
+    counts[:] = 0
+
+    for igauss in range(gmix.size):
+        for trow in range(tile_ranges[igauss, 0], tile_ranges[igauss, 1]+1):
+            for tcol in range(tile_ranges[igauss, 2],
+                              tile_ranges[igauss, 3]+1):
+                itile = trow*ntile_col + tcol
+                gauss_index[gauss_ptr[itile] + counts[itile]] = igauss
+                counts[itile] += 1
+
+    return gauss_ptr, gauss_index
@@ -1,4 +1,5 @@
-from numba import njit
+import numpy as np
+from numba import njit, prange
 
 
 @njit
@@ -62,3 +63,173 @@ def find_peaks(image, thresh, peakrows, peakcols):
                     peakcols[ipeak] = icol
 
     return npeaks
+
+
+# peaks found by find_peaks_parallel
+PEAK_DTYPE = [
+    ('row', 'f8'),
+    ('col', 'f8'),
+    ('row_peak', 'i4'),
+    ('col_peak', 'i4'),
+    ('height', 'f8'),
+]
+
+# number of image rows processed by each task in find_peaks_parallel
+DEFAULT_BLOCK_ROWS = 64
+
+
+def find_peaks_parallel(image, thresh, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    find peaks by looking for points around which all values are lower,
+    processing blocks of rows in parallel
+
+    The peaks are the same as found by find_peaks, but the positions are
+    refined to subpixel accuracy by fitting a parabola through the peak
+    and its neighbors along each axis
+
+    parameters
+    ----------
+    image: 2d array
+        An image in which to find peaks
+    thresh: float
+        Peaks must be higher than this value.  You would typically
+        set this to some multiple of the noise level.
+    block_rows: int, optional
+        Number of rows in each block, default DEFAULT_BLOCK_ROWS
+
+    returns
+    -------
+    peaks: array
+        Array with fields row, col (refined positions), row_peak,
+        col_peak (the peak pixel) and height (the image value at the
+        peak pixel), sorted by height, highest first
+    """
+    image = np.ascontiguousarray(image, dtype='f8')
+
+    nrows = image.shape[0]
+    nblocks = max(nrows - 2, 0)//block_rows + 1
+
+    counts = np.zeros(nblocks, dtype='i8')
+    _count_peaks(image, thresh, block_rows, counts)
+
+    offsets = np.zeros(nblocks, dtype='i8')
+    offsets[1:] = counts.cumsum()[:-1]
+    npeaks = counts.sum()
+
+    rows = np.zeros(npeaks, dtype='i4')
+    cols = np.zeros(npeaks, dtype='i4')
+    drows = np.zeros(npeaks)
+    dcols = np.zeros(npeaks)
+    heights = np.zeros(npeaks)
+    _fill_peaks(
+        image, thresh, block_rows, offsets,
+        rows, cols, drows, dcols, heights,
+    )
+
+    peaks = np.zeros(npeaks, dtype=PEAK_DTYPE)
+    peaks['row_peak'] = rows
+    peaks['col_peak'] = cols
+    peaks['row'] = rows + drows
+    peaks['col'] = cols + dcols
+    peaks['height'] = heights
+
+    s = (-heights).argsort(kind='mergesort')
+    return peaks[s]
+
+
+@njit
+def _is_peak(image, irow, icol, thresh):
+    """
+    check if the interior pixel is above the threshold and no
+    neighbor is higher
+    """
+    val = image[irow, icol]
+    if val <= thresh:
+        return False
+
+    for checkrow in range(irow-1, irow+2):
+        for checkcol in range(icol-1, icol+2):
+            if image[checkrow, checkcol] > val:
+                return False
+
+    return True
+
+
+@njit
+def _get_peak_offset(low, mid, high):
+    """
+    offset of the maximum of a parabola through three equally spaced
+    points, limited to half a pixel
+    """
+    denom = low - 2.0*mid + high
+    if denom >= 0.0:
+        return 0.0
+
+    offset = 0.5*(low - high)/denom
+    if offset > 0.5:
+        offset = 0.5
+    elif offset < -0.5:
+        offset = -0.5
+
+    return offset
+
+
+@njit(parallel=True)
+def _count_peaks(image, thresh, block_rows, counts):
+    """
+    count the peaks in each block of interior rows
+    """
+    nrows, ncols = image.shape
+
+    for iblock in prange(counts.size):
+        rowstart = 1 + iblock*block_rows
+        rowend = min(rowstart + block_rows, nrows-1)
+
+        n = 0
+        for irow in range(rowstart, rowend):
+            for icol in range(1, ncols-1):
+                if _is_peak(image, irow, icol, thresh):
+                    n += 1
+
+        counts[iblock] = n
+
+
+@njit(parallel=True)
+def _fill_peaks(image,
+                thresh,
+                block_rows,
+                offsets,
+                rows,
+                cols,
+                drows,
+                dcols,
+                heights):
+    """
+    fill the peaks for each block of interior rows, starting at the
+    offset for that block
+    """
+    nrows, ncols = image.shape
+
+    for iblock in prange(offsets.size):
+        rowstart = 1 + iblock*block_rows
+        rowend = min(rowstart + block_rows, nrows-1)
+
+        ipeak = offsets[iblock]
+        for irow in range(rowstart, rowend):
+            for icol in range(1, ncols-1):
+                if not _is_peak(image, irow, icol, thresh):
+                    continue
+
+                val = image[irow, icol]
+
+                rows[ipeak] = irow
+                cols[ipeak] = icol
+                drows[ipeak] = _get_peak_offset(
+                    image[irow-1, icol], val, image[irow+1, icol],
+                )
+                dcols[ipeak] = _get_peak_offset(
+                    image[irow, icol-1], val, image[irow, icol+1],
+                )
+                heights[ipeak] = val
+
+                ipeak += 1
@@ -14,6 +14,7 @@ class PriorSimpleSepMulti(object):
 
         self.nobj = len(cen_priors)
         self.cen_priors = cen_priors
+        self._cen_arrays = _get_cen_arrays(cen_priors)
         self.g_prior = g_prior
         self.T_prior = T_prior
 
@@ -29,44 +30,34 @@ class PriorSimpleSepMulti(object):
     def fill_fdiff(self, allpars, fdiff, **keys):
         """
         set sqrt(-2ln(p)) ~ (model-data)/err
-        """
-        index = 0
-
-        fstart = 0
-        for i in range(self.nobj):
-
-            fstart = index
-
-            beg = i*self.npars_per
-            end = (i+1)*self.npars_per
 
-            pars = allpars[beg:end]
-
-            cen_prior = self.cen_priors[i]
+        All objects are done at once, with the residuals for each object
+        in consecutive elements of fdiff
+        """
+        nprior_per = 4 + self.nband
+        index = self.nobj*nprior_per
 
-            lnp1, lnp2 = cen_prior.get_lnprob_scalar_sep(pars[0], pars[1])
+        lnp = fdiff[:index].reshape(self.nobj, nprior_per)
+        self._fill_lnprob_table(allpars, lnp, **keys)
 
-            fdiff[index] = lnp1
-            index += 1
-            fdiff[index] = lnp2
-            index += 1
+        _lnprob_to_fdiff(lnp)
 
-            fdiff[index] = self.g_prior.get_lnprob_scalar2d(pars[2], pars[3])
-            index += 1
+        return index
 
-            fdiff[index] = self.T_prior.get_lnprob_scalar(pars[4], **keys)
-            index += 1
+    def _fill_lnprob_table(self, allpars, lnp, **keys):
+        """
+        fill the log probability for each object and parameter, shape
+        (nobj, 4+nband)
+        """
+        pars = allpars.reshape(self.nobj, self.npars_per)
 
-            for j in range(self.nband):
-                F_prior = self.F_priors[j]
-                fdiff[index] = F_prior.get_lnprob_scalar(pars[5+j])
-                index += 1
+        _fill_cen_lnprob(self.cen_priors, self._cen_arrays, pars, lnp)
 
-            chi2 = -2*fdiff[fstart:index].copy()
-            chi2.clip(min=0.0, max=None, out=chi2)
-            fdiff[fstart:index] = np.sqrt(chi2)
+        lnp[:, 2] = _get_lnprob_array2d(self.g_prior, pars[:, 2], pars[:, 3])
+        lnp[:, 3] = _get_lnprob_array(self.T_prior, pars[:, 4], **keys)
 
-        return index
+        for j in range(self.nband):
+            lnp[:, 4+j] = _get_lnprob_array(self.F_priors[j], pars[:, 5+j])
 
     def get_prob_scalar(self, pars, **keys):
         """
@@ -82,27 +73,46 @@ class PriorSimpleSepMulti(object):
         log probability for scalar input (meaning one point)
         """
 
-        lnp = 0.0
-        for i in range(self.nobj):
+        lnp = np.zeros((self.nobj, 4 + self.nband))
+        self._fill_lnprob_table(allpars, lnp, **keys)
 
-            beg = i*self.npars_per
-            end = (i+1)*self.npars_per
+        return lnp.sum()
 
-            pars = allpars[beg:end]
+    def sample(self, n=None):
+        """
+        Get random samples
 
-            cen_prior = self.cen_priors[i]
-            lnp += cen_prior.get_lnprob_scalar(pars[0], pars[1])
-            lnp += self.g_prior.get_lnprob_scalar2d(pars[2], pars[3])
-            lnp += self.T_prior.get_lnprob_scalar(pars[4], **keys)
+        parameters
+        ----------
+        n: int, optional
+            Number of samples.  If sent, the result has shape
+            (n, npars_per*nobj), and each parameter is drawn for all
+            samples and objects at once.  Otherwise a single sample is
+            returned with shape (npars_per*nobj, ), see _sample_one
+        """
 
-            for j, F_prior in enumerate(self.F_priors):
-                lnp += F_prior.get_lnprob_scalar(pars[5+j], **keys)
+        if n is None:
+            return self._sample_one()
+
+        samples, nrand = _get_samples_array(self.nobj, self.npars_per, n)
+
+        _sample_cen(self.cen_priors, samples, n)
+
+        g1, g2 = self.g_prior.sample2d(nrand)
+        _set_samples(samples, 2, g1)
+        _set_samples(samples, 3, g2)
+
+        _set_samples(samples, 4, self.T_prior.sample(nrand))
 
-        return lnp
+        for j, F_prior in enumerate(self.F_priors):
+            _set_samples(samples, 5+j, F_prior.sample(nrand))
 
-    def sample(self):
+        return _finish_samples(samples)
+
+    def _sample_one(self):
         """
-        Get random samples
+        get a single sample, drawing the parameters object by object so
+        the result for a given seed is the same as for earlier versions
         """
 
         samples = np.zeros(self.npars_per*self.nobj)
@@ -143,6 +153,7 @@ class PriorBDFSepMulti(object):
 
         self.nobj = len(cen_priors)
         self.cen_priors = cen_priors
+        self._cen_arrays = _get_cen_arrays(cen_priors)
         self.g_prior = g_prior
         self.T_prior = T_prior
         self.fracdev_prior = fracdev_prior
@@ -190,48 +201,43 @@ class PriorBDFSepMulti(object):
     def fill_fdiff(self, allpars, fdiff, **keys):
         """
         set sqrt(-2ln(p)) ~ (model-data)/err
-        """
-        index = 0
 
-        fstart = 0
-        for i in range(self.nobj):
-
-            fstart = index
+        All objects are done at once, with the residuals for each object
+        in consecutive elements of fdiff
+        """
+        nprior_per = 5 + self.nband
+        index = self.nobj*nprior_per
 
-            beg = i*self.npars_per
-            end = (i+1)*self.npars_per
+        lnp = fdiff[:index].reshape(self.nobj, nprior_per)
+        self._fill_lnprob_table(allpars, lnp, **keys)
 
-            pars = allpars[beg:end]
+        _lnprob_to_fdiff(lnp)
 
-            cen_prior = self.cen_priors[i]
-            lnp1, lnp2 = cen_prior.get_lnprob_scalar_sep(pars[0], pars[1])
+        return index
 
-            fdiff[index] = lnp1
-            index += 1
-            fdiff[index] = lnp2
-            index += 1
+    def _fill_lnprob_table(self, allpars, lnp, **keys):
+        """
+        fill the log probability for each object and parameter, shape
+        (nobj, 5+nband)
+        """
+        pars = allpars.reshape(self.nobj, self.npars_per)
 
-            fdiff[index] = self.g_prior.get_lnprob_scalar2d(pars[2], pars[3])
-            index += 1
-            fdiff[index] = self.T_prior.get_lnprob_scalar(pars[4], **keys)
-            index += 1
+        _fill_cen_lnprob(self.cen_priors, self._cen_arrays, pars, lnp)
 
-            fdiff[index] = self.fracdev_prior.get_lnprob_scalar(
-                pars[5],
+        lnp[:, 2] = _get_lnprob_array2d(self.g_prior, pars[:, 2], pars[:, 3])
+        lnp[:, 3] = _get_lnprob_array(self.T_prior, pars[:, 4], **keys)
+        lnp[:, 4] = _get_lnprob_array(
+            self.fracdev_prior,
+            pars[:, 5],
+            **keys
+        )
+
+        for j in range(self.nband):
+            lnp[:, 5+j] = _get_lnprob_array(
+                self.F_priors[j],
+                pars[:, 6+j],
                 **keys
             )
-            index += 1
-
-            for j in range(self.nband):
-                F_prior = self.F_priors[j]
-                fdiff[index] = F_prior.get_lnprob_scalar(pars[6+j], **keys)
-                index += 1
-
-            chi2 = -2*fdiff[fstart:index].copy()
-            chi2.clip(min=0.0, max=None, out=chi2)
-            fdiff[fstart:index] = np.sqrt(chi2)
-
-        return index
 
     def get_prob_scalar(self, pars, **keys):
         """
@@ -247,28 +253,48 @@ class PriorBDFSepMulti(object):
         log probability for scalar input (meaning one point)
         """
 
-        lnp = 0.0
-        for i in range(self.nobj):
+        lnp = np.zeros((self.nobj, 5 + self.nband))
+        self._fill_lnprob_table(allpars, lnp, **keys)
 
-            beg = i*self.npars_per
-            end = (i+1)*self.npars_per
+        return lnp.sum()
 
-            pars = allpars[beg:end]
+    def sample(self, n=None):
+        """
+        Get random samples
 
-            cen_prior = self.cen_priors[i]
-            lnp += cen_prior.get_lnprob_scalar(pars[0], pars[1])
-            lnp += self.g_prior.get_lnprob_scalar2d(pars[2], pars[3])
-            lnp += self.T_prior.get_lnprob_scalar(pars[4], **keys)
-            lnp += self.fracdev_prior.get_lnprob_scalar(pars[5], **keys)
+        parameters
+        ----------
+        n: int, optional
+            Number of samples.  If sent, the result has shape
+            (n, npars_per*nobj), and each parameter is drawn for all
+            samples and objects at once.  Otherwise a single sample is
+            returned with shape (npars_per*nobj, ), see _sample_one
+        """
 
-            for j, F_prior in enumerate(self.F_priors):
-                lnp += F_prior.get_lnprob_scalar(pars[6+j], **keys)
+        if n is None:
+            return self._sample_one()
 
-        return lnp
+        samples, nrand = _get_samples_array(self.nobj, self.npars_per, n)
 
-    def sample(self):
+        _sample_cen(self.cen_priors, samples, n)
+
+        g1, g2 = self.g_prior.sample2d(nrand)
+        _set_samples(samples, 2, g1)
+        _set_samples(samples, 3, g2)
+
+        _set_samples(samples, 4, self.T_prior.sample(nrand))
+
+        _set_samples(samples, 5, self.fracdev_prior.sample(nrand))
+
+        for j, F_prior in enumerate(self.F_priors):
+            _set_samples(samples, 6+j, F_prior.sample(nrand))
+
+        return _finish_samples(samples)
+
+    def _sample_one(self):
         """
-        Get random samples
+        get a single sample, drawing the parameters object by object so
+        the result for a given seed is the same as for earlier versions
         """
 
         samples = np.zeros(self.npars_per*self.nobj)
@@ -291,8 +317,113 @@ class PriorBDFSepMulti(object):
             samples[beg+5] = fracdev
 
             for j, F_prior in enumerate(self.F_priors):
-                F_prior = self.F_priors[j]
                 F = F_prior.sample()
                 samples[beg+6+j] = F
 
         return samples
+
+
+def _fill_cen_lnprob(cen_priors, cen_arrays, pars, lnp):
+    """
+    fill the log probability for the centers into the first two
+    columns of lnp, using the separate probabilities for each
+    dimension
+    """
+    if cen_arrays is None:
+        for i, cen_prior in enumerate(cen_priors):
+            lnp[i, 0], lnp[i, 1] = cen_prior.get_lnprob_scalar_sep(
+                pars[i, 0],
+                pars[i, 1],
+            )
+    else:
+        cen1, cen2, sigma1, sigma2 = cen_arrays
+
+        d1 = pars[:, 0] - cen1
+        d2 = pars[:, 1] - cen2
+        lnp[:, 0] = -0.5*d1**2/sigma1**2
+        lnp[:, 1] = -0.5*d2**2/sigma2**2
+
+
+def _get_cen_arrays(cen_priors):
+    """
+    get arrays of the center and width for each center prior, or
+    None if the priors do not have these attributes
+    """
+    try:
+        arrays = (
+            np.array([p.cen1 for p in cen_priors]),
+            np.array([p.cen2 for p in cen_priors]),
+            np.array([p.sigma1 for p in cen_priors]),
+            np.array([p.sigma2 for p in cen_priors]),
+        )
+    except AttributeError:
+        arrays = None
+
+    return arrays
+
+
+def _get_lnprob_array(prior, x, **keys):
+    """
+    log probability for an array of values, looping over the scalar
+    version for priors without an array version
+    """
+    if hasattr(prior, 'get_lnprob_array'):
+        return prior.get_lnprob_array(x, **keys)
+    else:
+        return np.array([prior.get_lnprob_scalar(v, **keys) for v in x])
+
+
+def _get_lnprob_array2d(prior, g1, g2):
+    """
+    log probability for arrays of shapes, looping over the scalar
+    version for priors without an array version
+    """
+    if hasattr(prior, 'get_lnprob_array2d'):
+        return prior.get_lnprob_array2d(g1, g2)
+    else:
+        return np.array([
+            prior.get_lnprob_scalar2d(tg1, tg2)
+            for tg1, tg2 in zip(g1, g2)
+        ])
+
+
+def _lnprob_to_fdiff(lnp):
+    """
+    convert log probabilities to sqrt(-2ln(p)), in place
+    """
+    lnp *= -2
+    lnp.clip(min=0.0, max=None, out=lnp)
+    np.sqrt(lnp, out=lnp)
+
+
+def _get_samples_array(nobj, npars_per, n):
+    """
+    get the array to hold samples, shape (n, nobj, npars_per), and the
+    number of random values to draw for each parameter
+    """
+    samples = np.zeros((n, nobj, npars_per))
+    return samples, n*nobj
+
+
+def _sample_cen(cen_priors, samples, n):
+    """
+    sample the centers for each object
+    """
+    for i, cen_prior in enumerate(cen_priors):
+        cen1, cen2 = cen_prior.sample(n)
+        samples[:, i, 0] = cen1
+        samples[:, i, 1] = cen2
+
+
+def _set_samples(samples, ipar, vals):
+    """
+    set the samples for a parameter, drawn for all samples and objects
+    """
+    samples[:, :, ipar] = np.asarray(vals).reshape(samples.shape[:2])
+
+
+def _finish_samples(samples):
+    """
+    flatten the parameters for all objects
+    """
+    return samples.reshape(samples.shape[0], -1)
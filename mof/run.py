@@ -0,0 +1,447 @@
+"""
+run the MOF on all the FoF groups from a MEDS set
+
+The groups are sent to a pool of processes, largest first.  Each worker
+pulls a new group from the queue as soon as it is done with the last one,
+so the few big groups start early and the many small groups fill in
+behind them, rather than ending up with one process working on the biggest
+group while the rest sit idle.
+
+Results are written to disk as each group finishes
+"""
+from __future__ import print_function
+import time
+import logging
+import numpy as np
+from ngmix.gexceptions import GMixRangeError
+
+from . import moflib
+from . import procflags
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RUN_CONFIG = {
+    'model': 'bdf',
+    'weight_type': 'weight',
+    'detband': 0,
+    'ntry': 2,
+    'lm_pars': {
+        'maxfev': 4000,
+        'ftol': 1.0e-5,
+        'xtol': 1.0e-5,
+    },
+
+    # extra keywords for MOFStamps
+    'mof': {},
+}
+
+NO_ATTEMPT = 2**30
+
+# the fit raised an exception other than GMixRangeError or LinAlgError
+FIT_EXCEPTION = 2**29
+
+# set for each worker process, see _init_worker
+_worker_data = {}
+
+
+class MOFRunner(object):
+    """
+    fit all FoF groups in a MEDS set using a pool of processes
+
+    parameters
+    ----------
+    meds_files: sequence
+        The MEDS file for each band.  Each process opens its own copy of
+        the files, so file handles are not shared between processes
+    fof_data: array
+        FoF group data, with fields fofid and number, as returned by
+        mof.fofs.NbrsFoF.get_fofs.  The number is the 1-based index into
+        the MEDS data
+    config: dict, optional
+        Configuration, see DEFAULT_RUN_CONFIG
+    psf_obs: Observation, optional
+        PSF observation with gmix set, used for all stamps.  If not sent,
+        the observations from the MEDS must already have a psf set
+    seed: int, optional
+        Seed for the random numbers; each group uses seed + fofid so the
+        results do not depend on which process fit the group
+    """
+    def __init__(self,
+                 meds_files,
+                 fof_data,
+                 config=None,
+                 psf_obs=None,
+                 seed=None):
+
+        self.meds_files = list(meds_files)
+        self.mb_meds = open_mb_meds(self.meds_files)
+        self.fof_data = fof_data
+        self.psf_obs = psf_obs
+
+        self.config = {}
+        self.config.update(DEFAULT_RUN_CONFIG)
+        if config is not None:
+            self.config.update(config)
+
+        if seed is None:
+            seed = np.random.randint(0, 2**30)
+        self.seed = seed
+
+        self._set_fof_list()
+
+    def go(self, output_file, nproc=1, clobber=True):
+        """
+        fit all groups and write the results
+
+        parameters
+        ----------
+        output_file: string
+            Output FITS file; one row is appended for each object as its
+            group finishes, so the rows are not in any particular order
+        nproc: int, optional
+            Number of processes to use, default 1
+        clobber: bool, optional
+            If True, remove any existing file.  Default True
+        """
+        import fitsio
+
+        ngroup = len(self.fof_list)
+        logger.info('fitting %d groups with %d processes' % (ngroup, nproc))
+
+        tm = time.time()
+        with fitsio.FITS(output_file, 'rw', clobber=clobber) as fits:
+            for igroup, output in enumerate(self.iter_fits(nproc=nproc)):
+                if igroup == 0:
+                    fits.write(output, extname='model_fits')
+                else:
+                    fits['model_fits'].append(output)
+
+                logger.debug('%d/%d' % (igroup+1, ngroup))
+
+        tm = time.time() - tm
+        logger.info('time: %g' % tm)
+
+    def iter_fits(self, nproc=1):
+        """
+        iterate over the groups, yielding the output array for each
+        group as it finishes
+
+        parameters
+        ----------
+        nproc: int, optional
+            Number of processes to use, default 1
+
+        yields
+        ------
+        output: array
+            The output for the objects in one group
+        """
+
+        tasks = [
+            (fofid, indices, self.seed + fofid)
+            for fofid, indices in self.fof_list
+        ]
+
+        if nproc == 1:
+            _set_worker_data(self.mb_meds, self.psf_obs, self.config)
+            for task in tasks:
+                yield _fit_fof_task(task)
+        else:
+            import multiprocessing
+
+            # send the file names rather than the open files, which
+            # cannot be pickled and would share file offsets when forked
+            pool = multiprocessing.Pool(
+                processes=nproc,
+                initializer=_init_worker,
+                initargs=(self.meds_files, self.psf_obs, self.config),
+            )
+            try:
+                # chunksize=1 means each process pulls a single group
+                # at a time, when it is ready for more work
+                for output in pool.imap_unordered(
+                        _fit_fof_task, tasks, chunksize=1):
+                    yield output
+            except BaseException:
+                # the caller stopped early, e.g. an error writing the
+                # output, an interrupt, or breaking out of the loop; don't
+                # wait for the remaining groups to be fit
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+
+    def _set_fof_list(self):
+        """
+        get the indices for each group, sorted by the estimated cost
+        of the fit, largest first
+        """
+        fof_data = self.fof_data
+
+        s = fof_data['fofid'].argsort(kind='mergesort')
+        fofids, starts = np.unique(fof_data['fofid'][s], return_index=True)
+        ends = np.append(starts[1:], s.size)
+
+        fof_list = []
+        costs = np.zeros(fofids.size)
+        for i, fofid in enumerate(fofids):
+            indices = fof_data['number'][s[starts[i]:ends[i]]] - 1
+            fof_list.append((fofid, indices))
+            costs[i] = self._get_cost(indices)
+
+        # stable so equal costs stay in fofid order
+        order = (-costs).argsort(kind='mergesort')
+
+        self.fof_list = [fof_list[i] for i in order]
+        self.fof_costs = costs[order]
+
+    def _get_cost(self, indices):
+        """
+        the fit time scales as the number of objects times the number of
+        pixels, since every object is rendered into its neighbors stamps
+        """
+        npix = 0
+        for m in self.mb_meds.mlist:
+            npix += (
+                m['box_size'][indices]**2 * m['ncutout'][indices]
+            ).sum()
+
+        return indices.size * npix
+
+
+def open_mb_meds(meds_files):
+    """
+    open the MEDS files for all bands
+
+    parameters
+    ----------
+    meds_files: sequence
+        The MEDS file for each band
+
+    returns
+    -------
+    mb_meds: MultiBandMEDS
+    """
+    import meds
+    from .stamps import MultiBandMEDS
+
+    return MultiBandMEDS([meds.MEDS(fname) for fname in meds_files])
+
+
+def fit_fof_group(mb_meds,
+                  indices,
+                  config,
+                  rng,
+                  psf_obs=None):
+    """
+    fit a single FoF group
+
+    parameters
+    ----------
+    mb_meds: MultiBandMEDS
+        The MEDS data for all bands
+    indices: array
+        Indices of the objects in the group
+    config: dict
+        Configuration, see DEFAULT_RUN_CONFIG
+    rng: np.random.RandomState
+        For guesses and priors
+    psf_obs: Observation, optional
+        PSF observation to set for all stamps
+
+    returns
+    -------
+    fitter: MOFStamps
+        The fitter after running go
+    """
+    model = config['model']
+
+    list_of_obs = mb_meds.get_mbobs_list(
+        indices=indices,
+        weight_type=config['weight_type'],
+    )
+
+    if psf_obs is not None:
+        for mbo in list_of_obs:
+            for obslist in mbo:
+                for obs in obslist:
+                    obs.set_psf(psf_obs)
+
+    prior = moflib.get_mof_stamps_prior(list_of_obs, model, rng)
+
+    fitter = moflib.MOFStamps(
+        list_of_obs,
+        model,
+        prior=prior,
+        lm_pars=config['lm_pars'],
+        **config['mof']
+    )
+
+    for itry in range(config['ntry']):
+        guess = moflib.get_stamp_guesses(
+            list_of_obs,
+            config['detband'],
+            model,
+            rng,
+        )
+        fitter.go(guess)
+        res = fitter.get_result()
+        if res['flags'] == 0:
+            break
+
+    return fitter
+
+
+def get_output(mb_meds, fofid, indices, config,
+               fitter=None, flags=NO_ATTEMPT):
+    """
+    get the output array for the objects in a group
+
+    parameters
+    ----------
+    mb_meds: MultiBandMEDS
+        The MEDS data for all bands
+    fofid: int
+        The FoF group id
+    indices: array
+        Indices of the objects in the group
+    config: dict
+        Configuration, see DEFAULT_RUN_CONFIG
+    fitter: MOFStamps, optional
+        The fitter after running.  If not sent, the flags
+        are set to the input flags
+    flags: int, optional
+        Flags to set when the fitter is not sent, default NO_ATTEMPT
+
+    returns
+    -------
+    output: array
+    """
+    m = mb_meds.mlist[0]
+    nband = len(mb_meds.mlist)
+
+    output = get_output_struct(indices.size, nband, config['model'])
+    output['id'] = m['id'][indices]
+    output['number'] = m['number'][indices]
+    output['fofid'] = fofid
+    output['fof_size'] = indices.size
+
+    if fitter is None:
+        output['flags'] = flags
+        return output
+
+    res = fitter.get_result()
+    output['flags'] = res['flags']
+
+    for i, ores in enumerate(fitter.get_result_list()):
+        output['psf_T'][i] = ores['psf_T']
+
+        if ores['flags'] == 0:
+            output['nfev'][i] = ores['nfev']
+            output['s2n'][i] = ores['s2n']
+            output['pars'][i] = ores['pars']
+            output['pars_err'][i] = np.sqrt(np.diag(ores['pars_cov']))
+            output['T'][i] = ores['T']
+            output['T_err'][i] = ores['T_err']
+            output['flux'][i] = ores['flux']
+            output['flux_err'][i] = ores['flux_err']
+
+    return output
+
+
+def get_output_struct(nobj, nband, model):
+    """
+    get the output structure for the fits, filled with defaults
+    """
+    if model == 'bdf':
+        npars = 6+nband
+    elif model == 'bd':
+        npars = 7+nband
+    else:
+        npars = 5+nband
+
+    dt = [
+        ('id', 'i8'),
+        ('number', 'i4'),
+        ('fofid', 'i8'),
+        ('fof_size', 'i4'),
+        ('flags', 'i4'),
+        ('nfev', 'i4'),
+        ('psf_T', 'f8'),
+        ('s2n', 'f8'),
+        ('pars', 'f8', npars),
+        ('pars_err', 'f8', npars),
+        ('T', 'f8'),
+        ('T_err', 'f8'),
+        ('flux', 'f8', nband),
+        ('flux_err', 'f8', nband),
+    ]
+
+    output = np.zeros(nobj, dtype=dt)
+    for name in output.dtype.names:
+        if name not in ['id', 'number', 'fofid', 'fof_size', 'flags']:
+            output[name] = -9999.0
+
+    return output
+
+
+def _init_worker(meds_files, psf_obs, config):
+    """
+    open the MEDS files and set the data used by all fits in this process
+    """
+    _set_worker_data(open_mb_meds(meds_files), psf_obs, config)
+
+
+def _set_worker_data(mb_meds, psf_obs, config):
+    """
+    set the data used by all fits in this process
+    """
+    _worker_data['mb_meds'] = mb_meds
+    _worker_data['psf_obs'] = psf_obs
+    _worker_data['config'] = config
+
+
+def _fit_fof_task(task):
+    """
+    fit the group and return the output array
+
+    A fit that raises an exception is flagged, and the run continues
+    with the next group
+    """
+    fofid, indices, seed = task
+
+    mb_meds = _worker_data['mb_meds']
+    config = _worker_data['config']
+
+    rng = np.random.RandomState(seed)
+
+    flags = 0
+    try:
+        fitter = fit_fof_group(
+            mb_meds,
+            indices,
+            config,
+            rng,
+            psf_obs=_worker_data['psf_obs'],
+        )
+    except GMixRangeError as err:
+        logger.info('fofid %d: %s' % (fofid, str(err)))
+        fitter = None
+        flags = procflags.GMIX_RANGE_ERROR
+    except np.linalg.LinAlgError as err:
+        logger.info('fofid %d: %s' % (fofid, str(err)))
+        fitter = None
+        flags = procflags.LIN_ALG_ERROR
+    except Exception:
+        # e.g. errors from galsim; log the traceback so the problem
+        # can be found, but don't lose the rest of the run
+        logger.exception('fofid %d: fit failed' % fofid)
+        fitter = None
+        flags = FIT_EXCEPTION
+
+    return get_output(
+        mb_meds, fofid, indices, config,
+        fitter=fitter, flags=flags,
+    )
@@ -14,6 +14,7 @@ from __future__ import print_function
 import logging
 import numpy as np
 from numpy import pi
+from numba import njit
 import esutil as eu
 from esutil.numpy_util import between
 import meds
@@ -47,10 +48,27 @@ DEFAULT_SX_CONFIG = {
         [0.051328, 0.221178, 0.530797, 0.710525, 0.530797, 0.221178, 0.051328],
         [0.021388, 0.092163, 0.221178, 0.296069, 0.221178, 0.092163, 0.021388],
         [0.004963, 0.021388, 0.051328, 0.068707, 0.051328, 0.021388, 0.004963],
-    ]
+    ],
+
+    # run detection in square tiles of this size, each extended by
+    # tile_overlap on all sides, using nthreads threads.  None means
+    # a single pass over the image.  See MEDSifier._extract_tiled
+    'tile_size': None,
+    'tile_overlap': 64,
+    'nthreads': 1,
+}
 
+# images with more pixels than this on a side are convolved with the
+# overlap-add method, see MEDSifier._make_convolved_image
+OACONVOLVE_MIN_DIM = 2048
 
-}
+# psf images used for the peak finder, keyed by (fwhm, scale, dim),
+# see get_psf_kernel
+_PSF_KERNEL_CACHE = {}
+
+# fields in the sep catalog holding x and y positions
+SEP_X_FIELDS = ['x', 'xmin', 'xmax', 'xcpeak', 'xpeak']
+SEP_Y_FIELDS = ['y', 'ymin', 'ymax', 'ycpeak', 'ypeak']
 
 DEFAULT_MEDS_CONFIG = {
     'rad_min': 4,
@@ -66,6 +84,17 @@ DEFAULT_IMAGE_VALUES = {
     'bmask': BMASK_EDGE,
 }
 
+# statistics for each object in a seg map, see get_seg_stats
+SEG_STATS_DTYPE = [
+    ('area', 'i8'),
+    ('row_min', 'i8'),
+    ('row_max', 'i8'),
+    ('col_min', 'i8'),
+    ('col_max', 'i8'),
+    ('row', 'f8'),
+    ('col', 'f8'),
+]
+
 ALLOWED_BOX_SIZES = [
     2, 3, 4, 6, 8, 12, 16, 24, 32, 48,
     64, 96, 128, 192, 256,
@@ -87,6 +116,9 @@ class MultiBandMEDS(object):
         if indices is None:
             indices = np.arange(self.mlist[0].size)
 
+        if all([hasattr(m, 'get_obslist_list') for m in self.mlist]):
+            return self._get_mbobs_list_batch(indices, weight_type)
+
         list_of_obs = []
         for iobj in indices:
             mbobs = self.get_mbobs(iobj, weight_type=weight_type)
@@ -94,6 +126,26 @@ class MultiBandMEDS(object):
 
         return list_of_obs
 
+    def _get_mbobs_list_batch(self, indices, weight_type):
+        """
+        get the list of MultiBandObsList, extracting the cutouts for
+        each band in bulk, see MEDSInterface.get_obslist_list
+        """
+        band_obslists = [
+            m.get_obslist_list(indices, weight_type=weight_type)
+            for m in self.mlist
+        ]
+
+        list_of_obs = []
+        for i in range(len(indices)):
+            mbobs = ngmix.MultiBandObsList()
+            for obslists in band_obslists:
+                mbobs.append(obslists[i])
+
+            list_of_obs.append(mbobs)
+
+        return list_of_obs
+
     def get_mbobs(self, iobj, weight_type='weight'):
         """
         get a multiband obs list
@@ -108,7 +160,21 @@ class MultiBandMEDS(object):
 
 
 class MEDSInterface(meds.MEDS):
-    def __init__(self, image, weight, seg, bmask, cat):
+    """
+    MEDS interface to full images and a catalog
+
+    parameters
+    ----------
+    image, weight, seg, bmask: arrays
+        The images; these can be memory maps, in which case only
+        the pixels in the cutouts are read
+    cat: array
+        The catalog, with the fields used by MEDS
+    zero_copy: bool, optional
+        If True, cutouts that are fully within the image are returned as
+        read only views into the images, see get_cutout.  Default False
+    """
+    def __init__(self, image, weight, seg, bmask, cat, zero_copy=False):
         self._image_data = dict(
             image=image,
             weight=weight,
@@ -116,8 +182,32 @@ class MEDSInterface(meds.MEDS):
             bmask=bmask,
         )
         self._cat = cat
+        self.zero_copy = zero_copy
 
-    def get_cutout(self, iobj, icutout, type='image'):
+    @classmethod
+    def from_npy(cls, image_file, weight_file, seg_file, bmask_file, cat,
+                 zero_copy=False):
+        """
+        make the interface from images stored in .npy files, which are
+        memory mapped read only rather than loaded
+
+        parameters
+        ----------
+        image_file, weight_file, seg_file, bmask_file: string
+            Paths to the .npy files
+        cat: array
+            The catalog, with the fields used by MEDS
+        zero_copy: bool, optional
+            See MEDSInterface.  Default False
+        """
+        images = [
+            np.load(fname, mmap_mode='r')
+            for fname in [image_file, weight_file, seg_file, bmask_file]
+        ]
+
+        return cls(*images, cat=cat, zero_copy=zero_copy)
+
+    def get_cutout(self, iobj, icutout, type='image', copy=None):
         """
         Get a single cutout for the indicated entry
 
@@ -130,6 +220,11 @@ class MEDSInterface(meds.MEDS):
         type: string, optional
             Cutout type. Default is 'image'.  Allowed
             values are 'image','weight','seg','bmask'
+        copy: bool, optional
+            If False, a cutout that is fully within the image is returned
+            as a read only view into the image.  Cutouts that hang off the
+            edge are always a new array, padded with the default value for
+            the type.  Default is to copy unless zero_copy was set
 
         returns
         -------
@@ -158,6 +253,16 @@ class MEDSInterface(meds.MEDS):
         read_im = im[orow_box[0]:orow_box[1],
                      ocol_box[0]:ocol_box[1]]
 
+        if copy is None:
+            copy = not self.zero_copy
+
+        if not copy and read_im.shape == (bsize, bsize):
+            # a view of a memory map is still a memory map; return
+            # a plain array view of the same memory
+            view = np.asarray(read_im).view()
+            view.flags.writeable = False
+            return view
+
         subim = np.zeros((bsize, bsize), dtype=im.dtype)
         subim += DEFAULT_IMAGE_VALUES[type]
 
@@ -166,6 +271,57 @@ class MEDSInterface(meds.MEDS):
 
         return subim
 
+    def get_cutout_stack(self, iobjs, icutouts, type='image'):
+        """
+        Get the cutouts for the indicated entries in a single array,
+        read from the image in one operation.  All the entries must
+        have the same box size
+
+        parameters
+        ----------
+        iobjs: array
+            Index of the object for each cutout
+        icutouts: array
+            Index of the cutout for each object
+        type: string, optional
+            Cutout type. Default is 'image'.  Allowed
+            values are 'image','weight','seg','bmask'
+
+        returns
+        -------
+        The cutouts, shape (n, box_size, box_size)
+        """
+
+        if type not in self._image_data:
+            raise ValueError("bad cutout type: '%s'" % type)
+
+        c = self._cat
+        bsizes = c['box_size'][iobjs]
+        bsize = bsizes[0]
+        if np.any(bsizes != bsize):
+            raise ValueError('all cutouts must have the same box size')
+
+        im = self._image_data[type]
+        dims = im.shape
+
+        offsets = np.arange(bsize)
+        rows = c['orig_start_row'][iobjs, icutouts][:, np.newaxis] + offsets
+        cols = c['orig_start_col'][iobjs, icutouts][:, np.newaxis] + offsets
+
+        row_ok = (rows >= 0) & (rows < dims[0])
+        col_ok = (cols >= 0) & (cols < dims[1])
+
+        rows = rows.clip(min=0, max=dims[0]-1)
+        cols = cols.clip(min=0, max=dims[1]-1)
+
+        stack = im[rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+
+        off_image = ~(row_ok[:, :, np.newaxis] & col_ok[:, np.newaxis, :])
+        if off_image.any():
+            stack[off_image] = DEFAULT_IMAGE_VALUES[type]
+
+        return stack
+
     def _get_clipped_boxes(self, dim, start, bsize):
         """
         get clipped boxes for slicing
@@ -230,6 +386,10 @@ class MEDSInterface(meds.MEDS):
         """
 
         import ngmix
+
+        # raises ValueError if the object has no cutouts
+        self._check_indices(iobj)
+
         obslist = ngmix.ObsList()
         for icut in range(self._cat['ncutout'][iobj]):
             obs = self.get_obs(iobj, icut, weight_type=weight_type)
@@ -239,6 +399,87 @@ class MEDSInterface(meds.MEDS):
         obslist.meta['T'] = obs.meta['T']
         return obslist
 
+    def get_obslist_list(self, indices, weight_type='weight'):
+        """
+        get an ngmix ObsList for each of the indicated objects, the same
+        as calling get_obslist for each.  As for get_obslist, a
+        ValueError is raised if any of the objects has no cutouts
+
+        The cutouts are grouped by box size, and each group is read from
+        each image in a single operation, see get_cutout_stack.  Weight
+        types other than 'weight' are made one cutout at a time
+
+        parameters
+        ----------
+        indices: array
+            Indices of the objects
+        weight_type: string, optional
+            Weight type, see get_obs.  Default is 'weight'
+
+        returns
+        -------
+        list of ngmix ObsList
+        """
+        import ngmix
+
+        c = self._cat
+        indices = np.array(indices, dtype='i8', ndmin=1)
+        for iobj in indices:
+            # raises ValueError if the object has no cutouts
+            self._check_indices(iobj)
+
+        # object and cutout index for every cutout
+        ncutout = c['ncutout'][indices]
+        iobjs = np.repeat(indices, ncutout)
+        icutouts = (
+            np.arange(iobjs.size) -
+            np.repeat(ncutout.cumsum() - ncutout, ncutout)
+        )
+
+        all_obs = [None]*iobjs.size
+
+        bsizes = c['box_size'][iobjs]
+        for bsize in np.unique(bsizes):
+            w, = np.where(bsizes == bsize)
+            biobjs = iobjs[w]
+            bicutouts = icutouts[w]
+
+            ims = self.get_cutout_stack(biobjs, bicutouts, type='image')
+            bmasks = self.get_cutout_stack(biobjs, bicutouts, type='bmask')
+            if weight_type == 'weight':
+                wts = self.get_cutout_stack(biobjs, bicutouts, type='weight')
+
+            for i, ind in enumerate(w):
+                iobj = iobjs[ind]
+                icutout = icutouts[ind]
+
+                if weight_type == 'weight':
+                    wt = wts[i]
+                else:
+                    wt = self._get_weight(iobj, icutout, weight_type)
+
+                all_obs[ind] = self._make_obs(
+                    iobj, icutout, ims[i], wt, bmasks[i],
+                )
+
+        obslists = []
+        start = 0
+        for iobj, n in zip(indices, ncutout):
+            if n == 0:
+                raise ValueError("object %s has no cutouts" % iobj)
+
+            obslist = ngmix.ObsList()
+            for obs in all_obs[start:start+n]:
+                obslist.append(obs)
+
+            # the meta data are for the object, the same for each cutout
+            obslist.meta['flux'] = obslist[-1].meta['flux']
+            obslist.meta['T'] = obslist[-1].meta['T']
+            obslists.append(obslist)
+            start += n
+
+        return obslists
+
     def get_obs(self, iobj, icutout, weight_type='weight'):
         """
         get an ngmix Observation
@@ -260,23 +501,54 @@ class MEDSInterface(meds.MEDS):
         an ngmix Observation
         """
 
-        import ngmix
         im = self.get_cutout(iobj, icutout, type='image')
         bmask = self.get_cutout(iobj, icutout, type='bmask')
-        jd = self.get_jacobian(iobj, icutout)
+        wt = self._get_weight(iobj, icutout, weight_type)
 
-        if weight_type == 'uberseg':
-            wt = self.get_uberseg(iobj, icutout)
-        elif weight_type == 'cweight':
-            wt = self.get_cweight_cutout(iobj, icutout, restrict_to_seg=True)
-        elif weight_type == 'weight':
-            wt = self.get_cutout(iobj, icutout, type='weight')
-        elif weight_type == 'cseg':
-            wt = self.get_cseg_weight(iobj, icutout)
-        elif weight_type == 'cseg-canonical':
-            wt = self.get_cseg_weight(iobj, icutout, use_canonical_cen=True)
-        else:
-            raise ValueError("bad weight type '%s'" % weight_type)
+        return self._make_obs(iobj, icutout, im, wt, bmask)
+
+    def _get_weight(self, iobj, icutout, weight_type):
+        """
+        get the weight map of the indicated type, see get_obs
+
+        The weight maps other than 'weight' are made by modifying the
+        cutouts in place, so copies are always used for those
+        """
+        if weight_type == 'weight':
+            return self.get_cutout(iobj, icutout, type='weight')
+
+        # the meds helpers call get_cutout themselves
+        zero_copy = self.zero_copy
+        self.zero_copy = False
+
+        try:
+            if weight_type == 'uberseg':
+                wt = self.get_uberseg(iobj, icutout)
+            elif weight_type == 'cweight':
+                wt = self.get_cweight_cutout(
+                    iobj, icutout, restrict_to_seg=True,
+                )
+            elif weight_type == 'cseg':
+                wt = self.get_cseg_weight(iobj, icutout)
+            elif weight_type == 'cseg-canonical':
+                wt = self.get_cseg_weight(
+                    iobj, icutout, use_canonical_cen=True,
+                )
+            else:
+                raise ValueError("bad weight type '%s'" % weight_type)
+        finally:
+            self.zero_copy = zero_copy
+
+        return wt
+
+    def _make_obs(self, iobj, icutout, im, wt, bmask):
+        """
+        make the observation from the cutouts, with the jacobian
+        and meta data for the entry
+        """
+        import ngmix
+
+        jd = self.get_jacobian(iobj, icutout)
 
         jacobian = ngmix.Jacobian(
             row=jd['row0'],
@@ -485,13 +757,10 @@ class MEDSifier(object):
         # DETECT_THRESH=1.6 # in sky sigma
         # DEBLEND_MINCONT=0.005
         # DETECT_MINAREA  = 6 # minimum number of pixels above threshold
-        objs, seg = sep.extract(
-            self.detim,
-            self.detect_thresh,
-            err=self.detnoise,
-            segmentation_map=True,
-            **self.sx_config
-        )
+        if self.tile_size is not None:
+            objs, seg = self._extract_tiled()
+        else:
+            objs, seg = self._extract(self.detim)
 
         logger.debug('found %d objects' % objs.size)
         if objs.size == 0:
@@ -594,9 +863,8 @@ class MEDSifier(object):
         cat['dvdcol'][:, 0] = wcs.dvdx
 
         # use the number of pixels in the seg map as the iso area
-        for i in range(objs.size):
-            w = np.where(seg == (i+1))
-            cat['isoarea_image'][i] = w[0].size
+        seg_stats = get_seg_stats(seg, objs.size)
+        cat['isoarea_image'] = seg_stats['area']
 
         cat['iso_radius'] = np.sqrt(cat['isoarea_image'].clip(min=1)/np.pi)
 
@@ -638,41 +906,151 @@ class MEDSifier(object):
         self.bmask = np.zeros(seg.shape, dtype='i4')
         self.cat = cat
 
+    def _extract(self, detim):
+        """
+        run sep.extract on the image, returning the catalog and seg map
+        """
+        import sep
+        return sep.extract(
+            detim,
+            self.detect_thresh,
+            err=self.detnoise,
+            segmentation_map=True,
+            **self.sx_config
+        )
+
+    def _extract_tiled(self):
+        """
+        run detection in tiles of the detection image, in parallel
+        threads, and merge the results
+
+        Each tile is extended by tile_overlap on all sides.  An object is
+        kept only by the tile whose un-extended region contains its
+        center, so objects in the overlaps are not duplicated.  The
+        overlap should be larger than the biggest objects
+
+        returns
+        -------
+        objs, seg: the merged catalog and seg map, with the objects
+        numbered in order of the tiles
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        tiles = self._get_detection_tiles()
+
+        def extract_tile(tile):
+            rbeg, rend, cbeg, cend = tile['region']
+            detim = np.ascontiguousarray(self.detim[rbeg:rend, cbeg:cend])
+            return self._extract(detim)
+
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            results = list(executor.map(extract_tile, tiles))
+
+        seg = np.zeros(self.detim.shape, dtype='i4')
+        objs_list = []
+        nobj = 0
+
+        for tile, (tobjs, tseg) in zip(tiles, results):
+            rbeg, rend, cbeg, cend = tile['region']
+
+            tobjs = tobjs.copy()
+            for name in SEP_X_FIELDS:
+                if name in tobjs.dtype.names:
+                    tobjs[name] += cbeg
+            for name in SEP_Y_FIELDS:
+                if name in tobjs.dtype.names:
+                    tobjs[name] += rbeg
+
+            crbeg, crend, ccbeg, ccend = tile['core']
+            keep, = np.where(
+                (tobjs['y'] >= crbeg - 0.5) & (tobjs['y'] < crend - 0.5) &
+                (tobjs['x'] >= ccbeg - 0.5) & (tobjs['x'] < ccend - 0.5)
+            )
+            if keep.size == 0:
+                continue
+
+            # new numbers for the kept objects, zero for the rest
+            numbers = np.zeros(tobjs.size+1, dtype='i4')
+            numbers[keep+1] = nobj + 1 + np.arange(keep.size)
+
+            new_tseg = numbers[tseg]
+            sub_seg = seg[rbeg:rend, cbeg:cend]
+            w = np.where((new_tseg > 0) & (sub_seg == 0))
+            sub_seg[w] = new_tseg[w]
+
+            objs_list.append(tobjs[keep])
+            nobj += keep.size
+
+        if len(objs_list) > 0:
+            objs = np.concatenate(objs_list)
+        else:
+            objs = results[0][0][0:0]
+
+        return objs, seg
+
+    def _get_detection_tiles(self):
+        """
+        get the tiles for detection, each with the un-extended region
+        'core' and the region extended by the overlap 'region', as
+        [row_start, row_end, col_start, col_end]
+        """
+        tile_size = self.tile_size
+        overlap = self.tile_overlap
+        nrows, ncols = self.detim.shape
+
+        tiles = []
+        for rbeg in range(0, nrows, tile_size):
+            rend = min(rbeg + tile_size, nrows)
+            for cbeg in range(0, ncols, tile_size):
+                cend = min(cbeg + tile_size, ncols)
+
+                tiles.append({
+                    'core': (rbeg, rend, cbeg, cend),
+                    'region': (
+                        max(rbeg - overlap, 0),
+                        min(rend + overlap, nrows),
+                        max(cbeg - overlap, 0),
+                        min(cend + overlap, ncols),
+                    ),
+                })
+
+        return tiles
+
     def _make_convolved_image(self, im, psf_im):
+        """
+        convolve the image with the psf using FFTs, with zero padding
+        at the edges as for a direct convolution
+
+        Large images are done in blocks with the overlap-add method,
+        which keeps the FFTs small
+        """
         import scipy.signal
-        return scipy.signal.convolve2d(
+
+        if (max(im.shape) > OACONVOLVE_MIN_DIM and
+                hasattr(scipy.signal, 'oaconvolve')):
+            convolve = scipy.signal.oaconvolve
+        else:
+            convolve = scipy.signal.fftconvolve
+
+        return convolve(
             im,
             psf_im,
             mode='same',
         )
 
     def _run_peak_finder(self, peak_config):
-        import galsim
         from . import peaks
 
-        imsize = self.detim.size
-        rows = np.zeros(imsize)
-        cols = np.zeros(imsize)
-
         thresh = peak_config['noise_thresh']*self.detnoise
 
-        psf = galsim.Gaussian(fwhm=0.9)
         wcs = self.datalist[0]['wcs']
         scale, _, _, _ = wcs.getDecomposition()
-        psf_im = psf.drawImage(
-            nx=21,
-            ny=21,
-            scale=scale,
-        ).array
+        psf_im = get_psf_kernel(0.9, scale)
 
         cim = self._make_convolved_image(self.detim, psf_im)
 
-        npeaks = peaks.find_peaks(
-            cim,
-            thresh,
-            rows,
-            cols,
-        )
+        peak_data = peaks.find_peaks_parallel(cim, thresh)
+        npeaks = peak_data.size
         seg = np.zeros(self.detim.shape, dtype='i4')
 
         objs = np.zeros(npeaks, dtype=[('x', 'f8'), ('y', 'f8')])
@@ -681,8 +1059,8 @@ class MEDSifier(object):
             self.cat = objs
             return
 
-        objs['y'] = rows[0:npeaks]
-        objs['x'] = cols[0:npeaks]
+        objs['y'] = peak_data['row']
+        objs['x'] = peak_data['col']
 
         ncut = 2  # need this to make sure array
         new_dt = [
@@ -834,6 +1212,9 @@ class MEDSifier(object):
             sx_config['filter_kernel'] = np.array(sx_config['filter_kernel'])
 
         self.detect_thresh = sx_config.pop('detect_thresh')
+        self.tile_size = sx_config.pop('tile_size')
+        self.tile_overlap = sx_config.pop('tile_overlap')
+        self.nthreads = sx_config.pop('nthreads')
         self.sx_config = sx_config
 
     def _set_meds_config(self, config):
@@ -846,6 +1227,42 @@ class MEDSifier(object):
         self.meds_config = meds_config
 
 
+def get_psf_kernel(fwhm, scale, dim=21):
+    """
+    get an image of a gaussian psf, cached by fwhm, scale and dim
+
+    parameters
+    ----------
+    fwhm: float
+        FWHM of the gaussian in arcsec
+    scale: float
+        Pixel scale in arcsec
+    dim: int, optional
+        Size of the image, default 21
+
+    returns
+    -------
+    The psf image; this is shared so should not be modified
+    """
+    key = (fwhm, scale, dim)
+    psf_im = _PSF_KERNEL_CACHE.get(key)
+
+    if psf_im is None:
+        import galsim
+
+        psf = galsim.Gaussian(fwhm=fwhm)
+        psf_im = psf.drawImage(
+            nx=dim,
+            ny=dim,
+            scale=scale,
+        ).array
+        psf_im.flags.writeable = False
+
+        _PSF_KERNEL_CACHE[key] = psf_im
+
+    return psf_im
+
+
 def fitpsf(psf_obs):
     am = ngmix.admom.run_admom(psf_obs, 4.0)
     gmix = am.get_gmix()
@@ -1075,3 +1492,84 @@ def test(ntrial=1, dim=2000, show=False):
     total_time = time.time()-tm0
     print("time per group:", total_time/ntrial)
     print("time per object:", total_time/nobj_meas)
+
+
+def get_seg_stats(seg, nobj):
+    """
+    get the number of pixels, bounding box and mean position of each
+    object in a seg map, in a single pass over the map
+
+    parameters
+    ----------
+    seg: array
+        The seg map, with object i marked by the number i+1
+    nobj: int
+        Number of objects
+
+    returns
+    -------
+    stats: array
+        With fields area, row_min, row_max, col_min, col_max, row, col.
+        For objects with no pixels the bounding box is -1 and the
+        position is -9999
+    """
+    stats = np.zeros(nobj, dtype=SEG_STATS_DTYPE)
+
+    row_sum = np.zeros(nobj)
+    col_sum = np.zeros(nobj)
+    bbox = np.zeros((nobj, 4), dtype='i8') - 1
+
+    _fill_seg_stats(
+        np.ascontiguousarray(seg),
+        stats['area'],
+        bbox,
+        row_sum,
+        col_sum,
+    )
+
+    stats['row_min'] = bbox[:, 0]
+    stats['row_max'] = bbox[:, 1]
+    stats['col_min'] = bbox[:, 2]
+    stats['col_max'] = bbox[:, 3]
+
+    stats['row'] = -9999.0
+    stats['col'] = -9999.0
+    w, = np.where(stats['area'] > 0)
+    if w.size > 0:
+        stats['row'][w] = row_sum[w]/stats['area'][w]
+        stats['col'][w] = col_sum[w]/stats['area'][w]
+
+    return stats
+
+
+@njit
+def _fill_seg_stats(seg, area, bbox, row_sum, col_sum):
+    """
+    accumulate the statistics for each object; values in the seg map
+    outside of [1, nobj] are ignored
+    """
+    nobj = area.size
+    nrows, ncols = seg.shape
+
+    for row in range(nrows):
+        for col in range(ncols):
+            i = seg[row, col] - 1
+            if i < 0 or i >= nobj:
+                continue
+
+            if area[i] == 0:
+                bbox[i, 0] = row
+                bbox[i, 1] = row
+                bbox[i, 2] = col
+                bbox[i, 3] = col
+            else:
+                # rows are visited in order
+                bbox[i, 1] = row
+                if col < bbox[i, 2]:
+                    bbox[i, 2] = col
+                if col > bbox[i, 3]:
+                    bbox[i, 3] = col
+
+            area[i] += 1
+            row_sum[i] += row
+            col_sum[i] += col
@@ -1 +1,5 @@
 from . import test_lin
+from . import test_fofs
+from . import test_fdiff
+from . import test_galsimfit
+from . import test_stamps
@@ -0,0 +1,259 @@
+"""
+consistency tests for the fdiff calculation of MOFStamps
+"""
+from __future__ import print_function
+import ngmix
+import numpy as np
+from ..moftest import Sim
+from ..moflib import (
+    MOFStamps,
+    get_mof_stamps_prior,
+    get_stamp_guesses,
+)
+from ..leastsq import get_bounds_arrays
+from .test_lin import _get_conf
+
+PIXEL_SCALE = 0.263
+
+
+def _make_multi_epoch_obs(rng, nepoch=2, dim=33, noise=0.01):
+    """
+    two overlapping objects observed in several epochs, with a
+    different psf in each epoch
+    """
+
+    # positions in the original images, and the true parameters
+    positions = [(50.0, 50.0), (56.0, 54.0)]
+    obj_pars = [
+        [0.0, 0.0, 0.1, -0.05, 0.5, 100.0],
+        [0.0, 0.0, -0.2, 0.1, 0.3, 50.0],
+    ]
+    psf_Ts = 0.2 + 0.4*np.arange(nepoch)
+
+    list_of_obs = []
+    for iobj, (orig_row, orig_col) in enumerate(positions):
+        obslist = ngmix.ObsList()
+
+        for epoch in range(nepoch):
+            psf_gmix = ngmix.GMixModel(
+                [0.0, 0.0, 0.0, 0.0, psf_Ts[epoch], 1.0],
+                'gauss',
+            )
+            psf_jac = ngmix.DiagonalJacobian(
+                row=12.0, col=12.0, scale=PIXEL_SCALE,
+            )
+            psf_obs = ngmix.Observation(
+                psf_gmix.make_image((25, 25), jacobian=psf_jac),
+                jacobian=psf_jac,
+            )
+            psf_obs.set_gmix(psf_gmix)
+
+            # shift the stamps differently in each epoch
+            start_row = int(orig_row) - (dim-1)//2 + epoch
+            start_col = int(orig_col) - (dim-1)//2 - epoch
+
+            image = np.zeros((dim, dim))
+            for pars, (row, col) in zip(obj_pars, positions):
+                jac = ngmix.DiagonalJacobian(
+                    row=row-start_row,
+                    col=col-start_col,
+                    scale=PIXEL_SCALE,
+                )
+                gm = ngmix.GMixModel(pars, 'exp').convolve(psf_gmix)
+                image += gm.make_image((dim, dim), jacobian=jac)
+
+            image += rng.normal(scale=noise, size=image.shape)
+
+            jacobian = ngmix.DiagonalJacobian(
+                row=orig_row-start_row,
+                col=orig_col-start_col,
+                scale=PIXEL_SCALE,
+            )
+            meta = {
+                'file_id': epoch,
+                'orig_row': orig_row,
+                'orig_col': orig_col,
+                'orig_start_row': start_row,
+                'orig_start_col': start_col,
+            }
+            obs = ngmix.Observation(
+                image,
+                weight=image*0 + 1.0/noise**2,
+                jacobian=jacobian,
+                psf=psf_obs,
+                meta=meta,
+            )
+            obslist.append(obs)
+
+        mbo = ngmix.MultiBandObsList()
+        mbo.append(obslist)
+        list_of_obs.append(mbo)
+
+    pars = np.array(obj_pars).ravel()
+    return list_of_obs, pars
+
+
+def _get_uncached_fdiff(fitter, pars):
+    """
+    fill the fdiff array without the cache of convolved mixtures
+    """
+    fdiff = np.zeros(fitter.fdiff_size)
+    allpars = pars.reshape(fitter.nobj, fitter.npars_per)
+
+    start = 0
+    for iobj, mbo in enumerate(fitter.list_of_obs):
+        start = fitter._fill_priors(allpars[iobj], fdiff, start)
+
+        for band, obslist in enumerate(mbo):
+            for obs in obslist:
+                fitter._fill_stamp_fdiff(
+                    pars, iobj, band, obs, fdiff, start,
+                )
+                start += obs.pixels.size
+
+    return fdiff
+
+
+def test_gmix_cache_multi_epoch():
+    """
+    the cached mixtures must use the psf of each epoch
+    """
+    rng = np.random.RandomState(5712)
+
+    list_of_obs, pars = _make_multi_epoch_obs(rng)
+    prior = get_mof_stamps_prior(list_of_obs, 'exp', rng)
+    fitter = MOFStamps(list_of_obs, 'exp', prior=prior)
+
+    pars = pars + rng.uniform(low=-0.01, high=0.01, size=pars.size)
+    fitter._setup_data(pars)
+
+    # call twice, the second call reuses the cache arrays
+    fitter._calc_fdiff(pars)
+    fdiff = fitter._calc_fdiff(pars).copy()
+
+    fdiff_uncached = _get_uncached_fdiff(fitter, pars)
+
+    assert np.allclose(fdiff, fdiff_uncached, rtol=1.0e-8, atol=1.0e-8)
+
+
+def _get_sim_data(nobj, seed, model):
+    """
+    simulate a group and get the list of observations, a prior and
+    a guess
+    """
+    conf = _get_conf(nobj)
+
+    sim = Sim(conf, seed)
+    sim.make_obs()
+
+    rng = np.random.RandomState(sim.rng.randint(0, 2**15))
+
+    medser = sim.get_medsifier()
+    m = medser.get_multiband_meds()
+    list_of_obs = m.get_mbobs_list(weight_type='weight')
+    assert len(list_of_obs) > 0, 'found no objects'
+
+    for mbo in list_of_obs:
+        for olist in mbo:
+            for o in olist:
+                o.set_psf(sim.psf_obs)
+
+    prior = get_mof_stamps_prior(list_of_obs, model, rng)
+    guess = get_stamp_guesses(list_of_obs, 0, model, rng)
+
+    return list_of_obs, prior, guess
+
+
+def _get_numerical_jacobian(fitter, pars, h=1.0e-5):
+    """
+    jacobian of _calc_fdiff from central differences
+    """
+    jac = np.zeros((fitter.fdiff_size, pars.size))
+
+    for ipar in range(pars.size):
+        step = h*max(abs(pars[ipar]), 1.0)
+
+        tpars = pars.copy()
+        tpars[ipar] = pars[ipar] + step
+        fdiff_plus = fitter._calc_fdiff(tpars).copy()
+
+        tpars[ipar] = pars[ipar] - step
+        fdiff_minus = fitter._calc_fdiff(tpars).copy()
+
+        jac[:, ipar] = (fdiff_plus - fdiff_minus)/(2*step)
+
+    return jac
+
+
+def _test_jacobian(model, seed, **keys):
+    """
+    compare the jacobian to one from finite differences of the
+    fdiff array
+    """
+    list_of_obs, prior, guess = _get_sim_data(2, seed, model)
+
+    fitter = MOFStamps(list_of_obs, model, prior=prior, **keys)
+
+    # the setup done in go
+    fitter._setup_data(guess)
+    _, fitter._upper_bounds = get_bounds_arrays(
+        fitter._get_bounds(fitter.nobj),
+        fitter.npars,
+    )
+    if fitter.sparse_jacobian:
+        fitter._setup_jacobian_blocks()
+
+    jac = fitter._calc_jacobian(guess)
+    if fitter.sparse_jacobian:
+        jac = jac.toarray()
+
+    num_jac = _get_numerical_jacobian(fitter, guess)
+
+    assert jac.shape == num_jac.shape
+
+    atol = 1.0e-3*np.abs(num_jac).max()
+    assert np.allclose(jac, num_jac, rtol=1.0e-3, atol=atol)
+
+
+def test_jacobian_exp():
+    _test_jacobian('exp', 8712, analytic_jacobian=True)
+
+
+def test_jacobian_bdf():
+    _test_jacobian('bdf', 8712, analytic_jacobian=True)
+
+
+def test_sparse_jacobian_exp():
+    _test_jacobian('exp', 2814, sparse_jacobian=True)
+    _test_jacobian('exp', 2814, sparse_jacobian=True, analytic_jacobian=True)
+
+
+def test_sparse_jacobian_bdf():
+    _test_jacobian('bdf', 2814, sparse_jacobian=True)
+    _test_jacobian('bdf', 2814, sparse_jacobian=True, analytic_jacobian=True)
+
+
+def _test_packed(model, seed):
+    """
+    the packed fdiff should match the fdiff calculated stamp by stamp
+    """
+    list_of_obs, prior, guess = _get_sim_data(2, seed, model)
+
+    fitter = MOFStamps(list_of_obs, model, prior=prior)
+    fitter._setup_data(guess)
+    fdiff = fitter._calc_fdiff(guess).copy()
+
+    pfitter = MOFStamps(list_of_obs, model, prior=prior, packed=True)
+    pfitter._setup_data(guess)
+    pfitter._setup_packed_data()
+    pfdiff = pfitter._calc_fdiff(guess).copy()
+
+    assert np.allclose(pfdiff, fdiff, rtol=1.0e-6, atol=1.0e-6)
+
+
+def test_packed_exp():
+    _test_packed('exp', 4431)
+
+
+def test_packed_bdf():
+    _test_packed('bdf', 4431)
@@ -0,0 +1,91 @@
+from __future__ import print_function
+import numpy as np
+from ..fofs import NbrsFoF
+
+
+def _make_nbrs_data(nobj, nedge, rng):
+    """
+    random symmetric neighbor data, with a -1 entry for every object as
+    in MEDSNbrs.get_nbrs for objects without neighbors
+    """
+    num1 = rng.randint(1, nobj+1, size=nedge)
+    num2 = rng.randint(1, nobj+1, size=nedge)
+
+    number = np.concatenate([np.arange(1, nobj+1), num1, num2])
+    nbr_number = np.concatenate([np.zeros(nobj, dtype='i8')-1, num2, num1])
+
+    nbrs_data = np.zeros(
+        number.size,
+        dtype=[('number', 'i8'), ('nbr_number', 'i8')],
+    )
+    nbrs_data['number'] = number
+    nbrs_data['nbr_number'] = nbr_number
+
+    nbrs_data = nbrs_data[rng.permutation(nbrs_data.size)]
+    s = np.argsort(nbrs_data['number'])
+    return nbrs_data[s]
+
+
+def _get_fofids_by_linking(nbrs_data):
+    """
+    the original algorithm, merging sets
+    """
+    nobj = len(np.unique(nbrs_data['number']))
+    linked = np.zeros(nobj, dtype='i8') - 1
+    fofs = {}
+
+    for mind in range(nobj):
+        q, = np.where(
+            (nbrs_data['number'] == mind+1)
+            &
+            (nbrs_data['nbr_number'] > 0)
+        )
+        nbrs = set(list(nbrs_data['nbr_number'][q]-1))
+
+        if linked[mind] == -1:
+            fofid = mind
+            fofs[fofid] = set([mind])
+            linked[mind] = fofid
+        else:
+            fofid = linked[mind]
+
+        for nbr in nbrs:
+            if linked[nbr] == -1 or linked[nbr] == fofid:
+                fofs[fofid].add(nbr)
+                linked[nbr] = fofid
+            else:
+                fofs[linked[nbr]] |= fofs[fofid]
+                del fofs[fofid]
+                fofid = linked[nbr]
+                inds = np.array(list(fofs[fofid]), dtype=int)
+                linked[inds] = fofid
+
+    for fofid, k in enumerate(sorted(fofs)):
+        inds = np.array(list(fofs[k]), dtype=int)
+        linked[inds] = fofid
+
+    return linked
+
+
+def test_fofs_no_nbrs():
+    rng = np.random.RandomState(8123)
+    nbrs_data = _make_nbrs_data(10, 0, rng)
+
+    fof_data = NbrsFoF(nbrs_data).get_fofs()
+    assert np.all(fof_data['number'] == np.arange(1, 11))
+    assert np.all(fof_data['fofid'] == np.arange(10))
+
+
+def test_fofs_match_linking():
+    rng = np.random.RandomState(3145)
+
+    for nedge_fac in [0.2, 0.5, 1.0, 2.0]:
+        for nobj in [2, 10, 100, 5000]:
+            nedge = int(nedge_fac*nobj)
+            nbrs_data = _make_nbrs_data(nobj, nedge, rng)
+
+            fof_data = NbrsFoF(nbrs_data).get_fofs()
+            fofids = _get_fofids_by_linking(nbrs_data)
+
+            assert np.all(fof_data['number'] == np.arange(1, nobj+1))
+            assert np.all(fof_data['fofid'] == fofids)
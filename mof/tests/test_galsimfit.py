@@ -0,0 +1,242 @@
+"""
+tests for the galsim fitters
+"""
+from __future__ import print_function
+import ngmix
+import numpy as np
+from ..galsimfit import (
+    KGSMOF,
+    GSMOF,
+    GSMOFFlux,
+    get_mof_stamps_prior_gs,
+)
+
+PIXEL_SCALE = 0.263
+PARENT_DIM = 100
+
+
+def _make_group_obs(rng,
+                    positions,
+                    fluxes,
+                    hlr=0.5,
+                    dim=33,
+                    noise=0.01,
+                    psf_fwhm=0.9):
+    """
+    exponential objects drawn into a parent image, with a stamp cut
+    out around each.  The input model pars for the flux fitters are
+    set in the meta data
+    """
+    import galsim
+
+    psf = galsim.Gaussian(fwhm=psf_fwhm)
+    psf_im = psf.drawImage(
+        nx=25, ny=25, scale=PIXEL_SCALE, method='no_pixel',
+    ).array
+    psf_jac = ngmix.DiagonalJacobian(
+        row=12.0, col=12.0, scale=PIXEL_SCALE,
+    )
+    psf_obs = ngmix.Observation(psf_im, jacobian=psf_jac)
+
+    parent = galsim.ImageD(PARENT_DIM, PARENT_DIM, scale=PIXEL_SCALE)
+    pcen = (PARENT_DIM - 1.0)/2.0
+    for (row, col), flux in zip(positions, fluxes):
+        obj = galsim.Convolve(
+            galsim.Exponential(half_light_radius=hlr, flux=flux),
+            psf,
+        )
+        obj.drawImage(
+            image=parent,
+            add_to_image=True,
+            method='no_pixel',
+            offset=(col - pcen, row - pcen),
+        )
+
+    parent = parent.array + rng.normal(scale=noise, size=parent.array.shape)
+
+    list_of_obs = []
+    for (orig_row, orig_col), flux in zip(positions, fluxes):
+        start_row = int(orig_row) - (dim-1)//2
+        start_col = int(orig_col) - (dim-1)//2
+
+        image = parent[start_row:start_row+dim, start_col:start_col+dim]
+
+        jacobian = ngmix.DiagonalJacobian(
+            row=orig_row-start_row,
+            col=orig_col-start_col,
+            scale=PIXEL_SCALE,
+        )
+        meta = {
+            'file_id': 0,
+            'orig_row': orig_row,
+            'orig_col': orig_col,
+            'orig_start_row': start_row,
+            'orig_start_col': start_col,
+        }
+        obs = ngmix.Observation(
+            image.copy(),
+            weight=image*0 + 1.0/noise**2,
+            jacobian=jacobian,
+            psf=psf_obs,
+            meta=meta,
+        )
+
+        obslist = ngmix.ObsList()
+        obslist.append(obs)
+        mbo = ngmix.MultiBandObsList()
+        mbo.append(obslist)
+
+        mbo.meta['input_flags'] = 0
+        mbo.meta['input_model_pars'] = np.array(
+            [0.0, 0.0, 0.0, 0.0, hlr, abs(flux)],
+        )
+        list_of_obs.append(mbo)
+
+    return list_of_obs
+
+
+def test_linear_flux_negative():
+    """
+    the linear solve can give negative fluxes, which should not stop
+    us getting the result for the object
+    """
+    rng = np.random.RandomState(9123)
+
+    fluxes = [100.0, -2.0]
+    list_of_obs = _make_group_obs(
+        rng,
+        [(50.0, 45.0), (50.0, 53.0)],
+        fluxes,
+    )
+
+    fitter = GSMOFFlux(list_of_obs, 'exp', linear_solve=True)
+    fitter.go()
+
+    res = fitter.get_result()
+    assert res['flags'] == 0
+
+    for i, flux in enumerate(fluxes):
+        ores = fitter.get_object_result(i)
+        assert np.isfinite(ores['s2n'])
+        assert np.all(np.isfinite(ores['flux_err']))
+
+        # the templates have unit total flux, even when the object is
+        # cut off by the edge of the stamp
+        tol = 5*ores['flux_err'][0] + 0.01*abs(flux)
+        assert abs(ores['flux'][0] - flux) < tol
+
+
+def test_parent_templates():
+    """
+    the neighbor templates sliced from the parent frame should match
+    those drawn into each stamp
+    """
+    rng = np.random.RandomState(3318)
+
+    positions = [(40.0, 40.0), (46.0, 52.0), (58.0, 44.0)]
+    list_of_obs = _make_group_obs(rng, positions, [100.0, 50.0, 80.0])
+
+    fitter = GSMOFFlux(list_of_obs, 'exp', linear_solve=True)
+    pfitter = GSMOFFlux(
+        list_of_obs, 'exp', linear_solve=True, parent_templates=True,
+    )
+
+    flux_pars = np.ones(len(positions))
+    for iobj, mbo in enumerate(list_of_obs):
+        obs = mbo[0][0]
+
+        indices, templates = fitter._get_stamp_templates(
+            iobj, 0, obs, flux_pars,
+        )
+        pindices, ptemplates = pfitter._get_stamp_templates(
+            iobj, 0, obs, flux_pars,
+        )
+
+        assert np.all(pindices == indices)
+
+        atol = 1.0e-3*np.abs(templates).max()
+        assert np.allclose(ptemplates, templates, rtol=0, atol=atol)
+
+
+def _get_fit_pars(model, fluxes, hlr=0.5):
+    """
+    parameters for the galsim fitters, offset from the truth so the
+    residuals are not just noise
+    """
+    pars = []
+    for i, flux in enumerate(fluxes):
+        opars = [0.01*i, -0.01, 0.05, -0.02*i, 1.1*hlr]
+        if model == 'bdf':
+            opars += [0.3]
+        opars += [1.1*flux]
+        pars += opars
+
+    return np.array(pars)
+
+
+def _test_kspace(model):
+    """
+    the analytic k space models should match those drawn with galsim
+    """
+    rng = np.random.RandomState(7716)
+
+    positions = [(50.0, 45.0), (50.0, 53.0)]
+    fluxes = [100.0, 50.0]
+    list_of_obs = _make_group_obs(rng, positions, fluxes)
+
+    prior = get_mof_stamps_prior_gs(list_of_obs, model, rng)
+    pars = _get_fit_pars(model, fluxes)
+
+    fitter = KGSMOF(list_of_obs, model, prior)
+    kfitter = KGSMOF(list_of_obs, model, prior, analytic_kspace=True)
+
+    fdiff = fitter._calc_fdiff(pars).copy()
+    kfdiff = kfitter._calc_fdiff(pars).copy()
+
+    atol = 1.0e-3*np.abs(fdiff).max()
+    assert np.allclose(kfdiff, fdiff, rtol=0, atol=atol)
+
+
+def test_kspace_exp():
+    _test_kspace('exp')
+
+
+def test_kspace_bdf():
+    _test_kspace('bdf')
+
+
+def test_fft_draw():
+    """
+    drawing with the cached k space psf image should match drawImage,
+    for objects at the center and offset
+    """
+    import galsim
+
+    rng = np.random.RandomState(1298)
+
+    positions = [(50.0, 45.0), (50.0, 53.0)]
+    fluxes = [100.0, 50.0]
+    list_of_obs = _make_group_obs(rng, positions, fluxes)
+
+    prior = get_mof_stamps_prior_gs(list_of_obs, 'exp', rng)
+    fitter = GSMOF(list_of_obs, 'exp', prior, fft_draw=True)
+
+    for mbo in list_of_obs:
+        obs = mbo[0][0]
+
+        for du, dv in [(0.0, 0.0), (1.3, -0.8)]:
+            obj = galsim.Exponential(
+                half_light_radius=0.5, flux=100.0,
+            ).shear(g1=0.1, g2=-0.05).shift(du, dv)
+
+            image = fitter._draw_fft(obs, obj)
+
+            gsimage = obs.meta['model'].copy()
+            fitter._do_draw(
+                obs,
+                galsim.Convolve(obj, obs.psf.meta['ii']),
+                gsimage,
+            )
+
+            atol = 1.0e-3*np.abs(gsimage.array).max()
+            assert np.allclose(image, gsimage.array, rtol=0, atol=atol)
@@ -2,10 +2,12 @@ from __future__ import print_function
 import ngmix
 import numpy as np
 import yaml
+from .. import procflags
 from ..moftest import Sim
 from ..moflib import (
     MOFFlux,
     MOFStamps,
+    get_lin_fluxes,
     get_mof_stamps_prior,
     get_stamp_guesses,
 )
@@ -223,3 +225,30 @@ def test_err(ntrial=100, show=False):
     print('expected std:', expected_std)
 
     return all_fluxes, all_flux_errs
+
+
+def test_lin_fluxes_empty_template():
+    """
+    an object with no light in any stamp should be flagged, without
+    affecting the flux of the other object
+    """
+    rng = np.random.RandomState(2231)
+
+    npix = 100
+    templates = np.zeros((2, npix))
+    templates[0] = rng.uniform(size=npix)
+    rim = 3.0*templates[0] + rng.normal(size=npix)
+
+    stamp_data = [(np.array([0, 1]), templates, rim)]
+    res = get_lin_fluxes(stamp_data, 2)
+
+    assert res['flags'][0] == 0
+    assert res['flags'][1] == procflags.LIN_ALG_ERROR
+
+    assert np.isfinite(res['flux'][0])
+    assert np.isfinite(res['flux_err'][0])
+    assert abs(res['flux'][0] - 3.0) < 5*res['flux_err'][0]
+
+    # the same as solving for the first object alone
+    res1 = get_lin_fluxes([(np.array([0]), templates[0:1], rim)], 1)
+    assert np.allclose(res['flux'][0], res1['flux'][0])
@@ -0,0 +1,129 @@
+"""
+tests for the MEDS interface to full images
+"""
+from __future__ import print_function
+import numpy as np
+from ..stamps import MEDSInterface
+
+DIMS = (64, 64)
+BOX_SIZE = 24
+PIXEL_SCALE = 0.263
+
+
+def _make_interface(rng, zero_copy=False):
+    """
+    two objects in the interior of the image, with overlapping seg maps
+    """
+    rows = np.array([30.0, 34.0])
+    cols = np.array([30.0, 36.0])
+    nobj = rows.size
+
+    image = rng.normal(scale=0.1, size=DIMS)
+    weight = np.zeros(DIMS) + 100.0
+    bmask = np.zeros(DIMS, dtype='i4')
+
+    seg = np.zeros(DIMS, dtype='i4')
+    seg[26:34, 26:34] = 1
+    seg[30:38, 32:40] = 2
+
+    ncut = 2
+    dt = [
+        ('id', 'i8'),
+        ('number', 'i4'),
+        ('ncutout', 'i4'),
+        ('box_size', 'i4'),
+        ('x2', 'f8'),
+        ('y2', 'f8'),
+        ('file_id', 'i8', ncut),
+        ('orig_row', 'f4', ncut),
+        ('orig_col', 'f4', ncut),
+        ('orig_start_row', 'i8', ncut),
+        ('orig_start_col', 'i8', ncut),
+        ('orig_end_row', 'i8', ncut),
+        ('orig_end_col', 'i8', ncut),
+        ('cutout_row', 'f4', ncut),
+        ('cutout_col', 'f4', ncut),
+        ('dudrow', 'f8', ncut),
+        ('dudcol', 'f8', ncut),
+        ('dvdrow', 'f8', ncut),
+        ('dvdcol', 'f8', ncut),
+    ]
+    cat = np.zeros(nobj, dtype=dt)
+    cat['id'] = np.arange(nobj)
+    cat['number'] = np.arange(1, nobj+1)
+    cat['ncutout'] = 1
+    cat['box_size'] = BOX_SIZE
+    cat['x2'] = 2.0
+    cat['y2'] = 2.0
+
+    start_row = rows.astype('i8') - BOX_SIZE//2 + 1
+    start_col = cols.astype('i8') - BOX_SIZE//2 + 1
+
+    cat['orig_row'][:, 0] = rows
+    cat['orig_col'][:, 0] = cols
+    cat['orig_start_row'][:, 0] = start_row
+    cat['orig_start_col'][:, 0] = start_col
+    cat['orig_end_row'][:, 0] = start_row + BOX_SIZE
+    cat['orig_end_col'][:, 0] = start_col + BOX_SIZE
+    cat['cutout_row'][:, 0] = rows - start_row
+    cat['cutout_col'][:, 0] = cols - start_col
+    cat['dudcol'][:, 0] = PIXEL_SCALE
+    cat['dvdrow'][:, 0] = PIXEL_SCALE
+
+    # different sizes so the meta data differ between objects
+    cat['x2'][1] = 3.0
+
+    m = MEDSInterface(image, weight, seg, bmask, cat, zero_copy=zero_copy)
+    return m, weight
+
+
+def test_zero_copy_cweight():
+    """
+    weight maps that are made by modifying the cutout must work with
+    zero copy cutouts, and must not change the input weight map
+    """
+    rng = np.random.RandomState(8811)
+
+    m, weight = _make_interface(rng, zero_copy=True)
+    orig_weight = weight.copy()
+
+    # interior stamps are read only views
+    im = m.get_cutout(0, 0)
+    assert not im.flags.writeable
+
+    obs = m.get_obs(0, 0, weight_type='cweight')
+
+    seg = m.get_cutout(0, 0, type='seg')
+    wt = obs.weight
+    assert np.all(wt[seg == 2] == 0.0)
+    assert np.all(wt[seg != 2] > 0.0)
+
+    assert np.all(weight == orig_weight)
+
+
+def test_obslist_list():
+    """
+    the bulk extraction should match get_obslist, and fail in the same
+    way for objects with no cutouts
+    """
+    rng = np.random.RandomState(4120)
+
+    m, _ = _make_interface(rng)
+
+    obslists = m.get_obslist_list([0, 1])
+    for iobj, obslist in enumerate(obslists):
+        tobslist = m.get_obslist(iobj)
+
+        assert obslist.meta['T'] == tobslist.meta['T']
+        assert obslist.meta['flux'] == tobslist.meta['flux']
+        for obs, tobs in zip(obslist, tobslist):
+            assert np.all(obs.image == tobs.image)
+            assert np.all(obs.weight == tobs.weight)
+
+    m._cat['ncutout'][1] = 0
+    for func in [m.get_obslist, m.get_obslist_list]:
+        try:
+            func(1)
+            raise AssertionError('expected ValueError')
+        except ValueError:
+            pass